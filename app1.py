@@ -1,27 +1,116 @@
-from flask import Flask, request, jsonify, render_template, render_template_string, redirect, url_for, session, flash
+from flask import Flask, request, jsonify, render_template, render_template_string, redirect, url_for, session, flash, g, has_app_context, has_request_context, send_from_directory, current_app
+from flask import before_render_template, template_rendered
+from flask.cli import with_appcontext
+from werkzeug.local import LocalProxy
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 from flask_sqlalchemy import SQLAlchemy
-from jinja2 import DictLoader
+import click
+from jinja2 import DictLoader, FileSystemBytecodeCache
 from flask_login import UserMixin
+import asyncio
 import json
 import math
+import mimetypes
 import os
+import random
 import re
-from datetime import datetime
-from functools import wraps
+import sys
+import gzip
+import hashlib
+import heapq
+import hmac
+import logging
+import threading
+import time
+import uuid
+import zlib
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import lru_cache, partial, wraps
 from markupsafe import Markup
-from flask_migrate import Migrate
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def default_config():
+    # Читается при создании приложения, а не при импорте модуля
+    return {
+        'SECRET_KEY': 'секрет',
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'sqlite:///site.db'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'UPLOAD_FOLDER': 'uploads',
+        # Команды flask db; без них не импортируются flask_migrate и alembic
+        'MIGRATE_ENABLED': os.environ.get('MIGRATE_ENABLED', '1') == '1',
+        'FRAGMENT_CACHE_URL': os.environ.get('FRAGMENT_CACHE_URL'),  # None — кэш в памяти процесса
+        # Планировщик в процессе веб-сервера; при отдельном воркере (flask worker) выключается
+        'SCHEDULER_ENABLED': os.environ.get('SCHEDULER_ENABLED', '1') == '1',
+        'SCHEDULER_INTERVAL': float(os.environ.get('SCHEDULER_INTERVAL', '60')),
+        # Потоки обработки очереди событий; 0 — события обрабатываются сразу после коммита запроса
+        'OUTBOX_WORKERS': int(os.environ.get('OUTBOX_WORKERS', '2')),
+        # Байткод скомпилированных шаблонов общий для всех процессов; пустая строка отключает кэш,
+        # None — каталог template_cache в instance
+        'TEMPLATE_CACHE_DIR': os.environ.get('TEMPLATE_CACHE_DIR'),
+        # Сжатие ответов: меньшие тела не сжимаются, сжатые тела страниц с ETag кэшируются
+        'COMPRESS_MIN_SIZE': 1024,
+        'COMPRESS_LEVEL': 6,
+        'COMPRESS_CACHE_BYTES': 16 * 1024 * 1024,
+        # Рейтинги в памяти перечитываются из базы не реже раза в столько секунд. None — один раз
+        # на процесс; при нескольких процессах так ограничивается отставание от чужих изменений
+        'RANKINGS_MAX_AGE': float(os.environ['RANKINGS_MAX_AGE']) if os.environ.get('RANKINGS_MAX_AGE') else None,
+        # Живой рейтинг в синхронном сервере держит поток на подключение, поэтому таких подключений
+        # не больше стольких на процесс (0 — выключено); в asgi.py подключения потоков не занимают
+        'LIVE_SYNC_STREAMS': int(os.environ.get('LIVE_SYNC_STREAMS', '2')),
+        # /admin/metrics доступен администратору, а сборщику метрик — с заголовком Authorization: Bearer <токен>
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+        # Управление профилировщиком и стеки процессов; общий для всех процессов сервера каталог,
+        # None — каталог profiler в instance
+        'PROFILER_DIR': os.environ.get('PROFILER_DIR'),
+    }
+
+db = SQLAlchemy()
+
+def after_commit(callback):
+    # Изменения в памяти процесса (рейтинги, кэши) применяются после коммита транзакции,
+    # в которой изменились данные, и отбрасываются при откате
+    db.session.info.setdefault('after_commit', []).append(callback)
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit(session):
+    for callback in session.info.pop('after_commit', ()):
+        callback()
+
+@event.listens_for(Session, 'after_transaction_end')
+def discard_after_commit(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('after_commit', None)
+
+# Маршруты и прогрев регистрируются в модуле, а подключаются к приложению в create_app
+ROUTES = []
+WARMUP_HOOKS = []
+
+def route(rule, **options):
+    def decorator(f):
+        ROUTES.append((rule, f, options))
+        return f
+    return decorator
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'секрет'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'uploads'
+def on_warm_up(f):
+    WARMUP_HOOKS.append(f)
+    return f
 
-app.jinja_env.globals.update(json=json, math=math)
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Состояние подсистем (кэши, рейтинги, потоки) у каждого приложения свое и создается в
+# create_app; модульные имена вроде leaderboards обращаются к подсистеме текущего приложения
+def app_local(name):
+    return LocalProxy(lambda: getattr(current_app.extensions['math_site'], name))
 
 # Модели
 class User(db.Model, UserMixin):
@@ -34,14 +123,14 @@ class User(db.Model, UserMixin):
     xp = db.Column(db.Integer, default=0)
     level = db.Column(db.Integer, default=1)
     coins = db.Column(db.Integer, default=0)
-    titles = db.Column(db.String(500), default="[]")  # JSON список титулов
-    inventory = db.Column(db.String(1000), default="[]")  # JSON список предметов
+    titles = db.Column(db.String(500), default="[]")  # Устарело: перенесено в таблицу user_title
+    inventory = db.Column(db.String(1000), default="[]")  # Устарело: перенесено в таблицу user_item
     equipped_title = db.Column(db.Integer)  # ID текущего титула
     achievements = db.relationship('UserAchievement', backref='user', lazy=True)
     daily_tasks = db.relationship('UserDailyTask', backref='user', lazy=True)
     streak = db.relationship('UserStreak', backref='user', lazy=True, uselist=False)
-    friends = db.Column(db.String(1000), default="[]")  # JSON список ID друзей
-    friend_requests = db.Column(db.String(1000), default="[]")  # JSON список входящих запросов
+    friends = db.Column(db.String(1000), default="[]")  # Устарело: перенесено в таблицу friendship
+    friend_requests = db.Column(db.String(1000), default="[]")  # Устарело: перенесено в таблицу friendship
     notes = db.Column(db.Text)  # Пользовательские заметки
     settings = db.Column(db.String(1000), default="{}")  # JSON настройки пользователя
 
@@ -51,96 +140,134 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password, password)
 
-    def add_xp(self, amount):
-        self.xp += amount
-        needed_xp = self.calculate_needed_xp()
-        while self.xp >= needed_xp:
-            self.xp -= needed_xp
-            self.level += 1
-            flash(f"Поздравляем! Вы достигли уровня {self.level}!", "success")
-            needed_xp = self.calculate_needed_xp()
-        db.session.commit()
-
-    def calculate_needed_xp(self):
-        return 100 * (self.level ** 2)
+    def add_xp(self, amount, source=None):
+        # Не коммитит. Опыт прибавляется одним UPDATE, а не записью прочитанного значения:
+        # потоки очереди событий начисляют одному пользователю параллельно. После UPDATE
+        # строка заблокирована до конца транзакции, поэтому повышение уровня пишется безопасно
+        if amount > 0:
+            record_xp_gain(self.id, amount, source)
+        table = User.__table__
+        xp, level, coins = db.session.execute(
+            db.update(table).where(table.c.id == self.id).values(xp=table.c.xp + amount)
+            .returning(table.c.xp, table.c.level, table.c.coins)).one()
+        start_level = level
+        needed_xp = self.calculate_needed_xp(level)
+        while xp >= needed_xp:
+            xp -= needed_xp
+            level += 1
+            if has_request_context():
+                flash(f"Поздравляем! Вы достигли уровня {level}!", "success")
+            needed_xp = self.calculate_needed_xp(level)
+        if level != start_level:
+            db.session.execute(db.update(table).where(table.c.id == self.id).values(xp=xp, level=level))
+        for key, value in (('xp', xp), ('level', level), ('coins', coins)):
+            set_committed_value(self, key, value)
+        snapshot = self.ranking_snapshot()
+
+        def apply():
+            leaderboards.update_user(snapshot)
+            if amount > 0:
+                windowed_leaderboards.add(snapshot['id'], amount)
+                friends_leaderboards.invalidate(snapshot['id'])
+                fragment_cache.bump('leaderboard_period')
+        after_commit(apply)
+        if amount > 0:
+            events.publish('xp_gained', user=self, amount=amount, source=source)
+
+    def calculate_needed_xp(self, level=None):
+        return 100 * ((level or self.level) ** 2)
 
     def add_coins(self, amount):
-        self.coins += amount
-        db.session.commit()
+        # Не коммитит; как и опыт, монеты меняются одним UPDATE
+        table = User.__table__
+        xp, level, coins = db.session.execute(
+            db.update(table).where(table.c.id == self.id).values(coins=table.c.coins + amount)
+            .returning(table.c.xp, table.c.level, table.c.coins)).one()
+        for key, value in (('xp', xp), ('level', level), ('coins', coins)):
+            set_committed_value(self, key, value)
+        after_commit(partial(leaderboards.update_user, self.ranking_snapshot()))
 
     def add_title(self, title_id):
-        try:
-            titles = json.loads(self.titles)
-            if title_id not in titles:
-                titles.append(title_id)
-                self.titles = json.dumps(titles)
-                db.session.commit()
-                return True
-            return False
-        except json.JSONDecodeError:
-            self.titles = json.dumps([title_id])
-            db.session.commit()
-            return True
+        # Не коммитит: титул выдается в транзакции вызывающего
+        result = db.session.execute(
+            db.insert(UserTitle.__table__).prefix_with('OR IGNORE'),
+            {'user_id': self.id, 'title_id': title_id, 'acquired_at': datetime.utcnow()}
+        )
+        return result.rowcount == 1
+
+    def ranking_snapshot(self):
+        return {'id': self.id, 'username': self.username, 'level': self.level or 1,
+                'xp': self.xp or 0, 'coins': self.coins or 0}
+
+    def has_title(self, title_id):
+        return db.session.query(
+            UserTitle.query.filter_by(user_id=self.id, title_id=title_id).exists()
+        ).scalar()
+
+    def title_ids(self):
+        return [tid for (tid,) in db.session.query(UserTitle.title_id)
+                .filter_by(user_id=self.id).order_by(UserTitle.acquired_at, UserTitle.title_id)]
 
     def add_item(self, item_id):
-        try:
-            inventory = json.loads(self.inventory)
-            if item_id not in inventory:
-                inventory.append(item_id)
-                self.inventory = json.dumps(inventory)
-                db.session.commit()
-                return True
-            return False
-        except json.JSONDecodeError:
-            self.inventory = json.dumps([item_id])
-            db.session.commit()
-            return True
+        result = db.session.execute(
+            db.insert(UserItem.__table__).prefix_with('OR IGNORE'),
+            {'user_id': self.id, 'item_id': item_id, 'acquired_at': datetime.utcnow()}
+        )
+        return result.rowcount == 1
+
+    def has_item(self, item_id):
+        return db.session.query(
+            UserItem.query.filter_by(user_id=self.id, item_id=item_id).exists()
+        ).scalar()
 
     def add_friend(self, friend_id):
-        try:
-            friends = json.loads(self.friends)
-            if friend_id not in friends:
-                friends.append(friend_id)
-                self.friends = json.dumps(friends)
-                db.session.commit()
-                return True
+        edge = db.session.get(Friendship, (self.id, friend_id))
+        if edge and edge.status == FRIENDSHIP_ACCEPTED:
             return False
-        except json.JSONDecodeError:
-            self.friends = json.dumps([friend_id])
-            db.session.commit()
-            return True
+        if edge:
+            edge.status = FRIENDSHIP_ACCEPTED
+        else:
+            db.session.add(Friendship(user_id=self.id, friend_id=friend_id, status=FRIENDSHIP_ACCEPTED))
+        db.session.commit()
+        return True
 
     def add_friend_request(self, user_id):
-        try:
-            requests = json.loads(self.friend_requests)
-            if user_id not in requests:
-                requests.append(user_id)
-                self.friend_requests = json.dumps(requests)
-                db.session.commit()
-                return True
+        # Запрос хранится как ребро user_id -> self.id со статусом pending
+        if user_id == self.id or db.session.get(Friendship, (user_id, self.id)):
             return False
-        except json.JSONDecodeError:
-            self.friend_requests = json.dumps([user_id])
-            db.session.commit()
-            return True
+        if self.is_friend(user_id):
+            return False
+        db.session.add(Friendship(user_id=user_id, friend_id=self.id, status=FRIENDSHIP_PENDING))
+        db.session.commit()
+        return True
+
+    def is_friend(self, other_id):
+        edge = db.session.get(Friendship, (self.id, other_id))
+        return edge is not None and edge.status == FRIENDSHIP_ACCEPTED
+
+    def is_mutual_friend(self, other_id):
+        return Friendship.query.filter(
+            db.or_(
+                db.and_(Friendship.user_id == self.id, Friendship.friend_id == other_id),
+                db.and_(Friendship.user_id == other_id, Friendship.friend_id == self.id)
+            ),
+            Friendship.status == FRIENDSHIP_ACCEPTED
+        ).count() == 2
+
+    def get_friends(self):
+        return User.query.join(Friendship, Friendship.friend_id == User.id).filter(
+            Friendship.user_id == self.id,
+            Friendship.status == FRIENDSHIP_ACCEPTED
+        ).all()
+
+    def get_friend_requests(self):
+        return User.query.join(Friendship, Friendship.user_id == User.id).filter(
+            Friendship.friend_id == self.id,
+            Friendship.status == FRIENDSHIP_PENDING
+        ).all()
 
     def update_streak(self):
-        if not self.streak:
-            self.streak = UserStreak(user_id=self.id)
-            db.session.add(self.streak)
-        
-        now = datetime.utcnow()
-        last_activity = self.streak.last_activity
-        
-        if (now - last_activity).days == 1:
-            self.streak.current_streak += 1
-            if self.streak.current_streak > self.streak.longest_streak:
-                self.streak.longest_streak = self.streak.current_streak
-        elif (now - last_activity).days > 1:
-            self.streak.current_streak = 1
-        
-        self.streak.last_activity = now
-        db.session.commit()
+        return streak_engine.record(self)
 
 class Test(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -152,6 +279,7 @@ class Test(db.Model):
     xp_reward = db.Column(db.Integer, default=10)
     coin_reward = db.Column(db.Integer, default=5)
     title_reward = db.Column(db.Integer)  # ID титула за прохождение
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Question(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -168,8 +296,13 @@ class UserProgress(db.Model):
     test_id = db.Column(db.Integer, db.ForeignKey('test.id'))
     score = db.Column(db.Float)
     completed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    perfect = db.Column(db.Boolean, default=False)  # 100% по тесту уже засчитаны в счетчик perfect_score
     test = db.relationship('Test')
 
+    __table_args__ = (
+        db.Index('ix_user_progress_user_test', 'user_id', 'test_id'),
+    )
+
 class ShopItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -196,6 +329,11 @@ class UserAchievement(db.Model):
     earned_at = db.Column(db.DateTime, default=datetime.utcnow)
     progress = db.Column(db.Integer, default=0)
 
+    __table_args__ = (
+        db.Index('ix_user_achievement_user', 'user_id'),
+        db.Index('uq_user_achievement', 'user_id', 'achievement_id', unique=True),
+    )
+
 class DailyTask(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -212,6 +350,12 @@ class UserDailyTask(db.Model):
     task_id = db.Column(db.Integer, db.ForeignKey('daily_task.id'), nullable=False)
     completed_at = db.Column(db.DateTime)
     progress = db.Column(db.Integer, default=0)
+    day = db.Column(db.Date)  # день, к которому относятся progress и completed_at
+
+    __table_args__ = (
+        db.Index('ix_user_daily_task_user', 'user_id'),
+        db.Index('uq_user_daily_task', 'user_id', 'task_id', unique=True),
+    )
 
 class UserStreak(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -219,6 +363,146 @@ class UserStreak(db.Model):
     current_streak = db.Column(db.Integer, default=0)
     longest_streak = db.Column(db.Integer, default=0)
     last_activity = db.Column(db.DateTime, default=datetime.utcnow)
+    # Карта активности: бит i — был ли пользователь активен за activity_day - i дней
+    activity_day = db.Column(db.Date)
+    activity_bits = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index('uq_user_streak_user', 'user_id', unique=True),
+    )
+
+class UserCounter(db.Model):
+    # Накопительные счетчики пользователя для достижений: test_completed, perfect_score, streak, purchase
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class JobRun(db.Model):
+    # Запуски периодических задач: одна строка на (задача, период) — вставить ее может только один процесс
+    name = db.Column(db.String(50), primary_key=True)
+    period = db.Column(db.String(20), primary_key=True)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    duration_ms = db.Column(db.Float)
+    rows = db.Column(db.Integer)
+
+class DailyStats(db.Model):
+    # Агрегаты за сутки, которые собирает фоновая задача stats
+    day = db.Column(db.Date, primary_key=True)
+    new_users = db.Column(db.Integer, default=0)
+    active_users = db.Column(db.Integer, default=0)
+    attempts = db.Column(db.Integer, default=0)
+    avg_score = db.Column(db.Float)
+    xp_gained = db.Column(db.Integer, default=0)
+
+class OutboxEvent(db.Model):
+    # Очередь побочных эффектов: пишется в одной транзакции с данными запроса, разбирается потоками
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    idempotency_key = db.Column(db.String(100), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processing, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    available_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbox_event_status_available', 'status', 'available_at'),
+    )
+
+class OutboxDelivery(db.Model):
+    # Обработчики, уже отработавшие для события: при повторной попытке они пропускаются
+    event_id = db.Column(db.Integer, db.ForeignKey('outbox_event.id'), primary_key=True)
+    handler = db.Column(db.String(50), primary_key=True)
+
+class XpEvent(db.Model):
+    # Каждое начисление опыта; User.xp уменьшается при повышении уровня и не годится как счет
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(50))  # test, daily_task, ...
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_xp_event_user_created', 'user_id', 'created_at'),
+    )
+
+class XpDaily(db.Model):
+    # Суммарный опыт пользователя за день — корзины для рейтингов за период
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    xp = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_xp_daily_day', 'day'),
+    )
+
+def record_xp_gain(user_id, amount, source=None):
+    # Событие и корзина дня пишутся в транзакции вызывающего кода
+    now = datetime.utcnow()
+    db.session.add(XpEvent(user_id=user_id, amount=amount, source=source, created_at=now))
+    statement = sqlite_insert(XpDaily.__table__).values(user_id=user_id, day=now.date(), xp=amount)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', 'day'],
+        set_={'xp': XpDaily.__table__.c.xp + statement.excluded.xp}
+    ))
+
+FRIENDSHIP_PENDING = 'pending'
+FRIENDSHIP_ACCEPTED = 'accepted'
+
+class Friendship(db.Model):
+    # Ребро социального графа: принятая дружба хранится в обе стороны,
+    # входящий запрос — одним ребром от отправителя к получателю
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    friend_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default=FRIENDSHIP_PENDING)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_friendship_user_status', 'user_id', 'status'),
+        db.Index('ix_friendship_friend_status', 'friend_id', 'status'),
+    )
+
+class UserTitle(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    title_id = db.Column(db.Integer, nullable=False)  # ключ словаря TITLES
+    acquired_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'title_id', name='uq_user_title'),
+        db.Index('ix_user_title_title', 'title_id'),
+    )
+
+class UserItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey('shop_item.id'), nullable=False)
+    acquired_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'item_id', name='uq_user_item'),
+        db.Index('ix_user_item_item', 'item_id'),
+    )
+
+def shop_prices():
+    # Отсортированные цены товаров, закэшированные до следующего изменения магазина
+    cache_key = fragment_cache.key('shop_prices', versions=['shop'])
+    cached = fragment_cache.backend.get(cache_key)
+    if cached is None:
+        cached = json.dumps(sorted(price for (price,) in db.session.query(ShopItem.price)))
+        fragment_cache.backend.set(cache_key, cached, ttl=FragmentCache.TTL)
+    return json.loads(cached)
+
+def item_owner_counts():
+    # Сколько пользователей владеет каждым товаром — один агрегирующий запрос по индексу
+    return dict(db.session.query(UserItem.item_id, db.func.count(UserItem.id)).group_by(UserItem.item_id).all())
+
+def title_owner_count(title_id):
+    return UserTitle.query.filter_by(title_id=title_id).count()
 
 # Константы
 TITLES = {
@@ -237,25 +521,537 @@ TITLES = {
 
 # Вспомогательные функции
 def get_current_user():
-    if 'user_id' in session:
-        return User.query.get(session['user_id'])
-    return None
+    # Пользователь загружается один раз за запрос: декораторы, view и шаблоны берут его из g
+    if 'user_id' not in session:
+        return None
+    if 'current_user' not in g:
+        g.current_user = db.session.get(User, session['user_id'])
+    return g.current_user
 
-@app.context_processor
 def inject_user():
-    current_user = get_current_user()
-    titles_data = []
-    if current_user:
-        titles = json.loads(current_user.titles)
-        titles_data = [{"id": tid, **TITLES.get(tid, {"name": f"Титул {tid}", "description": "Неизвестный титул"})} for tid in titles]
-    
+    # user_titles и shop_items передают только те view, которым они нужны
     return dict(
-        current_user=current_user,
-        user_titles=titles_data,
-        TITLES=TITLES,
-        shop_items=ShopItem.query.all()
+        current_user=get_current_user(),
+        TITLES=TITLES
     )
 
+# Счетчик SQL-запросов и бюджеты запросов для view
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context():
+        g.sql_seconds = g.get('sql_seconds', 0.0) + elapsed
+    elif has_app_context():
+        metrics.record_background_query(elapsed)
+
+def query_budget(limit):
+    # Максимум SQL-запросов на одну отрисовку view, не зависящий от количества строк
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+def check_query_budget(response):
+    view = current_app.view_functions.get(request.endpoint)
+    limit = getattr(view, 'query_budget', None)
+    count = g.get('query_count', 0)
+    if limit is not None and count > limit:
+        message = f"View {request.endpoint} issued {count} SQL queries, budget is {limit}"
+        if current_app.config.get('QUERY_BUDGET_STRICT', current_app.testing):
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+# Метрики запросов
+class RouteMetrics:
+    __slots__ = ('buckets', 'seconds', 'statuses', 'sql_queries', 'sql_seconds', 'template_seconds')
+
+    def __init__(self, bucket_count, status_count):
+        self.buckets = [0] * bucket_count
+        self.seconds = 0.0
+        self.statuses = [0] * status_count
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+class Metrics:
+    # Счетчики процесса для /admin/metrics в формате Prometheus. Места под маршруты выделяются
+    # в create_app по таблице маршрутов, так что запрос только увеличивает готовые числа под
+    # одним замком: гистограмма задержки, статус, число и время SQL, время шаблонов. У каждого
+    # процесса gunicorn свои счетчики; SQL вне запросов (очередь событий, планировщик) идет
+    # в маршрут BACKGROUND.
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+    STAGES = ('parse_test', 'render_figure', 'grade')
+    NOT_FOUND = 'not_found'
+    BACKGROUND = 'background'
+    PREFIX = 'math_site'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._stages = {stage: [0, 0.0] for stage in self.STAGES}
+        self.add_routes([self.NOT_FOUND, self.BACKGROUND])
+
+    def add_routes(self, endpoints):
+        with self._lock:
+            for endpoint in endpoints:
+                if endpoint not in self._routes:
+                    self._routes[endpoint] = RouteMetrics(len(self.LATENCY_BUCKETS) + 1, len(self.STATUS_CLASSES))
+
+    def record(self, endpoint, seconds, status, sql_queries, sql_seconds, template_seconds):
+        route = self._routes.get(endpoint) or self._routes[self.NOT_FOUND]
+        bucket = bisect_left(self.LATENCY_BUCKETS, seconds)
+        status_class = min(max(status // 100, 1), 5) - 1
+        with self._lock:
+            route.buckets[bucket] += 1
+            route.seconds += seconds
+            route.statuses[status_class] += 1
+            route.sql_queries += sql_queries
+            route.sql_seconds += sql_seconds
+            route.template_seconds += template_seconds
+
+    def record_background_query(self, seconds):
+        route = self._routes[self.BACKGROUND]
+        with self._lock:
+            route.sql_queries += 1
+            route.sql_seconds += seconds
+
+    def record_stage(self, stage, seconds):
+        counters = self._stages[stage]
+        with self._lock:
+            counters[0] += 1
+            counters[1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            routes = {endpoint: (list(r.buckets), r.seconds, list(r.statuses), r.sql_queries, r.sql_seconds,
+                                 r.template_seconds) for endpoint, r in self._routes.items()}
+            stages = {stage: tuple(counters) for stage, counters in self._stages.items()}
+        return routes, stages
+
+    def summary(self):
+        # Для админ-панели: маршруты по суммарному времени, средние на запрос в мс
+        routes, _ = self.snapshot()
+        rows = []
+        for endpoint, (buckets, seconds, _, sql_queries, sql_seconds, template_seconds) in routes.items():
+            count = sum(buckets)
+            if count:
+                rows.append({'route': endpoint, 'requests': count, 'total_s': seconds,
+                             'avg_ms': seconds / count * 1000, 'sql_queries': sql_queries / count,
+                             'sql_ms': sql_seconds / count * 1000, 'template_ms': template_seconds / count * 1000})
+        return sorted(rows, key=lambda row: -row['total_s'])
+
+    def render(self, gauges=()):
+        routes, stages = self.snapshot()
+        p = self.PREFIX
+        lines = [f'# HELP {p}_request_duration_seconds Request latency by route',
+                 f'# TYPE {p}_request_duration_seconds histogram']
+        for endpoint, (buckets, seconds, _, _, _, _) in routes.items():
+            count = sum(buckets)
+            if not count:
+                continue
+            cumulative = 0
+            for bound, value in zip(self.LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += value
+                lines.append(f'{p}_request_duration_seconds_bucket{{route="{endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'{p}_request_duration_seconds_sum{{route="{endpoint}"}} {seconds}')
+            lines.append(f'{p}_request_duration_seconds_count{{route="{endpoint}"}} {count}')
+        lines += [f'# HELP {p}_requests_total Responses by route and status class',
+                  f'# TYPE {p}_requests_total counter']
+        for endpoint, (_, _, statuses, _, _, _) in routes.items():
+            for status_class, value in zip(self.STATUS_CLASSES, statuses):
+                if value:
+                    lines.append(f'{p}_requests_total{{route="{endpoint}",status="{status_class}"}} {value}')
+        for name, index, help_text in (('sql_queries_total', 3, 'SQL queries by route'),
+                                       ('sql_seconds_total', 4, 'Time in SQL queries by route'),
+                                       ('template_seconds_total', 5, 'Time rendering templates by route')):
+            lines += [f'# HELP {p}_{name} {help_text}', f'# TYPE {p}_{name} counter']
+            for endpoint, values in routes.items():
+                if values[index]:
+                    lines.append(f'{p}_{name}{{route="{endpoint}"}} {values[index]}')
+        lines += [f'# HELP {p}_stage_seconds_total Time in request stages (parse_test includes render_figure)',
+                  f'# TYPE {p}_stage_seconds_total counter']
+        lines += [f'{p}_stage_seconds_total{{stage="{stage}"}} {seconds}' for stage, (_, seconds) in stages.items()]
+        lines += [f'# TYPE {p}_stage_calls_total counter']
+        lines += [f'{p}_stage_calls_total{{stage="{stage}"}} {count}' for stage, (count, _) in stages.items()]
+        for name, kind, value in gauges:
+            lines += [f'# TYPE {p}_{name} {kind}', f'{p}_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+metrics = app_local('metrics')
+
+def timed_stage(stage):
+    # Время этапа обработки (разбор теста, проверка ответов) для /admin/metrics
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if has_app_context():
+                    metrics.record_stage(stage, time.perf_counter() - started)
+        return decorated
+    return decorator
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def start_template_timer(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+def stop_template_timer(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None:
+        g.template_seconds = g.get('template_seconds', 0.0) + time.perf_counter() - started
+
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+def record_request(exc):
+    started = g.get('request_started')
+    if started is None:
+        return
+    metrics.record(request.endpoint, time.perf_counter() - started,
+                   500 if exc is not None else g.get('response_status', 500), g.get('query_count', 0),
+                   g.get('sql_seconds', 0.0), g.get('template_seconds', 0.0))
+
+# Профилирование запросов по требованию
+class StackTracer:
+    # sys.setprofile действует только на поток выбранного запроса. Время между событиями
+    # вызова и возврата приписывается текущему стеку, а время самого обработчика событий
+    # в отчет не попадает. Кадры называются module:function без строк. Встроенные функции и
+    # вызовы внутри одной сторонней библиотеки не получают своих кадров: их время считается
+    # временем кадра, из которого вошли в библиотеку. Все, что глубже MAX_DEPTH, складывается
+    # в один кадр [deeper]
+    MAX_DEPTH = 40
+    DEEPER = ';[deeper]'
+
+    def __init__(self, session_id, root, names):
+        self.session_id = session_id
+        self.names = names
+        self.keys = [root]
+        self.packages = [None]
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter()
+        key = self.keys[-1]
+        self.times[key] = self.times.get(key, 0.0) + now - self.last
+        if event == 'call':
+            name, package = self.names(frame)
+            if package is not None and package == self.packages[-1]:
+                self.keys.append(key)
+            elif len(self.keys) < self.MAX_DEPTH:
+                self.keys.append(key + ';' + name)
+            else:
+                self.keys.append(key if key.endswith(self.DEEPER) else key + self.DEEPER)
+            self.packages.append(package)
+        elif event == 'c_call':
+            self.keys.append(key)
+            self.packages.append(self.packages[-1])
+        elif len(self.keys) > 1:
+            # return, c_return, c_exception; возвраты из кадров, начатых до профилирования, ничего не снимают
+            self.keys.pop()
+            self.packages.pop()
+        self.last = time.perf_counter()
+
+class RequestProfiler:
+    # Включается из админ-панели на время: control.json в PROFILER_DIR задает долю запросов и,
+    # если нужно, маршрут. Каждый процесс перечитывает его не чаще раза в CONTROL_INTERVAL,
+    # поэтому включение доходит до всех процессов gunicorn. Выбранный запрос выполняется со
+    # StackTracer, и время по стекам копится в свернутом виде для flamegraph.pl и
+    # speedscope (значения — микросекунды). Каждый процесс пишет свой файл не реже раза в
+    # FLUSH_INTERVAL, скачивание их объединяет. Выключенный профилировщик стоит одного
+    # сравнения времени на запрос; невыбранные запросы сеанса не замедляются, а выбранный идет
+    # в 3-4 раза медленнее, поэтому на боевом трафике доля — единицы процентов. Асинхронные
+    # маршруты asgi.py делят поток цикла событий с другими корутинами и не профилируются.
+    CONTROL_INTERVAL = 1.0
+    FLUSH_INTERVAL = 5.0
+    MAX_STACKS = 20000
+    MAX_DURATION = 600
+
+    def __init__(self, directory):
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._control_mtime = None
+        self._flushed_at = 0.0
+        self._stacks = {}
+        self._stacks_id = None
+        self._names = {}
+        self.session = None
+        self.directory = directory
+
+    def begin(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.CONTROL_INTERVAL
+            self._reload()
+        session = self.session
+        if session is None:
+            return
+        if time.time() >= session['until']:
+            self._finish(session)
+            return
+        if session['route'] and request.endpoint != session['route']:
+            return
+        if random.random() >= session['rate']:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            return
+        g.profile_tracer = StackTracer(session['id'], f'route:{request.endpoint or Metrics.NOT_FOUND}',
+                                       self._frame_name)
+        sys.setprofile(g.profile_tracer)
+
+    def end(self, exc):
+        tracer = g.pop('profile_tracer', None)
+        if tracer is None:
+            return
+        sys.setprofile(None)
+        with self._lock:
+            if self._stacks_id != tracer.session_id:
+                return
+            for stack, seconds in tracer.times.items():
+                if stack not in self._stacks and len(self._stacks) >= self.MAX_STACKS:
+                    stack = stack.split(';', 1)[0] + ';[other]'
+                self._stacks[stack] = self._stacks.get(stack, 0.0) + seconds
+        if time.monotonic() - self._flushed_at >= self.FLUSH_INTERVAL:
+            self.flush(self._stacks_id)
+
+    def control_path(self):
+        return os.path.join(self.directory, 'control.json')
+
+    def control(self):
+        try:
+            with open(self.control_path(), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def start(self, rate, route, duration):
+        if not 0 < rate <= 1:
+            raise ValueError('Rate must be in (0, 1]')
+        if not 0 < duration <= self.MAX_DURATION:
+            raise ValueError(f'Duration must be between 1 and {self.MAX_DURATION} seconds')
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith('.folded'):
+                os.remove(os.path.join(self.directory, name))
+        return self._write_control({'id': uuid.uuid4().hex[:8], 'rate': rate, 'route': route or None,
+                                    'until': time.time() + duration})
+
+    def stop(self):
+        # Стеки остановленного сеанса остаются доступны для скачивания
+        control = self.control()
+        if control:
+            control['until'] = time.time()
+            self._write_control(control)
+
+    def _write_control(self, control):
+        tmp_path = f'{self.control_path()}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(control, f)
+        os.replace(tmp_path, self.control_path())
+        self._next_check = 0.0
+        return control
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.control_path()).st_mtime
+        except (OSError, TypeError):
+            mtime = None
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        control = self.control() if mtime is not None else None
+        if control and control.get('id') and control['until'] > time.time():
+            with self._lock:
+                if self._stacks_id != control['id']:
+                    self._stacks = {}
+                    self._stacks_id = control['id']
+            self.session = control
+        elif self.session is not None:
+            self._finish(self.session)
+
+    def _finish(self, session):
+        if self.session is session:
+            self.session = None
+        self.flush(session['id'])
+
+    def _frame_name(self, frame):
+        # (имя кадра, библиотека); у кода сайта и шаблонов библиотеки нет, их кадры не сливаются
+        code = frame.f_code
+        entry = self._names.get(code)
+        if entry is None:
+            module = frame.f_globals.get('__name__') or os.path.basename(code.co_filename)
+            package = module.partition('.')[0]
+            entry = self._names[code] = (f"{module}:{getattr(code, 'co_qualname', code.co_name)}",
+                                         None if package in (__name__, '<template>') else package)
+        return entry
+
+    def flush(self, session_id):
+        with self._lock:
+            if session_id is None or session_id != self._stacks_id or not self._stacks:
+                return
+            lines = [f'{stack} {round(seconds * 1e6)}\n' for stack, seconds in self._stacks.items()]
+            self._flushed_at = time.monotonic()
+        path = os.path.join(self.directory, f'{session_id}-{os.getpid()}.folded')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+
+    def collapsed(self, session_id):
+        # Стеки всех процессов за сеанс: одинаковые стеки складываются
+        self.flush(session_id)
+        stacks = {}
+        prefix = f'{session_id}-'
+        for name in sorted(os.listdir(self.directory)) if os.path.isdir(self.directory) else ():
+            if name.startswith(prefix) and name.endswith('.folded'):
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    for line in f:
+                        stack, _, value = line.rstrip('\n').rpartition(' ')
+                        stacks[stack] = stacks.get(stack, 0) + int(value)
+        return ''.join(f'{stack} {value}\n' for stack, value in sorted(stacks.items()) if value)
+
+profiler = app_local('profiler')
+
+# Сжатие ответов
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/xml', 'application/javascript',
+                      'application/json', 'application/xml', 'image/svg+xml'}
+
+class CompressedBodyCache:
+    # LRU сжатых тел, ограниченный суммарным размером. Ключ — ETag, кодировка и CRC32
+    # исходного тела: CRC дешевле сжатия на порядки и страхует от совпадения ETag у разных тел
+    def __init__(self, max_bytes):
+        self._lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+compressed_bodies = app_local('compressed_bodies')
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL'], mtime=0)
+
+def compress_response(response):
+    # Регистрируется до add_validators, поэтому выполняется после него и видит ETag
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+    elif accepted['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    etag, weak = response.get_etag()
+    if etag:
+        key = (etag, encoding, zlib.crc32(data))
+        body = compressed_bodies.get(key)
+        if body is None:
+            body = compress_body(data, encoding)
+            compressed_bodies.set(key, body)
+        # Сжатое представление побайтно отличается, поэтому ETag становится слабым
+        response.set_etag(etag, weak=True)
+    else:
+        body = compress_body(data, encoding)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Условные GET-запросы
+def user_state(user):
+    # Все, что base.html показывает о пользователе: входит в ETag персональных страниц
+    if user is None:
+        return None
+    return (user.id, user.username, user.level, user.xp, user.coins, user.is_admin, user.equipped_title)
+
+def build_id(manifest):
+    # Версия разметки: шаблоны и манифест ресурсов. Входит в ETag, чтобы после выкладки браузер
+    # не получил 304 для страницы со ссылками на удаленные /assets/
+    digest = hashlib.sha1()
+    for name in sorted(TEMPLATES):
+        digest.update(name.encode() + b'\0' + TEMPLATES[name].encode() + b'\0')
+    digest.update(json.dumps(manifest, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def not_modified(*parts, last_modified=None):
+    # ETag строится из версий данных и версии разметки до рендеринга; при совпадении с
+    # If-None-Match возвращается 304 и шаблон не рендерится. Страницы с ожидающими
+    # flash-сообщениями всегда рендерятся заново
+    if request.method != 'GET' or session.get('_flashes'):
+        return None
+    g.etag = hashlib.sha1(repr((current_app.extensions['build_id'],) + parts).encode()).hexdigest()
+    g.last_modified = last_modified
+    if request.if_none_match.contains_weak(g.etag):
+        return add_validators(current_app.response_class(status=304))
+    return None
+
+def add_validators(response):
+    etag = g.get('etag')
+    if etag and response.status_code in (200, 304):
+        # ETag строится из версий данных, а не из байтов ответа, поэтому он слабый — одинаковый
+        # у 304, у несжатого и у сжатого 200
+        response.set_etag(etag, weak=True)
+        if g.get('last_modified'):
+            response.last_modified = g.last_modified
+        # Страницы персональные: кэшировать может только браузер и только с перепроверкой
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -274,6 +1070,1282 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Кэш фрагментов HTML
+class DictCacheBackend:
+    # Кэш в памяти процесса: фрагменты в LRU, счетчики версий отдельно, чтобы не вытеснялись.
+    # Годится только для одного процесса: версии, увеличенные в другом, здесь не видны
+    def __init__(self, max_entries=1024):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._values = OrderedDict()
+        self._counters = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._values[key] = (value, expires_at)
+            self._values.move_to_end(key)
+            while len(self._values) > self._max_entries:
+                self._values.popitem(last=False)
+
+    def get_counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+class RedisCacheBackend:
+    # Общий кэш для нескольких процессов: любой сервер с протоколом Redis (Redis, KeyDB, ...)
+    def __init__(self, url):
+        import redis
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=ttl)
+
+    def get_counter(self, key):
+        return int(self._client.get(key) or 0)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+def is_shared_cache_url(url):
+    return bool(url) and url.startswith(('redis://', 'rediss://', 'unix://'))
+
+def make_cache_backend(url):
+    if is_shared_cache_url(url):
+        return RedisCacheBackend(url)
+    if url:
+        raise ValueError(f'Unsupported fragment cache URL: {url}')
+    return DictCacheBackend()
+
+class FragmentCache:
+    # Ключ фрагмента включает счетчики версий данных; при изменении данных счетчик
+    # увеличивается (bump), и старые фрагменты просто перестают запрашиваться.
+    TTL = 24 * 3600
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def version(self, name):
+        return self.backend.get_counter(f'version:{name}')
+
+    def bump(self, *names):
+        for name in names:
+            self.backend.incr(f'version:{name}')
+
+    def key(self, name, versions=(), key=()):
+        parts = [name] + [f'{v}={self.version(v)}' for v in versions] + [str(k) for k in key]
+        return 'fragment:' + ':'.join(parts)
+
+    def render(self, name, versions=(), key=(), caller=None):
+        cache_key = self.key(name, versions, key)
+        html = self.backend.get(cache_key)
+        if html is None:
+            html = str(caller())
+            self.backend.set(cache_key, html, ttl=self.TTL)
+        return Markup(html)
+
+fragment_cache = app_local('fragment_cache')
+
+# Рейтинги в памяти
+class RankIndex:
+    # Упорядоченный набор ключей, разбитый на блоки (как sortedcontainers.SortedList).
+    # Длины блоков хранятся в дереве Фенвика, поэтому позиция ключа и поиск
+    # элемента по позиции стоят O(log n), а вставка сдвигает только один блок.
+    def __init__(self, keys=(), load=1000):
+        self._load = load
+        keys = sorted(keys)
+        self._lists = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._maxes = [block[-1] for block in self._lists]
+        self._len = len(keys)
+        self._rebuild_tree()
+
+    def __len__(self):
+        return self._len
+
+    def _rebuild_tree(self):
+        tree = [0] + [len(block) for block in self._lists]
+        for i in range(1, len(tree)):
+            j = i + (i & -i)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, pos, delta):
+        i = pos + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, pos):
+        # Количество ключей в блоках [0, pos)
+        total = 0
+        while pos > 0:
+            total += self._tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _locate(self, index):
+        # Блок и смещение для позиции index
+        pos = 0
+        step = 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= index:
+                pos = nxt
+                index -= self._tree[nxt]
+            step >>= 1
+        return pos, index
+
+    def add(self, key):
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._rebuild_tree()
+            return
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            pos -= 1
+            self._lists[pos].append(key)
+            self._maxes[pos] = key
+        else:
+            insort(self._lists[pos], key)
+        self._len += 1
+        block = self._lists[pos]
+        if len(block) > 2 * self._load:
+            self._lists.insert(pos + 1, block[self._load:])
+            del block[self._load:]
+            self._maxes[pos] = block[-1]
+            self._maxes.insert(pos + 1, self._lists[pos + 1][-1])
+            self._rebuild_tree()
+        else:
+            self._tree_add(pos, 1)
+
+    def remove(self, key):
+        pos = bisect_left(self._maxes, key)
+        block = self._lists[pos] if pos < len(self._lists) else []
+        i = bisect_left(block, key)
+        if i == len(block) or block[i] != key:
+            raise KeyError(key)
+        del block[i]
+        self._len -= 1
+        if block:
+            self._maxes[pos] = block[-1]
+            self._tree_add(pos, -1)
+        else:
+            del self._lists[pos]
+            del self._maxes[pos]
+            self._rebuild_tree()
+
+    def index(self, key):
+        # Сколько ключей строго меньше key
+        pos = bisect_left(self._maxes, key)
+        if pos == len(self._maxes):
+            return self._len
+        return self._prefix(pos) + bisect_left(self._lists[pos], key)
+
+    def islice(self, start, stop):
+        start = max(start, 0)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return
+        pos, offset = self._locate(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = self._lists[pos][offset:offset + remaining]
+            yield from block
+            remaining -= len(block)
+            pos += 1
+            offset = 0
+
+class Leaderboard:
+    # Рейтинги по опыту, уровню и монетам. Загружаются из базы один раз на процесс
+    # и обновляются на месте при каждой выдаче наград (add_xp/add_coins).
+    BOARDS = {
+        'xp': lambda u: (-u['xp'], u['id']),
+        'level': lambda u: (-u['level'], -u['xp'], u['id']),
+        'coins': lambda u: (-u['coins'], u['id']),
+    }
+    TOP_SIZE = 10
+
+    def __init__(self, max_age=None):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._loaded_at = 0.0
+        self.max_age = max_age
+        self._users = {}
+        self._keys = {board: {} for board in self.BOARDS}
+        self._indexes = {board: RankIndex() for board in self.BOARDS}
+
+    def load(self):
+        rows = db.session.query(User.id, User.username, User.level, User.xp, User.coins).all()
+        users = {row.id: {'id': row.id, 'username': row.username, 'level': row.level or 1,
+                          'xp': row.xp or 0, 'coins': row.coins or 0} for row in rows}
+        keys = {board: {uid: key_fn(u) for uid, u in users.items()} for board, key_fn in self.BOARDS.items()}
+        with self._lock:
+            self._users = users
+            self._keys = keys
+            self._indexes = {board: RankIndex(keys[board].values()) for board in self.BOARDS}
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return not self._loaded or (self.max_age is not None and time.monotonic() - self._loaded_at > self.max_age)
+
+    def ensure_loaded(self):
+        if self.is_stale():
+            with self._lock:
+                if self.is_stale():
+                    reload = self._loaded
+                    self.load()
+                    if reload:
+                        fragment_cache.bump('leaderboard')
+                        live_rankings.mark_changed()
+
+    def update_user(self, snapshot):
+        # snapshot — User.ranking_snapshot() на момент коммита
+        if not self._loaded:
+            # Без загруженных рейтингов нельзя понять, задет ли топ, — сбрасываем кэш
+            fragment_cache.bump('leaderboard')
+            return
+        top_changed = False
+        with self._lock:
+            for board, key_fn in self.BOARDS.items():
+                index = self._indexes[board]
+                old_key = self._keys[board].get(snapshot['id'])
+                new_key = key_fn(snapshot)
+                if old_key == new_key:
+                    continue
+                if old_key is not None:
+                    top_changed = top_changed or index.index(old_key) < self.TOP_SIZE
+                    index.remove(old_key)
+                index.add(new_key)
+                top_changed = top_changed or index.index(new_key) < self.TOP_SIZE
+                self._keys[board][snapshot['id']] = new_key
+            self._users[snapshot['id']] = snapshot
+        if top_changed:
+            fragment_cache.bump('leaderboard')
+            live_rankings.mark_changed()
+
+    def remove_user(self, user_id):
+        top_changed = False
+        with self._lock:
+            for board in self.BOARDS:
+                key = self._keys[board].pop(user_id, None)
+                if key is not None:
+                    top_changed = top_changed or self._indexes[board].index(key) < self.TOP_SIZE
+                    self._indexes[board].remove(key)
+            self._users.pop(user_id, None)
+        if top_changed or not self._loaded:
+            fragment_cache.bump('leaderboard')
+            live_rankings.mark_changed()
+
+    def top(self, board, limit=TOP_SIZE):
+        self.ensure_loaded()
+        with self._lock:
+            return [self._users[key[-1]] for key in self._indexes[board].islice(0, limit)]
+
+    def rank(self, board, user_id):
+        # Место пользователя, начиная с 1, или None
+        self.ensure_loaded()
+        with self._lock:
+            key = self._keys[board].get(user_id)
+            return None if key is None else self._indexes[board].index(key) + 1
+
+    def around(self, board, user_id, radius=2):
+        # Место пользователя и соседи ±radius: список пар (место, пользователь)
+        self.ensure_loaded()
+        with self._lock:
+            key = self._keys[board].get(user_id)
+            if key is None:
+                return None, []
+            position = self._indexes[board].index(key)
+            start = max(0, position - radius)
+            window = self._indexes[board].islice(start, position + radius + 1)
+            return position + 1, [(start + i + 1, self._users[k[-1]]) for i, k in enumerate(window)]
+
+    def total(self, board):
+        self.ensure_loaded()
+        return len(self._indexes[board])
+
+    def get_user(self, user_id):
+        self.ensure_loaded()
+        return self._users.get(user_id)
+
+class WindowedLeaderboard:
+    # Рейтинги за день, неделю (7 дней) и месяц (30 дней) по начисленному опыту.
+    # Хранятся дневные корзины {день: {user_id: xp}} и текущие суммы по каждому окну;
+    # при смене дня из сумм вычитается только выпавшая корзина — O(активных пользователей).
+    WINDOWS = {'day': 1, 'week': 7, 'month': 30}
+
+    def __init__(self, max_age=None):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._loaded_at = 0.0
+        self.max_age = max_age
+        self._today = None
+        self._buckets = {}
+        self._totals = {window: {} for window in self.WINDOWS}
+
+    def load(self, today=None):
+        today = today or datetime.utcnow().date()
+        history = max(self.WINDOWS.values())
+        rows = XpDaily.query.filter(XpDaily.day > today - timedelta(days=history)).all()
+        buckets = {}
+        for row in rows:
+            buckets.setdefault(row.day, {})[row.user_id] = row.xp
+        totals = {window: {} for window in self.WINDOWS}
+        for day, bucket in buckets.items():
+            age = (today - day).days
+            for window, days in self.WINDOWS.items():
+                if age < days:
+                    window_totals = totals[window]
+                    for user_id, xp in bucket.items():
+                        window_totals[user_id] = window_totals.get(user_id, 0) + xp
+        with self._lock:
+            self._today = today
+            self._buckets = buckets
+            self._totals = totals
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return not self._loaded or (self.max_age is not None and time.monotonic() - self._loaded_at > self.max_age)
+
+    def ensure_loaded(self):
+        if self.is_stale():
+            with self._lock:
+                if self.is_stale():
+                    reload = self._loaded
+                    self.load()
+                    if reload:
+                        fragment_cache.bump('leaderboard_period')
+                        live_rankings.mark_changed()
+
+    def rotate(self, today=None):
+        today = today or datetime.utcnow().date()
+        with self._lock:
+            if not self._loaded:
+                return 0
+            touched = 0
+            while self._today < today:
+                self._today += timedelta(days=1)
+                for window, days in self.WINDOWS.items():
+                    expired = self._buckets.get(self._today - timedelta(days=days), {})
+                    window_totals = self._totals[window]
+                    for user_id, xp in expired.items():
+                        left = window_totals.get(user_id, 0) - xp
+                        if left > 0:
+                            window_totals[user_id] = left
+                        else:
+                            window_totals.pop(user_id, None)
+                        touched += 1
+                history = max(self.WINDOWS.values())
+                self._buckets.pop(self._today - timedelta(days=history), None)
+            return touched
+
+    def add(self, user_id, amount, day=None):
+        if not self._loaded:
+            return
+        day = day or datetime.utcnow().date()
+        with self._lock:
+            self.rotate(day)
+            bucket = self._buckets.setdefault(day, {})
+            bucket[user_id] = bucket.get(user_id, 0) + amount
+            for window_totals in self._totals.values():
+                window_totals[user_id] = window_totals.get(user_id, 0) + amount
+        live_rankings.mark_changed()
+
+    def top(self, window, limit=10):
+        self.ensure_loaded()
+        self.rotate()
+        with self._lock:
+            best = heapq.nlargest(limit, self._totals[window].items(), key=lambda item: (item[1], -item[0]))
+        result = []
+        for user_id, xp in best:
+            user = leaderboards.get_user(user_id)
+            if user:
+                result.append({**user, 'window_xp': xp})
+        return result
+
+class FriendsLeaderboardCache:
+    # Рейтинг "я и мои друзья" по уровню и опыту, закэшированный на пользователя.
+    # В кэше только упорядоченные id; данные подставляются из рейтингов в памяти.
+    # Обратный индекс участник -> владельцы списков позволяет сбросить нужные
+    # записи без запросов к базе; для пользователей с огромным числом друзей
+    # сбрасывается не больше FANOUT_LIMIT записей, остальные истекают по TTL.
+    MAX_ENTRIES = 10000
+    TTL = 300
+    FANOUT_LIMIT = 200
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._owners = {}
+
+    def get(self, user_id, limit=50):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[0] < self.TTL:
+                self._entries.move_to_end(user_id)
+                ranked_ids = entry[1]
+            else:
+                ranked_ids = None
+        if ranked_ids is None:
+            ranked_ids = self._build(user_id, limit)
+            with self._lock:
+                self._store(user_id, now, ranked_ids)
+        return [leaderboards.get_user(uid) for uid in ranked_ids if leaderboards.get_user(uid)]
+
+    def _build(self, user_id, limit):
+        friend_ids = [fid for (fid,) in db.session.query(Friendship.friend_id).filter_by(
+            user_id=user_id, status=FRIENDSHIP_ACCEPTED)]
+        members = [leaderboards.get_user(uid) for uid in friend_ids + [user_id]]
+        members = [m for m in members if m]
+        members.sort(key=lambda m: (-m['level'], -m['xp'], m['id']))
+        return [m['id'] for m in members[:limit]]
+
+    def _store(self, user_id, built_at, ranked_ids):
+        self._drop(user_id)
+        self._entries[user_id] = (built_at, ranked_ids)
+        for member_id in ranked_ids:
+            self._owners.setdefault(member_id, set()).add(user_id)
+        while len(self._entries) > self.MAX_ENTRIES:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry:
+            for member_id in entry[1]:
+                owners = self._owners.get(member_id)
+                if owners:
+                    owners.discard(user_id)
+                    if not owners:
+                        del self._owners[member_id]
+
+    def invalidate(self, user_id):
+        # Пользователь получил опыт: сбрасываем его список и списки, где он участвует
+        with self._lock:
+            self._drop(user_id)
+            owners = list(self._owners.get(user_id, ()))[:self.FANOUT_LIMIT]
+            for owner_id in owners:
+                self._drop(owner_id)
+
+leaderboards = app_local('leaderboards')
+windowed_leaderboards = app_local('windowed_leaderboards')
+friends_leaderboards = app_local('friends_leaderboards')
+MAX_RANK_RADIUS = 10
+
+# Живые рейтинги (SSE)
+class LiveRankings:
+    # Рейтинги меняют только отметку (mark_changed), а поток публикации не чаще раза в
+    # MIN_INTERVAL считает топы один раз на процесс, сравнивает с прошлой публикацией и
+    # сериализует изменения (diff) один раз для всех подписчиков. Подписчик помнит номер
+    # версии: отставшему на одну версию уходит diff, отставшему сильнее (медленный клиент
+    # не успел забрать прошлые) — один снимок вместо накопившихся устаревших diff.
+    # Поток запускается при первом подписчике; без подписчиков отметка ничего не стоит.
+    MIN_INTERVAL = 0.5
+    ME_INTERVAL = 5.0  # так часто подписчик перепроверяет свое место
+    KEEPALIVE = 15.0
+    RETRY_MS = 5000
+    HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    def __init__(self, leaderboards, windowed_leaderboards):
+        # Рейтинги своего приложения: поток публикации и подписчики asgi.py читают их вне его контекста
+        self.leaderboards = leaderboards
+        self.windowed_leaderboards = windowed_leaderboards
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._published = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._dirty = True
+        self._epoch = None
+        self._version = 0
+        self._boards = {}
+        self._diff = None
+        self._snapshot = None
+        self._futures = {}
+        self.subscribers = 0
+
+    def mark_changed(self):
+        with self._lock:
+            self._dirty = True
+            if self._thread is not None:
+                self._changed.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        app = current_app._get_current_object()
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            # Номер версии имеет смысл только в этом процессе: после переподключения к другому
+            # процессу Last-Event-ID с чужой эпохой дает снимок
+            self._epoch = uuid.uuid4().hex[:8]
+            self.publish()
+            self._thread = threading.Thread(target=self.loop, args=(app,), name='live-rankings', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.mark_changed()
+
+    def loop(self, app):
+        while not self._stop.is_set():
+            with self._lock:
+                if not self._dirty:
+                    # При RANKINGS_MAX_AGE рейтинги перечитываются и без отметок: изменения других процессов
+                    self._changed.wait(self.leaderboards.max_age)
+                if not (self._dirty or self.leaderboards.is_stale() or self.windowed_leaderboards.is_stale()):
+                    continue
+                self._dirty = False
+            try:
+                with app.app_context():
+                    self.publish()
+            except Exception:
+                logger.exception('Live rankings publisher error')
+            self._stop.wait(self.MIN_INTERVAL)
+
+    def publish(self):
+        boards = {board: self.leaderboards.top(board) for board in Leaderboard.BOARDS}
+        for window in WindowedLeaderboard.WINDOWS:
+            boards[window] = self.windowed_leaderboards.top(window)
+        with self._lock:
+            changes = {}
+            for board, entries in boards.items():
+                old = self._boards.get(board, [])
+                changed = [[rank, entry] for rank, entry in enumerate(entries, 1)
+                           if rank > len(old) or old[rank - 1] != entry]
+                if changed or len(old) != len(entries):
+                    changes[board] = {'size': len(entries), 'changes': changed}
+            if not changes:
+                return False
+            self._version += 1
+            self._boards = boards
+            self._diff = self.sse_event('diff', {'boards': changes})
+            self._snapshot = None
+            futures = list(self._futures.values())
+            self._futures.clear()
+            self._published.notify_all()
+        for future in futures:
+            try:
+                future.get_loop().call_soon_threadsafe(self._resolve, future)
+            except RuntimeError:
+                pass  # цикл событий уже закрыт
+        return True
+
+    @staticmethod
+    def _resolve(future):
+        if not future.done():
+            future.set_result(None)
+
+    def sse_event(self, name, data, event_id=True):
+        lines = f'id: {self._epoch}-{self._version}\n' if event_id else ''
+        return f'{lines}event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'.encode()
+
+    def parse_event_id(self, value):
+        epoch, _, version = (value or '').partition('-')
+        if epoch != self._epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def message_since(self, version):
+        # (новая версия, сообщение или None) для подписчика на версии version
+        with self._lock:
+            if version == self._version:
+                return version, None
+            if version == self._version - 1 and self._diff is not None:
+                return self._version, self._diff
+            if self._snapshot is None:
+                self._snapshot = self.sse_event('snapshot', {'boards': self._boards})
+            return self._version, self._snapshot
+
+    def me(self, user_id):
+        # Место пользователя по каждому рейтингу; None, пока рейтинги перечитываются потоком публикации
+        if self.leaderboards.is_stale():
+            return None
+        user = self.leaderboards.get_user(user_id)
+        if user is None:
+            return None
+        return {'level': user['level'], 'xp': user['xp'], 'coins': user['coins'],
+                'ranks': {board: self.leaderboards.rank(board, user_id) for board in Leaderboard.BOARDS},
+                'total': self.leaderboards.total('xp')}
+
+    def stream(self, user_id, last_event_id, limit=None):
+        # None — подписчиков уже limit
+        with self._lock:
+            if limit is not None and self.subscribers >= limit:
+                return None
+            self.subscribers += 1
+        return LiveRankingsStream(self, user_id, self.parse_event_id(last_event_id))
+
+    def release(self):
+        with self._lock:
+            self.subscribers -= 1
+
+    def wait(self, version, timeout):
+        with self._lock:
+            if self._version == version:
+                self._published.wait(timeout)
+
+    async def wait_async(self, version, timeout):
+        # Одно будущее на цикл событий: публикация будит весь цикл одним вызовом
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._version != version:
+                return
+            future = self._futures.get(loop)
+            if future is None:
+                future = self._futures[loop] = loop.create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+class LiveRankingsStream:
+    # Состояние одного подписчика: версия рейтингов и последнее отправленное место
+    def __init__(self, hub, user_id, version):
+        self.hub = hub
+        self.user_id = user_id
+        self.version = version
+        self.me = None
+        self.sent_at = None
+
+    def next_chunk(self):
+        parts = [f'retry: {self.hub.RETRY_MS}\n\n'.encode()] if self.sent_at is None else []
+        self.version, message = self.hub.message_since(self.version)
+        if message:
+            parts.append(message)
+        if self.user_id is not None:
+            me = self.hub.me(self.user_id)
+            if me is not None and me != self.me:
+                self.me = me
+                parts.append(self.hub.sse_event('me', me, event_id=False))
+        now = time.monotonic()
+        if not parts and now - self.sent_at >= self.hub.KEEPALIVE:
+            parts.append(b': keep-alive\n\n')
+        if parts:
+            self.sent_at = now
+        return b''.join(parts)
+
+    def close(self):
+        self.hub.release()
+
+live_rankings = app_local('live_rankings')
+
+# Доменные события
+class EventBus:
+    # Синхронная шина: обработчики вызываются в порядке подписки в транзакции издателя
+    def __init__(self):
+        self._handlers = {}
+
+    def subscribe(self, event_type, handler=None):
+        if handler is None:
+            return lambda f: self.subscribe(event_type, f)
+        self._handlers.setdefault(event_type, []).append(handler)
+        return handler
+
+    def publish(self, event_type, **payload):
+        for handler in self._handlers.get(event_type, ()):
+            handler(**payload)
+
+events = EventBus()
+
+# Достижения
+ACHIEVEMENT_CATEGORIES = ('test_completed', 'perfect_score', 'streak', 'other')
+
+class AchievementEngine:
+    # Индекс condition_type -> отсортированные пороги. Событие продвигает счетчик
+    # пользователя, и выдаются только достижения с порогом в (старое, новое] —
+    # стоимость события O(log A + подходящие достижения).
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+
+    def load(self):
+        index = {}
+        for achievement in Achievement.query.filter(Achievement.condition_type.isnot(None),
+                                                    Achievement.condition_value.isnot(None)):
+            index.setdefault(achievement.condition_type, []).append(
+                (achievement.condition_value, achievement.id, achievement.name,
+                 achievement.xp_reward or 0, achievement.coin_reward or 0))
+        for thresholds in index.values():
+            thresholds.sort()
+        with self._lock:
+            self._index = index
+
+    def invalidate(self):
+        # После изменения порогов: индекс перечитается при следующем событии
+        self._index = None
+
+    def thresholds(self, condition_type):
+        if self._index is None:
+            self.load()
+        return self._index.get(condition_type, [])
+
+    def advance(self, user, counter, amount=1, value=None):
+        # amount — приращение; value — новое абсолютное значение (для серий берется максимум).
+        # Не коммитит. Счетчик меняется одной вставкой с ON CONFLICT, и параллельные события
+        # одного пользователя не теряют приращений; повторная выдача исключена OR IGNORE
+        table = UserCounter.__table__
+        statement = sqlite_insert(table).values(user_id=user.id, name=counter,
+                                                value=amount if value is None else value)
+        if value is None:
+            statement = statement.on_conflict_do_update(
+                index_elements=['user_id', 'name'], set_={'value': table.c.value + statement.excluded.value})
+        else:
+            old = db.session.query(UserCounter.value).filter_by(user_id=user.id, name=counter).scalar() or 0
+            statement = statement.on_conflict_do_update(
+                index_elements=['user_id', 'name'], set_={'value': statement.excluded.value},
+                where=statement.excluded.value > table.c.value)
+        new = db.session.execute(statement.returning(table.c.value)).scalar()
+        if new is None:
+            return []
+        if value is None:
+            old = new - amount
+        if new <= old:
+            return []
+        thresholds = self.thresholds(counter)
+        start = bisect_left(thresholds, (old + 1,))
+        stop = bisect_left(thresholds, (new + 1,))
+        awarded = []
+        for threshold, achievement_id, name, xp_reward, coin_reward in thresholds[start:stop]:
+            result = db.session.execute(
+                db.insert(UserAchievement.__table__).prefix_with('OR IGNORE'),
+                {'user_id': user.id, 'achievement_id': achievement_id,
+                 'earned_at': datetime.utcnow(), 'progress': threshold}
+            )
+            if result.rowcount == 1:
+                awarded.append((name, xp_reward, coin_reward))
+        for name, xp_reward, coin_reward in awarded:
+            if has_request_context():
+                flash(f'Новое достижение: {name}!', 'success')
+            if xp_reward:
+                user.add_xp(xp_reward, source='achievement')
+            if coin_reward:
+                user.add_coins(coin_reward)
+        return awarded
+
+    def counters(self, user_id):
+        return dict(db.session.query(UserCounter.name, UserCounter.value).filter_by(user_id=user_id).all())
+
+achievement_engine = app_local('achievement_engine')
+
+@events.subscribe('test_completed')
+def count_test_completed(user, test, score, first_attempt, previous_score=None):
+    if first_attempt:
+        achievement_engine.advance(user, 'test_completed')
+    if score < 100:
+        return
+    # Тест засчитывается в perfect_score один раз, даже если результат падал и снова стал 100%
+    table = UserProgress.__table__
+    marked = db.session.execute(db.update(table).where(
+        table.c.user_id == user.id, table.c.test_id == test.id,
+        db.or_(table.c.perfect.is_(None), table.c.perfect.is_(False))).values(perfect=True)).rowcount
+    if marked:
+        achievement_engine.advance(user, 'perfect_score')
+
+@events.subscribe('streak_updated')
+def count_streak(user, streak):
+    achievement_engine.advance(user, 'streak', value=streak)
+
+@events.subscribe('purchase')
+def count_purchase(user, item):
+    achievement_engine.advance(user, 'purchase')
+
+# Серии активности
+class StreakEngine:
+    # Серия считается по карте активных дней на строке user_streak: отметка дня — сдвиг
+    # и OR, без обращения к истории попыток. Окно в 62 дня помещается в INTEGER SQLite;
+    # длина текущей серии хранится отдельно и может быть длиннее окна.
+    WINDOW = 62
+    MASK = (1 << WINDOW) - 1
+
+    @staticmethod
+    def run_length(bits):
+        # Число подряд идущих единиц с младшего бита
+        return (bits ^ (bits + 1)).bit_length() - 1
+
+    def record(self, user, day=None):
+        day = day or datetime.utcnow().date()
+        streak = user.streak
+        if streak is None:
+            # Строку может одновременно создавать другой поток очереди событий
+            db.session.execute(
+                db.insert(UserStreak.__table__).prefix_with('OR IGNORE'),
+                {'user_id': user.id, 'current_streak': 0, 'longest_streak': 0, 'activity_bits': 0}
+            )
+            streak = UserStreak.query.filter_by(user_id=user.id).one()
+        bits = streak.activity_bits or 0
+        if streak.activity_day == day:
+            return streak.current_streak
+        gap = (day - streak.activity_day).days if streak.activity_day else None
+        if gap is not None and gap < 0:
+            # Запоздавшее событие за прошлый день только отмечается в карте
+            if -gap < self.WINDOW:
+                streak.activity_bits = bits | (1 << -gap)
+            return streak.current_streak
+        if gap is None or gap >= self.WINDOW:
+            streak.activity_bits = 1
+        else:
+            streak.activity_bits = ((bits << gap) | 1) & self.MASK
+        streak.current_streak = (streak.current_streak or 0) + 1 if gap == 1 else 1
+        streak.longest_streak = max(streak.longest_streak or 0, streak.current_streak)
+        streak.activity_day = day
+        streak.last_activity = datetime.utcnow()
+        events.publish('streak_updated', user=user, streak=streak.current_streak)
+        return streak.current_streak
+
+    def current(self, streak, today=None):
+        today = today or datetime.utcnow().date()
+        if streak is None or streak.activity_day is None or (today - streak.activity_day).days > 1:
+            return 0
+        return streak.current_streak or 0
+
+    def calendar(self, streak, days=28, today=None):
+        # Активность за последние days дней, от старых к новым
+        today = today or datetime.utcnow().date()
+        if streak is None or streak.activity_day is None:
+            return [False] * days
+        offset = (today - streak.activity_day).days
+        bits = streak.activity_bits or 0
+        return [0 <= i - offset < self.WINDOW and bool(bits >> (i - offset) & 1)
+                for i in range(days - 1, -1, -1)]
+
+    def decay(self, today):
+        # Ночной проход одним UPDATE: серии без активности вчера и сегодня обнуляются
+        return db.session.execute(db.text(
+            "UPDATE user_streak SET current_streak = 0 "
+            "WHERE current_streak > 0 AND (activity_day IS NULL OR activity_day < :yesterday)"),
+            {'yesterday': (today - timedelta(days=1)).isoformat()}).rowcount
+
+    def rebuild(self, today=None, only_missing=True):
+        # Пересчет карт по истории попыток: один запрос дней активности за окно и пакетная запись
+        today = today or datetime.utcnow().date()
+        since = datetime.combine(today - timedelta(days=self.WINDOW - 1), datetime.min.time())
+        days_by_user = {}
+        for user_id, day in db.session.execute(db.text(
+                "SELECT DISTINCT user_id, date(completed_at) FROM user_progress "
+                "WHERE completed_at >= :since AND user_id IS NOT NULL"), {'since': since}):
+            days_by_user.setdefault(user_id, []).append(datetime.strptime(day, '%Y-%m-%d').date())
+        existing = {row.user_id: row for row in UserStreak.query}
+        inserts, updates = [], []
+        for user_id, days in days_by_user.items():
+            row = existing.get(user_id)
+            if only_missing and row is not None and row.activity_day is not None:
+                continue
+            last_day = max(days)
+            bits = 0
+            for day in days:
+                bits |= 1 << (last_day - day).days
+            current = self.run_length(bits) if (today - last_day).days <= 1 else 0
+            longest, run = 0, bits
+            while run:
+                run >>= (run & -run).bit_length() - 1
+                length = self.run_length(run)
+                longest = max(longest, length)
+                run >>= length
+            values = {'user_id': user_id, 'activity_day': last_day, 'activity_bits': bits,
+                      'current_streak': current,
+                      'longest_streak': max(longest, row.longest_streak or 0) if row else longest,
+                      'last_activity': datetime.combine(last_day, datetime.min.time())}
+            (updates if row else inserts).append(values)
+        if inserts:
+            db.session.execute(db.insert(UserStreak.__table__), inserts)
+        if updates:
+            table = UserStreak.__table__
+            db.session.execute(
+                db.update(table).where(table.c.user_id == db.bindparam('b_user_id')).values(
+                    activity_day=db.bindparam('activity_day'), activity_bits=db.bindparam('activity_bits'),
+                    current_streak=db.bindparam('current_streak'), longest_streak=db.bindparam('longest_streak'),
+                    last_activity=db.bindparam('last_activity')),
+                [{**values, 'b_user_id': values['user_id']} for values in updates])
+        db.session.commit()
+        return len(inserts) + len(updates)
+
+streak_engine = StreakEngine()
+
+@events.subscribe('test_completed')
+def mark_streak_activity(user, test, score, first_attempt, previous_score=None):
+    streak_engine.record(user)
+
+# Ежедневные задания
+class DailyTaskCounters:
+    # Прогресс заданий хранится в user_daily_task вместе с днем, к которому он относится,
+    # и увеличивается событиями. Строки прошлых дней сбрасывает задача планировщика
+    # daily_reset одним UPDATE; до сброса они не считаются прогрессом текущего дня
+    def rollover(self, today=None):
+        # Условие по дню делает сброс безопасным при повторе и параллельных событиях:
+        # прогресс, уже набранный сегодня, он не затрагивает
+        today = (today or datetime.utcnow().date()).isoformat()
+        return db.session.execute(db.text(
+            "UPDATE user_daily_task SET progress = 0, completed_at = NULL, day = :today "
+            "WHERE (day IS NULL OR day < :today) AND (progress != 0 OR completed_at IS NOT NULL)"),
+            {'today': today}).rowcount
+
+    def increment(self, user, task_type, amount=1):
+        # Строка прошлого дня начинается заново, даже если планировщик еще не сбросил ее
+        result = db.session.execute(db.text(
+            "INSERT INTO user_daily_task (user_id, task_id, progress, day) "
+            "SELECT :user_id, id, :amount, :today FROM daily_task WHERE active AND task_type = :task_type "
+            "ON CONFLICT (user_id, task_id) DO UPDATE SET "
+            "progress = CASE WHEN day = excluded.day THEN progress + excluded.progress ELSE excluded.progress END, "
+            "completed_at = CASE WHEN day = excluded.day THEN completed_at END, day = excluded.day"),
+            {'user_id': user.id, 'amount': amount, 'task_type': task_type,
+             'today': datetime.utcnow().date().isoformat()})
+        if not result.rowcount:
+            return
+        completed = db.session.query(UserDailyTask, DailyTask).join(DailyTask).filter(
+            UserDailyTask.user_id == user.id, UserDailyTask.completed_at.is_(None),
+            DailyTask.task_type == task_type, UserDailyTask.progress >= DailyTask.task_value).all()
+        reward_xp = reward_coins = 0
+        for user_task, task in completed:
+            user_task.completed_at = datetime.utcnow()
+            reward_xp += task.xp_reward or 0
+            reward_coins += task.coin_reward or 0
+            if has_request_context():
+                flash(f'Задание выполнено! Получено {task.xp_reward} XP и {task.coin_reward} монет.', 'success')
+        if reward_xp:
+            user.add_xp(reward_xp, source='daily_task')
+        if reward_coins:
+            user.add_coins(reward_coins)
+
+daily_task_counters = DailyTaskCounters()
+
+# Фоновые задачи
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    # Раз в интервал проверяет, какие задачи не выполнялись в текущем периоде (сутки).
+    # Эксклюзивные задачи захватываются вставкой строки job_run с первичным ключом
+    # (задача, период): при нескольких процессах ее выполняет ровно один.
+    # Локальные задачи обслуживают память своего процесса и выполняются в каждом.
+    def __init__(self, jobs):
+        self._jobs = jobs
+        self._done = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.local_runs = {}
+
+    def claim(self, name, period):
+        result = db.session.execute(
+            db.insert(JobRun.__table__).prefix_with('OR IGNORE'),
+            {'name': name, 'period': period, 'started_at': datetime.utcnow()}
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def run(self, name, today=None):
+        # Возвращает число затронутых строк или None, если задачу уже выполнил другой процесс
+        func, exclusive = self._jobs[name]
+        today = today or datetime.utcnow().date()
+        period = today.isoformat()
+        with self._lock:
+            if self._done.get(name) == period:
+                return None
+            if exclusive and not self.claim(name, period):
+                self._done[name] = period
+                return None
+            started = time.perf_counter()
+            try:
+                rows = func(today)
+            except Exception:
+                db.session.rollback()
+                if exclusive:
+                    # Снимаем захват, чтобы задачу повторил следующий проход
+                    JobRun.query.filter_by(name=name, period=period).delete()
+                    db.session.commit()
+                logger.exception('Job %s failed', name)
+                return None
+            duration_ms = (time.perf_counter() - started) * 1000
+            if exclusive:
+                db.session.execute(
+                    db.update(JobRun.__table__)
+                    .where(JobRun.__table__.c.name == name, JobRun.__table__.c.period == period)
+                    .values(finished_at=datetime.utcnow(), duration_ms=duration_ms, rows=rows)
+                )
+                db.session.commit()
+            else:
+                self.local_runs[name] = {'period': period, 'duration_ms': duration_ms, 'rows': rows}
+            self._done[name] = period
+            logger.info('Job %s for %s: %s rows in %.1f ms', name, period, rows, duration_ms)
+            return rows
+
+    def run_pending(self, today=None):
+        return {name: self.run(name, today) for name in self._jobs}
+
+    def start(self, app, interval=None):
+        if self._thread is not None:
+            return
+        interval = interval or app.config['SCHEDULER_INTERVAL']
+        self._thread = threading.Thread(target=self.loop, args=(app, interval), name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def loop(self, app, interval):
+        while not self._stop.is_set():
+            with app.app_context():
+                self.run_pending()
+            self._stop.wait(interval)
+
+scheduler = app_local('scheduler')
+
+# Задачи регистрируются в модуле, а выполняет их планировщик каждого приложения
+SCHEDULED_JOBS = {}
+
+def scheduled_job(name, exclusive=True):
+    def decorator(func):
+        SCHEDULED_JOBS[name] = (func, exclusive)
+        return func
+    return decorator
+
+@scheduled_job('daily_reset')
+def reset_daily_tasks(today):
+    return daily_task_counters.rollover(today)
+
+@scheduled_job('streak_decay')
+def decay_streaks(today):
+    return streak_engine.decay(today)
+
+@scheduled_job('leaderboard_rotation', exclusive=False)
+def rotate_leaderboards(today):
+    touched = windowed_leaderboards.rotate(today)
+    fragment_cache.bump('leaderboard_period')
+    return touched
+
+@scheduled_job('stats')
+def materialize_stats(today):
+    # Пересобирает агрегаты за вчера одним INSERT ... SELECT
+    day = today - timedelta(days=1)
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    return db.session.execute(db.text(
+        "INSERT OR REPLACE INTO daily_stats (day, new_users, active_users, attempts, avg_score, xp_gained) "
+        "SELECT :day, "
+        "(SELECT COUNT(*) FROM user WHERE created_at >= :start AND created_at < :end), "
+        "COUNT(DISTINCT user_id), COUNT(*), AVG(score), "
+        "(SELECT COALESCE(SUM(xp), 0) FROM xp_daily WHERE day = :day) "
+        "FROM user_progress WHERE completed_at >= :start AND completed_at < :end"),
+        {'day': day.isoformat(), 'start': start, 'end': end}).rowcount
+
+@click.command('worker')
+@click.option('--once', is_flag=True, help='выполнить задачи текущего периода и выйти')
+@click.option('--interval', type=float, default=None, help='интервал проверки в секундах')
+@with_appcontext
+def worker_command(once, interval):
+    # Отдельный процесс для фоновых задач: веб-процессы тогда запускают с SCHEDULER_ENABLED=0
+    if once:
+        for name, rows in scheduler.run_pending().items():
+            click.echo(f'{name}: {"пропущено" if rows is None else rows}')
+        click.echo(f'outbox: {outbox.drain()}')
+        return
+    app = current_app._get_current_object()
+    outbox.start()
+    scheduler.loop(app, interval or app.config['SCHEDULER_INTERVAL'])
+
+# Очередь событий (outbox)
+class Outbox:
+    # Запрос пишет событие в outbox_event в своей транзакции, потоки забирают пачки
+    # с арендой (locked_until) и вызывают обработчики. Повторы — с экспоненциальной
+    # задержкой; отработавшие обработчики отмечаются в outbox_delivery и не повторяются.
+    BATCH_SIZE = 20
+    LEASE = timedelta(seconds=60)
+    MAX_ATTEMPTS = 5
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, handlers):
+        self._handlers = handlers
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, event_type, payload, idempotency_key):
+        # Не коммитит: событие попадает в базу вместе с данными вызывающего.
+        # False — событие с таким ключом уже есть (повторная отправка формы)
+        result = db.session.execute(self.insert_statement(), self.event_row(event_type, payload, idempotency_key))
+        return result.rowcount == 1
+
+    def insert_statement(self):
+        return db.insert(OutboxEvent.__table__).prefix_with('OR IGNORE')
+
+    def event_row(self, event_type, payload, idempotency_key):
+        now = datetime.utcnow()
+        return {'event_type': event_type, 'payload': json.dumps(payload), 'idempotency_key': idempotency_key,
+                'status': 'pending', 'attempts': 0, 'available_at': now, 'created_at': now}
+
+    def notify(self):
+        # Вызывается после коммита
+        if current_app.config['OUTBOX_WORKERS'] <= 0:
+            self.drain()
+            return
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def claim(self, limit=None):
+        now = datetime.utcnow()
+        rows = db.session.execute(db.text(
+            "UPDATE outbox_event SET status = 'processing', locked_until = :locked_until, attempts = attempts + 1 "
+            "WHERE id IN (SELECT id FROM outbox_event "
+            "WHERE (status = 'pending' AND available_at <= :now) OR (status = 'processing' AND locked_until < :now) "
+            "ORDER BY id LIMIT :limit) RETURNING id"),
+            {'now': now, 'locked_until': now + self.LEASE, 'limit': limit or self.BATCH_SIZE}).fetchall()
+        db.session.commit()
+        return sorted(row[0] for row in rows)
+
+    def process(self, event_id):
+        event = db.session.get(OutboxEvent, event_id)
+        event_type, payload = event.event_type, json.loads(event.payload)
+        db.session.commit()
+        try:
+            for name, func in self._handlers.get(event_type, ()):
+                # Отметка о доставке и изменения обработчика коммитятся вместе: повтор после сбоя
+                # либо повторит обработчик целиком, либо пропустит его. Вставка идет первой —
+                # в SQLite она сразу берет блокировку записи, и обработчик читает свежие данные
+                delivered = db.session.execute(db.insert(OutboxDelivery.__table__).prefix_with('OR IGNORE'),
+                                               {'event_id': event_id, 'handler': name}).rowcount
+                if delivered:
+                    func(**payload)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            event = db.session.get(OutboxEvent, event_id)
+            event.last_error = f'{type(e).__name__}: {e}'
+            if event.attempts >= self.MAX_ATTEMPTS:
+                event.status = 'failed'
+                logger.exception('Outbox event %s failed permanently', event_id)
+            else:
+                event.status = 'pending'
+                event.available_at = datetime.utcnow() + timedelta(seconds=2 ** event.attempts)
+                logger.warning('Outbox event %s failed, retrying: %s', event_id, event.last_error)
+            db.session.commit()
+            return False
+        event.status = 'done'
+        event.processed_at = datetime.utcnow()
+        event.locked_until = None
+        db.session.commit()
+        return True
+
+    def drain(self):
+        # Синхронно разбирает все готовые события; возвращает число обработанных
+        processed = 0
+        while True:
+            ids = self.claim()
+            if not ids:
+                return processed
+            for event_id in ids:
+                self.process(event_id)
+                processed += 1
+
+    def start(self, workers=None):
+        if self._threads:
+            return
+        app = current_app._get_current_object()
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(workers or app.config['OUTBOX_WORKERS']):
+                thread = threading.Thread(target=self.loop, args=(app,), name=f'outbox-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def loop(self, app):
+        while not self._stop.is_set():
+            try:
+                with app.app_context():
+                    processed = self.drain()
+            except Exception:
+                logger.exception('Outbox worker error')
+                processed = 0
+            if not processed:
+                with self._wakeup:
+                    self._wakeup.wait(self.POLL_INTERVAL)
+
+outbox = app_local('outbox')
+
+# Обработчики регистрируются в модуле; потоки, которые их вызывают, у каждого приложения свои
+OUTBOX_HANDLERS = {}
+
+def outbox_handler(event_type, name):
+    def decorator(func):
+        OUTBOX_HANDLERS.setdefault(event_type, []).append((name, func))
+        return func
+    return decorator
+
+@outbox_handler('test_graded', 'rewards')
+def grant_test_rewards(user_id, test_id, score, first_attempt, previous_score=None):
+    user = db.session.get(User, user_id)
+    test = db.session.get(Test, test_id)
+    if user is None or test is None or not first_attempt:
+        return
+    user.add_xp(test.xp_reward, source='test')
+    user.add_coins(test.coin_reward)
+    if test.title_reward:
+        user.add_title(test.title_reward)
+
+@outbox_handler('test_graded', 'events')
+def publish_test_completed(user_id, test_id, score, first_attempt, previous_score=None):
+    user = db.session.get(User, user_id)
+    test = db.session.get(Test, test_id)
+    if user is None or test is None:
+        return
+    events.publish('test_completed', user=user, test=test, score=score, first_attempt=first_attempt,
+                   previous_score=previous_score)
+
+@scheduled_job('outbox_cleanup')
+def cleanup_outbox(today):
+    cutoff = datetime.combine(today - timedelta(days=7), datetime.min.time())
+    db.session.execute(db.text(
+        "DELETE FROM outbox_delivery WHERE event_id IN "
+        "(SELECT id FROM outbox_event WHERE status = 'done' AND processed_at < :cutoff)"), {'cutoff': cutoff})
+    return db.session.execute(db.text(
+        "DELETE FROM outbox_event WHERE status = 'done' AND processed_at < :cutoff"), {'cutoff': cutoff}).rowcount
+
+@events.subscribe('test_completed')
+def count_daily_tests(user, test, score, first_attempt, previous_score=None):
+    daily_task_counters.increment(user, 'complete_test')
+    if score >= 100:
+        daily_task_counters.increment(user, 'get_perfect_score')
+
+@events.subscribe('xp_gained')
+def count_daily_xp(user, amount, source):
+    # Награды за сами задания не засчитываются, иначе задание на опыт подпитывало бы себя
+    if source != 'daily_task':
+        daily_task_counters.increment(user, 'earn_xp', amount)
+
 class TestLanguageParser:
     def __init__(self, content):
         if not content or not isinstance(content, str):
@@ -459,6 +2531,19 @@ class TestLanguageParser:
             print(f"Ошибка при разборе ответа: {e}")
             return None
 
+def collect_answers(form_lists):
+    # Поля q<N> формы теста -> {N: ответ}; вопрос с выбором нескольких вариантов дает список
+    answers = {}
+    for key, value in form_lists:
+        if key.startswith('q'):
+            answers[key[1:]] = value[0] if len(value) == 1 else value
+    return answers
+
+def submission_key(user_id, test_id, submission_id):
+    # Ключ идемпотентности отправки теста: id формы генерирует браузер, без него каждая отправка новая
+    return f'test:{user_id}:{test_id}:{(submission_id or "")[:64] or uuid.uuid4().hex}'
+
+@timed_stage('grade')
 def calculate_score(user_answers, questions):
     if not questions:
         return 0, []
@@ -495,6 +2580,7 @@ def calculate_score(user_answers, questions):
     score = round((correct / len(questions)) * 100, 2) if questions else 0
     return score, results
 
+@timed_stage('render_figure')
 def render_figure(figure_data):
     if not figure_data or not isinstance(figure_data, dict):
         return ""
@@ -562,273 +2648,10 @@ TEMPLATES = {
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>{% block title %}{% endblock %} - Математическая платформа</title>
-        <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-        <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-        <link href="https://fonts.googleapis.com/css2?family=Montserrat:wght@400;500;600;700&display=swap" rel="stylesheet">
-        <style>
-            :root {
-                --primary-color: #2196F3;
-                --secondary-color: #1976D2;
-                --accent-color: #FF4081;
-                --text-color: #333333;
-                --light-bg: #F5F5F5;
-                --dark-bg: #1E1E1E;
-                --success-color: #4CAF50;
-                --warning-color: #FFC107;
-                --danger-color: #F44336;
-                --card-bg: #FFFFFF;
-                --border-color: #E0E0E0;
-                --shadow-color: rgba(0,0,0,0.1);
-                --sidebar-width: 250px;
-            }
-            
-            [data-theme="dark"] {
-                --primary-color: #64B5F6;
-                --secondary-color: #42A5F5;
-                --accent-color: #FF80AB;
-                --text-color: #FFFFFF;
-                --light-bg: #121212;
-                --dark-bg: #000000;
-                --success-color: #81C784;
-                --warning-color: #FFD54F;
-                --danger-color: #E57373;
-                --card-bg: #1E1E1E;
-                --border-color: #333333;
-                --shadow-color: rgba(0,0,0,0.3);
-            }
-            
-            * {
-                margin: 0;
-                padding: 0;
-                box-sizing: border-box;
-            }
-            
-            body {
-                font-family: 'Montserrat', sans-serif;
-                background-color: var(--light-bg);
-                color: var(--text-color);
-                min-height: 100vh;
-                display: flex;
-            }
-            
-            /* Боковое меню */
-            .sidebar {
-                width: var(--sidebar-width);
-                background: linear-gradient(135deg, var(--primary-color), var(--secondary-color));
-                color: white;
-                padding: 1.5rem 0;
-                position: fixed;
-                height: 100vh;
-                overflow-y: auto;
-                transition: all 0.3s ease;
-                z-index: 1000;
-            }
-            
-            .sidebar-header {
-                padding: 0 1.5rem;
-                margin-bottom: 2rem;
-                display: flex;
-                align-items: center;
-                gap: 1rem;
-            }
-            
-            .sidebar-brand {
-                font-size: 1.5rem;
-                font-weight: 700;
-                color: white;
-                text-decoration: none;
-                display: flex;
-                align-items: center;
-                gap: 0.5rem;
-            }
-            
-            .sidebar-brand i {
-                font-size: 1.8rem;
-                color: var(--warning-color);
-            }
-            
-            .nav-link {
-                color: rgba(255,255,255,0.9);
-                padding: 1rem 1.5rem;
-                display: flex;
-                align-items: center;
-                gap: 1rem;
-                font-weight: 500;
-                transition: all 0.3s ease;
-                border-left: 4px solid transparent;
-            }
-            
-            .nav-link:hover {
-                color: white;
-                background: rgba(255,255,255,0.1);
-                border-left-color: var(--warning-color);
-            }
-            
-            .nav-link.active {
-                color: white;
-                background: rgba(255,255,255,0.15);
-                border-left-color: var(--warning-color);
-            }
-            
-            .nav-link i {
-                font-size: 1.2rem;
-                width: 24px;
-                text-align: center;
-            }
-            
-            /* Основной контент */
-            .main-content {
-                flex: 1;
-                margin-left: var(--sidebar-width);
-                padding: 2rem;
-                transition: all 0.3s ease;
-            }
-            
-            /* Верхняя панель */
-            .top-bar {
-                background: var(--card-bg);
-                padding: 1rem 2rem;
-                margin: -2rem -2rem 2rem -2rem;
-                box-shadow: 0 2px 10px var(--shadow-color);
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-            }
-            
-            .user-info {
-                display: flex;
-                align-items: center;
-                gap: 1rem;
-            }
-            
-            .user-avatar {
-                width: 40px;
-                height: 40px;
-                border-radius: 50%;
-                background: linear-gradient(135deg, var(--secondary-color), var(--primary-color));
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                color: white;
-                font-weight: 700;
-                box-shadow: 0 3px 10px var(--shadow-color);
-            }
-            
-            .user-stats {
-                display: flex;
-                gap: 1rem;
-            }
-            
-            .stat-item {
-                background: var(--light-bg);
-                padding: 0.5rem 1rem;
-                border-radius: 20px;
-                display: flex;
-                align-items: center;
-                gap: 0.5rem;
-                font-size: 0.9rem;
-            }
-            
-            .stat-item i {
-                color: var(--warning-color);
-            }
-            
-            /* Кнопки */
-            .btn {
-                border-radius: 20px;
-                padding: 0.7rem 1.5rem;
-                font-weight: 500;
-                transition: all 0.3s ease;
-            }
-            
-            .btn-primary {
-                background: linear-gradient(135deg, var(--secondary-color), var(--primary-color));
-                border: none;
-            }
-            
-            .btn-primary:hover {
-                transform: translateY(-2px);
-                box-shadow: 0 5px 15px var(--shadow-color);
-            }
-            
-            .btn-outline-light {
-                border: 2px solid white;
-            }
-            
-            .btn-outline-light:hover {
-                background: white;
-                color: var(--primary-color);
-            }
-            
-            /* Flash сообщения */
-            .flash-messages {
-                position: fixed;
-                top: 20px;
-                right: 20px;
-                z-index: 1000;
-            }
-            
-            .flash-message {
-                animation: slideIn 0.3s ease-out;
-                border-radius: 10px;
-                box-shadow: 0 3px 10px var(--shadow-color);
-                border: none;
-            }
-            
-            @keyframes slideIn {
-                from { transform: translateX(100%); opacity: 0; }
-                to { transform: translateX(0); opacity: 1; }
-            }
-            
-            /* Адаптивность */
-            @media (max-width: 768px) {
-                .sidebar {
-                    transform: translateX(-100%);
-                }
-                
-                .sidebar.active {
-                    transform: translateX(0);
-                }
-                
-                .main-content {
-                    margin-left: 0;
-                }
-                
-                .top-bar {
-                    padding: 1rem;
-                }
-                
-                .user-stats {
-                    display: none;
-                }
-            }
-            
-            /* Мобильное меню */
-            .mobile-menu-btn {
-                display: none;
-                background: none;
-                border: none;
-                color: var(--text-color);
-                font-size: 1.5rem;
-                cursor: pointer;
-            }
-            
-            @media (max-width: 768px) {
-                .mobile-menu-btn {
-                    display: block;
-                }
-            }
-            
-            /* Анимации */
-            .fade-in {
-                animation: fadeIn 0.5s ease-out;
-            }
-            
-            @keyframes fadeIn {
-                from { opacity: 0; transform: translateY(20px); }
-                to { opacity: 1; transform: translateY(0); }
-            }
-        </style>
+        <link href="{{ asset_url('vendor/bootstrap/css/bootstrap.min.css') }}" rel="stylesheet">
+        <link href="{{ asset_url('vendor/fontawesome/css/all.min.css') }}" rel="stylesheet">
+        <link href="{{ asset_url('vendor/montserrat/montserrat.css') }}" rel="stylesheet">
+        <link href="{{ asset_url('src/base.css') }}" rel="stylesheet">
         {% block extra_css %}{% endblock %}
     </head>
     <body>
@@ -952,38 +2775,8 @@ TEMPLATES = {
             </div>
         </main>
         
-        <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
-        <script>
-            // Переключение бокового меню на мобильных устройствах
-            function toggleSidebar() {
-                document.querySelector('.sidebar').classList.toggle('active');
-            }
-            
-            // Автоматическое скрытие flash-сообщений
-            document.addEventListener('DOMContentLoaded', function() {
-                const alerts = document.querySelectorAll('.alert');
-                alerts.forEach(function(alert) {
-                    setTimeout(function() {
-                        alert.classList.remove('show');
-                        setTimeout(function() {
-                            alert.remove();
-                        }, 300);
-                    }, 5000);
-                });
-            });
-            
-            // Закрытие бокового меню при клике вне его на мобильных устройствах
-            document.addEventListener('click', function(event) {
-                const sidebar = document.querySelector('.sidebar');
-                const mobileMenuBtn = document.querySelector('.mobile-menu-btn');
-                
-                if (window.innerWidth <= 768 && 
-                    !sidebar.contains(event.target) && 
-                    !mobileMenuBtn.contains(event.target)) {
-                    sidebar.classList.remove('active');
-                }
-            });
-        </script>
+        <script src="{{ asset_url('vendor/bootstrap/js/bootstrap.bundle.min.js') }}"></script>
+        <script src="{{ asset_url('src/base.js') }}"></script>
         {% block extra_js %}{% endblock %}
     </body>
     </html>
@@ -1085,6 +2878,21 @@ TEMPLATES = {
                     </div>
                 </div>
                 
+                <div class="card mb-4">
+                    <div class="card-body">
+                        <h5 class="card-title">Серия активности</h5>
+                        <p class="card-text">
+                            Текущая: {{ current_streak }} дн.
+                            {% if current_user.streak %}· Рекорд: {{ current_user.streak.longest_streak }} дн.{% endif %}
+                        </p>
+                        <div class="activity-calendar">
+                            {% for active in activity_calendar %}
+                                <span class="activity-day {% if active %}active{% endif %}"></span>
+                            {% endfor %}
+                        </div>
+                    </div>
+                </div>
+                
                 <div class="card mb-4">
                     <div class="card-body">
                         <h5 class="card-title">Титулы ({{ user_titles|length }}/50)</h5>
@@ -1124,6 +2932,25 @@ TEMPLATES = {
                 {% endif %}
             </div>
         </div>
+        
+        <style>
+            .activity-calendar {
+                display: grid;
+                grid-template-columns: repeat(7, 16px);
+                gap: 4px;
+            }
+            
+            .activity-day {
+                width: 16px;
+                height: 16px;
+                border-radius: 3px;
+                background: #e9ecef;
+            }
+            
+            .activity-day.active {
+                background: #28a745;
+            }
+        </style>
     {% endblock %}
     ''',
     
@@ -1139,6 +2966,8 @@ TEMPLATES = {
             <a href="/tests" class="btn btn-outline-secondary">Все тесты</a>
         </div>
         
+        {% call cache_fragment('tests_list', versions=['tests'], key=[subject or 'all']) %}
+        {% set tests = tests|list %}
         {% if tests %}
             <div class="row">
                 {% for test in tests %}
@@ -1162,6 +2991,7 @@ TEMPLATES = {
         {% else %}
             <p>Нет доступных тестов.</p>
         {% endif %}
+        {% endcall %}
     {% endblock %}
     ''',
     
@@ -1187,6 +3017,12 @@ TEMPLATES = {
     {% endfor %}
 
         <form method="POST">
+        <input type="hidden" name="submission_id" id="submission-id">
+        <script>
+            // Идентификатор создается в браузере, чтобы страница из кэша (304) не повторяла прошлый
+            document.getElementById('submission-id').value =
+                window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now() + '-' + Math.random().toString(36).slice(2);
+        </script>
     {% for q in parsed.questions %}
         <div class="question-card">
             <strong>{{ loop.index }}. {{ q.text }}</strong><br>
@@ -1377,6 +3213,10 @@ TEMPLATES = {
             </div>
             
             <div class="col-md-9">
+                {% call cache_fragment('shop_items', versions=['shop'], key=[affordable]) %}
+                {% set shop_items = shop_items|list %}
+                {% set prices = shop_items|map(attribute='price')|sort|list %}
+                {% set price_limit = prices[affordable - 1] if affordable else -1 %}
                 <div class="row">
                     {% for item in shop_items %}
                         <div class="col-md-4 mb-4">
@@ -1387,7 +3227,7 @@ TEMPLATES = {
                                     <p class="text-muted mt-auto">Цена: {{ item.price }} монет</p>
                                     <form method="post" action="{{ url_for('buy_item', item_id=item.id) }}" class="mt-auto">
                                         <button type="submit" class="btn btn-primary w-100" 
-                                            {% if current_user.coins < item.price %}disabled{% endif %}>
+                                            {% if item.price > price_limit %}disabled{% endif %}>
                                             Купить
                                         </button>
                                     </form>
@@ -1396,6 +3236,7 @@ TEMPLATES = {
                         </div>
                     {% endfor %}
                 </div>
+                {% endcall %}
             </div>
         </div>
     {% endblock %}
@@ -1544,6 +3385,7 @@ TEMPLATES = {
                     <th>Название</th>
                     <th>Тип</th>
                     <th>Цена</th>
+                    <th>Владельцев</th>
                     <th>Действия</th>
                 </tr>
             </thead>
@@ -1554,6 +3396,7 @@ TEMPLATES = {
                     <td>{{ item.name }}</td>
                     <td>{{ item.item_type }}</td>
                     <td>{{ item.price }}</td>
+                    <td>{{ owner_counts.get(item.id, 0) }}</td>
                     <td>
                         <form action="/admin/delete_shop_item/{{ item.id }}" method="post" style="display:inline;">
                             <button class="btn btn-danger btn-sm">Удалить</button>
@@ -1565,6 +3408,102 @@ TEMPLATES = {
         </table>
         <a href="/admin/create_shop_item" class="btn btn-primary mt-3">Добавить товар</a>
     </div>
+
+    <div class="admin-section">
+        <h4>Статистика по дням</h4>
+        <table>
+            <thead>
+                <tr><th>День</th><th>Новых</th><th>Активных</th><th>Попыток</th><th>Средний балл</th><th>Опыт</th></tr>
+            </thead>
+            <tbody>
+                {% for row in daily_stats %}
+                <tr>
+                    <td>{{ row.day }}</td>
+                    <td>{{ row.new_users }}</td>
+                    <td>{{ row.active_users }}</td>
+                    <td>{{ row.attempts }}</td>
+                    <td>{{ '%.1f'|format(row.avg_score) if row.avg_score is not none else '—' }}</td>
+                    <td>{{ row.xp_gained }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    </div>
+
+    <div class="admin-section">
+        <h4>Фоновые задачи</h4>
+        <table>
+            <thead>
+                <tr><th>Задача</th><th>Период</th><th>Начало</th><th>Длительность, мс</th><th>Строк</th></tr>
+            </thead>
+            <tbody>
+                {% for run in job_runs %}
+                <tr>
+                    <td>{{ run.name }}</td>
+                    <td>{{ run.period }}</td>
+                    <td>{{ run.started_at.strftime('%Y-%m-%d %H:%M') }}</td>
+                    <td>{{ '%.1f'|format(run.duration_ms) if run.duration_ms is not none else 'выполняется' }}</td>
+                    <td>{{ run.rows if run.rows is not none else '—' }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+    </div>
+
+    <div class="admin-section">
+        <h4>Производительность процесса</h4>
+        <table>
+            <thead>
+                <tr><th>Маршрут</th><th>Запросов</th><th>Всего, с</th><th>Среднее, мс</th><th>SQL на запрос</th><th>SQL, мс</th><th>Шаблоны, мс</th></tr>
+            </thead>
+            <tbody>
+                {% for row in route_metrics %}
+                <tr>
+                    <td>{{ row.route }}</td>
+                    <td>{{ row.requests }}</td>
+                    <td>{{ '%.2f'|format(row.total_s) }}</td>
+                    <td>{{ '%.1f'|format(row.avg_ms) }}</td>
+                    <td>{{ '%.1f'|format(row.sql_queries) }}</td>
+                    <td>{{ '%.1f'|format(row.sql_ms) }}</td>
+                    <td>{{ '%.1f'|format(row.template_ms) }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        <a href="{{ url_for('admin_metrics') }}" class="btn btn-secondary mt-3">Метрики (Prometheus)</a>
+    </div>
+
+    <div class="admin-section">
+        <h4>Профилировщик</h4>
+        {% if profiler_control and profiler_control.until > now %}
+        <p>Идет сеанс {{ profiler_control.id }}: {{ '%g'|format(profiler_control.rate * 100) }}% запросов
+            {%- if profiler_control.route %} маршрута {{ profiler_control.route }}{% endif %},
+            еще {{ (profiler_control.until - now)|round|int }} с.</p>
+        <form action="{{ url_for('admin_profiler') }}" method="post" style="display:inline;">
+            <input type="hidden" name="action" value="stop">
+            <button class="btn btn-warning btn-sm">Остановить</button>
+        </form>
+        {% else %}
+        <form action="{{ url_for('admin_profiler') }}" method="post">
+            <label>Доля запросов, %
+                <input type="number" name="percent" value="10" min="0.1" max="100" step="0.1" class="form-control form-control-sm">
+            </label>
+            <label>Маршрут
+                <select name="route" class="form-select form-select-sm">
+                    <option value="">все</option>
+                    {% for name in profiler_routes %}<option value="{{ name }}">{{ name }}</option>{% endfor %}
+                </select>
+            </label>
+            <label>Длительность, с
+                <input type="number" name="duration" value="60" min="1" max="600" class="form-control form-control-sm">
+            </label>
+            <button class="btn btn-primary btn-sm">Запустить</button>
+        </form>
+        {% endif %}
+        {% if profiler_control and profiler_control.id %}
+        <a href="{{ url_for('admin_profiler_stacks') }}" class="btn btn-secondary mt-3">Скачать стеки сеанса {{ profiler_control.id }}</a>
+        {% endif %}
+    </div>
 </div>
 {% endblock %}
     ''',
@@ -2063,7 +4002,7 @@ TEMPLATES = {
                             <strong>Уровень:</strong> {{ current_user.level }}<br>
                             <strong>Опыт:</strong> {{ current_user.xp }}<br>
                             <strong>Монеты:</strong> {{ current_user.coins }}<br>
-                            <strong>Тестов пройдено:</strong> {{ current_user.progress|length }}
+                            <strong>Тестов пройдено:</strong> {{ tests_completed }}
                         </p>
                     </div>
                 </div>
@@ -2104,12 +4043,14 @@ TEMPLATES = {
                                                     {% if item.user_progress %}
                                                         <span class="badge bg-success">Получено</span>
                                                     {% else %}
+                                                        {% if item.achievement.condition_value %}
                                                         <div class="progress">
                                                             <div class="progress-bar" role="progressbar" 
-                                                                 style="width: {{ (item.user_progress.progress / item.achievement.condition_value) * 100 }}%">
-                                                                {{ item.user_progress.progress }}/{{ item.achievement.condition_value }}
+                                                                 style="width: {{ (item.progress / item.achievement.condition_value) * 100 }}%">
+                                                                {{ item.progress }}/{{ item.achievement.condition_value }}
                                                             </div>
                                                         </div>
+                                                        {% endif %}
                                                     {% endif %}
                                                 </div>
                                             </div>
@@ -2180,8 +4121,8 @@ TEMPLATES = {
                 <div class="card">
                     <div class="card-body">
                         <h5 class="card-title">Активные задания</h5>
-                        {% for task in active_tasks %}
-                            {% set user_task = user_tasks|selectattr('task_id', 'equalto', task.id)|first %}
+                        {% for task, user_task in tasks %}
+                            {% set progress = user_task.progress if user_task else 0 %}
                             <div class="task-card mb-3 {% if user_task and user_task.completed_at %}completed{% endif %}">
                                 <div class="d-flex justify-content-between align-items-center">
                                     <div>
@@ -2198,8 +4139,8 @@ TEMPLATES = {
                                         {% else %}
                                             <div class="progress" style="width: 200px;">
                                                 <div class="progress-bar" role="progressbar" 
-                                                     style="width: {{ (user_task.progress / task.task_value) * 100 }}%">
-                                                    {{ user_task.progress }}/{{ task.task_value }}
+                                                     style="width: {{ (progress / task.task_value) * 100 if task.task_value else 0 }}%">
+                                                    {{ progress }}/{{ task.task_value }}
                                                 </div>
                                             </div>
                                         {% endif %}
@@ -2263,6 +4204,24 @@ TEMPLATES = {
                         {% endif %}
                     </div>
                 </div>
+                
+                {% if friends_ranking|length > 1 %}
+                <div class="card mb-4">
+                    <div class="card-body">
+                        <h5 class="card-title">Рейтинг среди друзей</h5>
+                        <div class="list-group">
+                            {% for user in friends_ranking %}
+                                <div class="list-group-item {% if user.id == current_user.id %}active{% endif %}">
+                                    <div class="d-flex justify-content-between align-items-center">
+                                        <span>{{ loop.index }}. {{ user.username }}</span>
+                                        <small>Уровень {{ user.level }}, {{ user.xp }} XP</small>
+                                    </div>
+                                </div>
+                            {% endfor %}
+                        </div>
+                    </div>
+                </div>
+                {% endif %}
             </div>
             
             <div class="col-md-8">
@@ -2329,15 +4288,16 @@ TEMPLATES = {
     {% block content %}
         <h1>Рейтинг игроков</h1>
         
+        {% call cache_fragment('leaderboard_top', versions=['leaderboard']) %}
         <div class="row">
             <div class="col-md-4">
                 <div class="card mb-4">
                     <div class="card-header">
                         <h5 class="mb-0">Топ по опыту</h5>
                     </div>
-                    <div class="card-body">
+                    <div class="card-body" data-live-board="xp">
                         <div class="list-group">
-                            {% for user in top_users %}
+                            {% for user in top_users() %}
                                 <div class="list-group-item">
                                     <div class="d-flex justify-content-between align-items-center">
                                         <div>
@@ -2358,9 +4318,9 @@ TEMPLATES = {
                     <div class="card-header">
                         <h5 class="mb-0">Топ по уровню</h5>
                     </div>
-                    <div class="card-body">
+                    <div class="card-body" data-live-board="level">
                         <div class="list-group">
-                            {% for user in top_levels %}
+                            {% for user in top_levels() %}
                                 <div class="list-group-item">
                                     <div class="d-flex justify-content-between align-items-center">
                                         <div>
@@ -2381,9 +4341,9 @@ TEMPLATES = {
                     <div class="card-header">
                         <h5 class="mb-0">Топ по монетам</h5>
                     </div>
-                    <div class="card-body">
+                    <div class="card-body" data-live-board="coins">
                         <div class="list-group">
-                            {% for user in top_coins %}
+                            {% for user in top_coins() %}
                                 <div class="list-group-item">
                                     <div class="d-flex justify-content-between align-items-center">
                                         <div>
@@ -2399,18 +4359,241 @@ TEMPLATES = {
                 </div>
             </div>
         </div>
+        
+        {% endcall %}
+        
+        {% call cache_fragment('leaderboard_period', versions=['leaderboard_period'], key=[period_day]) %}
+        <h2 class="mt-2">Лучшие за период</h2>
+        <div class="row">
+            {% for period, period_title, period_users in [('day', 'За день', top_day()), ('week', 'За неделю', top_week()), ('month', 'За месяц', top_month())] %}
+            <div class="col-md-4">
+                <div class="card mb-4">
+                    <div class="card-header">
+                        <h5 class="mb-0">{{ period_title }}</h5>
+                    </div>
+                    <div class="card-body" data-live-board="{{ period }}">
+                        {% if period_users %}
+                        <div class="list-group">
+                            {% for user in period_users %}
+                                <div class="list-group-item">
+                                    <div class="d-flex justify-content-between align-items-center">
+                                        <div>
+                                            <h6 class="mb-0">{{ user.username }}</h6>
+                                            <small class="text-muted">Уровень {{ user.level }}</small>
+                                        </div>
+                                        <span class="badge bg-info">+{{ user.window_xp }} XP</span>
+                                    </div>
+                                </div>
+                            {% endfor %}
+                        </div>
+                        {% else %}
+                        <p class="text-muted mb-0">Пока никто не набрал опыт</p>
+                        {% endif %}
+                    </div>
+                </div>
+            </div>
+            {% endfor %}
+        </div>
+        {% endcall %}
+        
+        {% if my_ranks %}
+        <h2 class="mt-2">Ваше место</h2>
+        <div class="row">
+            {% for board, board_title in [('xp', 'По опыту'), ('level', 'По уровню'), ('coins', 'По монетам')] %}
+                {% set info = my_ranks.get(board) %}
+                {% if info %}
+                <div class="col-md-4">
+                    <div class="card mb-4">
+                        <div class="card-header">
+                            <h5 class="mb-0" data-live-rank="{{ board }}" data-title="{{ board_title }}">{{ board_title }}: #{{ info.rank }} из {{ total_players }}</h5>
+                        </div>
+                        <div class="card-body">
+                            <div class="list-group">
+                                {% for rank, user in info.neighbors %}
+                                    <div class="list-group-item {% if user.id == current_user.id %}active{% endif %}">
+                                        <div class="d-flex justify-content-between align-items-center">
+                                            <div>
+                                                <h6 class="mb-0">#{{ rank }} {{ user.username }}</h6>
+                                                <small>Уровень {{ user.level }}</small>
+                                            </div>
+                                            <span class="badge bg-secondary">
+                                                {% if board == 'coins' %}{{ user.coins }} монет{% else %}{{ user.xp }} XP{% endif %}
+                                            </span>
+                                        </div>
+                                    </div>
+                                {% endfor %}
+                            </div>
+                        </div>
+                    </div>
+                </div>
+                {% endif %}
+            {% endfor %}
+        </div>
+        {% endif %}
+
+        <script>
+            // Живой рейтинг: сервер присылает снимок топов, затем только изменившиеся места
+            (function() {
+                if (!window.EventSource) return;
+                const boards = {};
+                const badges = {
+                    xp: u => ['Уровень ' + u.level, u.xp + ' XP', 'bg-primary'],
+                    level: u => [u.xp + ' XP', 'Уровень ' + u.level, 'bg-success'],
+                    coins: u => ['Уровень ' + u.level, u.coins + ' монет', 'bg-warning'],
+                };
+                const periodBadge = u => ['Уровень ' + u.level, '+' + u.window_xp + ' XP', 'bg-info'];
+
+                function element(tag, className, text) {
+                    const el = document.createElement(tag);
+                    if (className) el.className = className;
+                    if (text !== undefined) el.textContent = text;
+                    return el;
+                }
+
+                function render(board) {
+                    const body = document.querySelector('[data-live-board="' + board + '"]');
+                    if (!body) return;
+                    const users = boards[board];
+                    if (!users.length) {
+                        body.replaceChildren(element('p', 'text-muted mb-0', 'Пока никто не набрал опыт'));
+                        return;
+                    }
+                    const list = element('div', 'list-group');
+                    for (const u of users) {
+                        const [subtitle, badge, badgeClass] = (badges[board] || periodBadge)(u);
+                        const name = element('div');
+                        name.append(element('h6', 'mb-0', u.username), element('small', 'text-muted', subtitle));
+                        const row = element('div', 'd-flex justify-content-between align-items-center');
+                        row.append(name, element('span', 'badge ' + badgeClass, badge));
+                        const item = element('div', 'list-group-item');
+                        item.append(row);
+                        list.append(item);
+                    }
+                    body.replaceChildren(list);
+                }
+
+                const source = new EventSource('{{ url_for('leaderboard_stream') }}');
+                source.addEventListener('snapshot', function(event) {
+                    const data = JSON.parse(event.data);
+                    for (const board in data.boards) {
+                        boards[board] = data.boards[board];
+                        render(board);
+                    }
+                });
+                source.addEventListener('diff', function(event) {
+                    const data = JSON.parse(event.data);
+                    for (const board in data.boards) {
+                        const diff = data.boards[board];
+                        const users = boards[board] || [];
+                        for (const [rank, user] of diff.changes) users[rank - 1] = user;
+                        users.length = diff.size;
+                        boards[board] = users;
+                        render(board);
+                    }
+                });
+                source.addEventListener('me', function(event) {
+                    const data = JSON.parse(event.data);
+                    document.querySelectorAll('[data-live-rank]').forEach(function(header) {
+                        const rank = data.ranks[header.dataset.liveRank];
+                        if (rank) header.textContent = header.dataset.title + ': #' + rank + ' из ' + data.total;
+                    });
+                });
+            })();
+        </script>
     {% endblock %}
     '''
 }
 
-app.jinja_loader = DictLoader(TEMPLATES)
+@on_warm_up
+def warm_templates():
+    # Компилирует все шаблоны заранее: байткод берется из кэша (ключ — имя и хэш исходника)
+    # или пишется в него, а готовые шаблоны остаются в кэше окружения Jinja
+    started = time.perf_counter()
+    for name in TEMPLATES:
+        current_app.jinja_env.get_template(name)
+    return len(TEMPLATES), (time.perf_counter() - started) * 1000
+
+@click.command('compile-templates')
+@with_appcontext
+def compile_templates_command():
+    # Шаг сборки: заполняет кэш байткода до запуска рабочих процессов
+    app = current_app
+    if app.jinja_env.bytecode_cache is not None:
+        app.jinja_env.bytecode_cache.clear()
+    if app.jinja_env.cache is not None:
+        app.jinja_env.cache.clear()
+    count, elapsed_ms = warm_templates()
+    click.echo(f'Скомпилировано шаблонов: {count} за {elapsed_ms:.1f} мс -> {app.config["TEMPLATE_CACHE_DIR"] or "без кэша"}')
+
+# Статические ресурсы
+# Сторонние библиотеки вендорятся в static/vendor (python build_assets.py --fetch),
+# build_assets.py собирает static/src и static/vendor в static/dist: имена с хэшем
+# содержимого, рядом .gz/.br и manifest.json. Пока сборки нет, ссылки ведут на исходники,
+# а недостающие библиотеки — на CDN с предупреждением в журнале; в собранном сайте
+# библиотека без записи в манифесте — ошибка.
+VENDOR_ASSETS = {
+    'vendor/bootstrap/css/bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css',
+    'vendor/bootstrap/js/bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js',
+    'vendor/fontawesome/css/all.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css',
+    'vendor/montserrat/montserrat.css': 'https://fonts.googleapis.com/css2?family=Montserrat:wght@400;500;600;700&display=swap',
+}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def load_asset_manifest(app):
+    try:
+        with open(os.path.join(app.static_folder, 'dist', 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+_asset_sources = {}
+_cdn_fallbacks = set()
+
+def asset_url(name):
+    manifest = current_app.extensions['asset_manifest']
+    hashed = manifest.get(name)
+    if hashed:
+        return url_for('asset', filename=hashed)
+    if name not in _asset_sources:
+        _asset_sources[name] = os.path.isfile(os.path.join(current_app.static_folder, name))
+    if _asset_sources[name] or name not in VENDOR_ASSETS:
+        return url_for('static', filename=name)
+    if manifest:
+        # Собранный сайт работает без внешних адресов: библиотеки нет в сборке — сборка неполная
+        raise RuntimeError(f'Vendor asset {name} is missing from static/dist/manifest.json, '
+                           'run python build_assets.py --fetch and rebuild')
+    if name not in _cdn_fallbacks:
+        _cdn_fallbacks.add(name)
+        current_app.logger.warning('Vendor asset %s is not in static/vendor, serving it from %s',
+                                   name, VENDOR_ASSETS[name])
+    return VENDOR_ASSETS[name]
+
+@route('/assets/<path:filename>')
+def asset(filename):
+    # Имена содержат хэш, поэтому файл кэшируется навсегда; сжатый вариант выбирается по Accept-Encoding
+    directory = os.path.join(current_app.static_folder, 'dist')
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        compressed = safe_join(directory, filename + suffix)
+        if request.accept_encodings[encoding] and compressed and os.path.isfile(compressed):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 # Маршруты
-@app.route('/')
+@route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -2434,13 +4617,14 @@ def register():
             new_user.set_password(password)
             db.session.add(new_user)
             db.session.commit()
+            leaderboards.update_user(new_user.ranking_snapshot())
 
             flash('Регистрация прошла успешно!', 'success')
             return redirect(url_for('login'))
 
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -2456,32 +4640,38 @@ def login():
 
     return render_template('login.html')
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.pop('user_id', None)
     flash('Вы успешно вышли из системы', 'info')
     return redirect(url_for('index'))
 
-@app.route('/profile')
+@route('/profile')
 @login_required
+@query_budget(5)
 def profile():
     user = get_current_user()
-    progress = UserProgress.query.filter_by(user_id=user.id).join(Test).all()
-    titles = json.loads(user.titles)
+    progress = (UserProgress.query.filter_by(user_id=user.id)
+                .join(UserProgress.test)
+                .options(db.contains_eager(UserProgress.test))
+                .order_by(UserProgress.completed_at.desc())
+                .all())
+    titles = user.title_ids()
     user_titles = [{"id": tid, **TITLES.get(tid, {"name": f"Титул {tid}", "description": "Неизвестный титул"})} for tid in titles]
     
     return render_template('profile.html', 
                          current_user=user, 
                          progress=progress,
-                         user_titles=user_titles)
+                         user_titles=user_titles,
+                         current_streak=streak_engine.current(user.streak),
+                         activity_calendar=streak_engine.calendar(user.streak))
 
-@app.route('/equip_title/<int:title_id>', methods=['POST'])
+@route('/equip_title/<int:title_id>', methods=['POST'])
 @login_required
 def equip_title(title_id):
     user = get_current_user()
-    titles = json.loads(user.titles)
     
-    if title_id in titles:
+    if user.has_title(title_id):
         user.equipped_title = title_id
         db.session.commit()
         flash(f"Титул '{TITLES.get(title_id, {}).get('name', '')}' теперь отображается в вашем профиле", "success")
@@ -2490,13 +4680,19 @@ def equip_title(title_id):
     
     return redirect(url_for('profile'))
 
-@app.route('/shop')
+@route('/shop')
 @login_required
+@query_budget(3)
 def shop():
-    items = ShopItem.query.all()
-    return render_template('shop.html', items=items)
-
-@app.route('/buy/<int:item_id>', methods=['POST'])
+    user = get_current_user()
+    # Вариант фрагмента зависит только от того, сколько товаров пользователь может купить:
+    # при известных ценах это однозначно задает, какие кнопки неактивны
+    prices = shop_prices()
+    affordable = bisect_left(prices, user.coins + 1)
+    # Запрос к товарам выполнится только при промахе кэша, внутри фрагмента
+    return render_template('shop.html', shop_items=ShopItem.query.order_by(ShopItem.id), affordable=affordable)
+
+@route('/buy/<int:item_id>', methods=['POST'])
 @login_required
 def buy_item(item_id):
     user = get_current_user()
@@ -2507,71 +4703,74 @@ def buy_item(item_id):
             if user.add_title(item.id):
                 user.add_coins(-item.price)
                 flash(f"Вы успешно приобрели титул '{item.name}'!", "success")
+                events.publish('purchase', user=user, item=item)
             else:
                 flash("У вас уже есть этот титул", "warning")
         else:
             if user.add_item(item.id):
                 user.add_coins(-item.price)
                 flash(f"Вы успешно приобрели '{item.name}'!", "success")
+                events.publish('purchase', user=user, item=item)
             else:
                 flash("У вас уже есть этот предмет", "warning")
+        db.session.commit()
     else:
         flash("Недостаточно монет для покупки", "danger")
     
     return redirect(url_for('shop'))
 
-@app.route('/tests')
+@route('/tests')
+@query_budget(2)
 def tests():
     subject = request.args.get('subject')
+    cached = not_modified('tests', subject, fragment_cache.version('tests'), user_state(get_current_user()))
+    if cached:
+        return cached
     tests_query = Test.query.filter_by(subject=subject) if subject else Test.query
-    tests = tests_query.all()
-    return render_template('tests.html', tests=tests, subject=subject)
+    # Запрос выполнится только при промахе кэша фрагмента
+    return render_template('tests.html', tests=tests_query, subject=subject)
 
-@app.route('/test/<int:test_id>', methods=['GET', 'POST'])
+@route('/test/<int:test_id>', methods=['GET', 'POST'])
 @login_required
 def test(test_id):
     test = Test.query.get_or_404(test_id)
     user = get_current_user()
     
     if request.method == 'POST':
-        user_answers = {}
-        for key, value in request.form.lists():
-            if key.startswith('q'):
-                q_id = key[1:]  # Извлекаем номер вопроса
-                user_answers[q_id] = value[0] if len(value) == 1 else value
-
+        user_answers = collect_answers(request.form.lists())
         score, results = calculate_score(user_answers, test.questions)
 
         # Проверяем, не проходил ли пользователь уже этот тест
         existing_progress = UserProgress.query.filter_by(user_id=user.id, test_id=test.id).first()
+        previous_score = existing_progress.score if existing_progress else None
         
-        if not existing_progress:
+        # Запрос пишет только попытку и событие; награды, достижения, задания и серии
+        # обрабатывает очередь. Повторная отправка той же формы события не создает
+        accepted = outbox.enqueue('test_graded', {
+            'user_id': user.id, 'test_id': test.id, 'score': score,
+            'first_attempt': existing_progress is None, 'previous_score': previous_score,
+        }, submission_key(user.id, test.id, request.form.get('submission_id')))
+        
+        title_reward = None
+        if not accepted:
+            flash('Эти ответы уже были приняты.', 'info')
+        elif not existing_progress:
             # Награждаем только при первом прохождении
-            progress = UserProgress(
+            db.session.add(UserProgress(
                 user_id=user.id,
                 test_id=test.id,
                 score=score,
                 completed_at=datetime.utcnow()
-            )
-            db.session.add(progress)
-            
-            # Выдаем награды
-            user.add_xp(test.xp_reward)
-            user.add_coins(test.coin_reward)
-            
-            title_reward = None
-            if test.title_reward:
-                if user.add_title(test.title_reward):
-                    title_reward = test.title_reward
-                    flash(f"Вы получили новый титул: {TITLES.get(test.title_reward, {}).get('name', '')}!", "success")
-            
-            db.session.commit()
+            ))
+            if test.title_reward and not user.has_title(test.title_reward):
+                title_reward = test.title_reward
+                flash(f"Вы получили новый титул: {TITLES.get(test.title_reward, {}).get('name', '')}!", "success")
         else:
             # Обновляем результат, но не награждаем
             existing_progress.score = score
             existing_progress.completed_at = datetime.utcnow()
-            title_reward = None
-            db.session.commit()
+        db.session.commit()
+        outbox.notify()
 
         return render_template('test_result.html', 
                             test=test, 
@@ -2581,21 +4780,50 @@ def test(test_id):
                             coin_reward=0 if existing_progress else test.coin_reward,
                             title_reward=title_reward)
 
-    # Парсим контент теста
-    parser = TestLanguageParser(test.content)
-    return render_template('test.html', test=test, parsed={
+    content_hash = hashlib.sha1((test.content or '').encode()).hexdigest()
+    cached = not_modified('test', test.id, test.title, test.description, content_hash,
+                          fragment_cache.version('tests'), user_state(user), last_modified=test.updated_at)
+    if cached:
+        return cached
+    
+    return render_template('test.html', test=test, parsed=parse_test_page(test.content))
+
+PARSED_TESTS_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=PARSED_TESTS_CACHE_SIZE)
+@timed_stage('parse_test')
+def parse_test_page(content):
+    # Ключ — сам текст теста: после правки теста старая запись просто вытесняется
+    parser = TestLanguageParser(content)
+    return {
         'title': parser.metadata['title'],
         'description': parser.metadata.get('description', ''),
         'rules': parser.rules,
         'figures': [render_figure(fig) for fig in parser.rules if isinstance(fig, dict)],
         'questions': parser.questions
-    })
+    }
 
-@app.route('/calculator')
+@on_warm_up
+def warm_tests():
+    # Новые тесты открывают чаще всего; разбирается не больше, чем помещается в кэш
+    contents = db.session.scalars(
+        db.select(Test.content).where(Test.content.isnot(None)).order_by(Test.id.desc()).limit(PARSED_TESTS_CACHE_SIZE)
+    )
+    parsed = 0
+    for content in contents:
+        try:
+            parse_test_page(content)
+            parsed += 1
+        except ValueError:
+            # Сломанный тест покажет ошибку при открытии, прогрев из-за него не прерывается
+            continue
+    return parsed
+
+@route('/calculator')
 def calculator():
     return render_template('calculator.html')
 
-@app.route('/api/calculate', methods=['POST'])
+@route('/api/calculate', methods=['POST'])
 def api_calculate():
     data = request.get_json()
     try:
@@ -2614,15 +4842,67 @@ def api_calculate():
         return jsonify({'error': str(e)}), 400
 
 # Админ-маршруты
-@app.route('/admin')
+@route('/admin')
 @admin_required
+@query_budget(7)
 def admin_panel():
     users = User.query.order_by(User.created_at.desc()).all()
     tests = Test.query.order_by(Test.id.desc()).all()
     shop_items = ShopItem.query.all()
-    return render_template('admin.html', users=users, tests=tests, shop_items=shop_items)
+    owner_counts = item_owner_counts()
+    daily_stats = DailyStats.query.order_by(DailyStats.day.desc()).limit(14).all()
+    job_runs = JobRun.query.order_by(JobRun.started_at.desc()).limit(20).all()
+    return render_template('admin.html', users=users, tests=tests, shop_items=shop_items, owner_counts=owner_counts,
+                           daily_stats=daily_stats, job_runs=job_runs, route_metrics=metrics.summary()[:15],
+                           profiler_control=profiler.control(), profiler_routes=sorted(current_app.view_functions),
+                           now=time.time())
+
+@route('/admin/profiler', methods=['POST'])
+@admin_required
+def admin_profiler():
+    if request.form.get('action') == 'stop':
+        profiler.stop()
+        flash('Профилирование остановлено.', 'info')
+        return redirect(url_for('admin_panel'))
+    try:
+        rate = float(request.form.get('percent', 10)) / 100
+        duration = int(request.form.get('duration', 60))
+        route_name = request.form.get('route') or None
+        if route_name and route_name not in current_app.view_functions:
+            raise ValueError(f'Unknown route: {route_name}')
+        profiler.start(rate, route_name, duration)
+        flash(f'Профилирование запущено на {duration} с.', 'success')
+    except ValueError as e:
+        flash(f'Ошибка профилировщика: {e}', 'danger')
+    return redirect(url_for('admin_panel'))
 
-@app.route('/admin/create_test', methods=['GET', 'POST'])
+@route('/admin/profiler/stacks')
+@admin_required
+def admin_profiler_stacks():
+    # Свернутые стеки: flamegraph.pl profile.folded > profile.svg или speedscope.app
+    control = profiler.control()
+    if not control or not control.get('id'):
+        flash('Профилирование еще не запускалось.', 'warning')
+        return redirect(url_for('admin_panel'))
+    return profiler.collapsed(control['id']), 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Disposition': f"attachment; filename=profile-{control['id']}.folded",
+    }
+
+@route('/admin/metrics')
+@query_budget(1)
+def admin_metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if not (token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')):
+        user = get_current_user()
+        if not user or not user.is_admin:
+            return 'Forbidden\n', 403, {'Content-Type': 'text/plain; charset=utf-8'}
+    gauges = [('live_subscribers', 'gauge', live_rankings.subscribers),
+              ('compress_cache_hits_total', 'counter', compressed_bodies.hits),
+              ('compress_cache_misses_total', 'counter', compressed_bodies.misses)]
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@route('/admin/create_test', methods=['GET', 'POST'])
 @admin_required
 def create_test():
     if request.method == 'POST':
@@ -2672,6 +4952,7 @@ def create_test():
                 db.session.add(q)
             
             db.session.commit()
+            fragment_cache.bump('tests')
             flash('Тест успешно создан!', 'success')
             return redirect(url_for('admin_panel'))
             
@@ -2682,7 +4963,7 @@ def create_test():
     
     return render_template('create_test.html')
 
-@app.route('/admin/edit_test/<int:test_id>', methods=['GET', 'POST'])
+@route('/admin/edit_test/<int:test_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_test(test_id):
     test = Test.query.get_or_404(test_id)
@@ -2732,6 +5013,7 @@ def edit_test(test_id):
                 db.session.add(q)
             
             db.session.commit()
+            fragment_cache.bump('tests')
             flash('Тест успешно обновлен!', 'success')
             return redirect(url_for('admin_panel'))
             
@@ -2742,16 +5024,17 @@ def edit_test(test_id):
     
     return render_template('edit_test.html', test=test)
 
-@app.route('/admin/delete_test/<int:test_id>', methods=['POST'])
+@route('/admin/delete_test/<int:test_id>', methods=['POST'])
 @admin_required
 def delete_test(test_id):
     test = Test.query.get_or_404(test_id)
     db.session.delete(test)
     db.session.commit()
+    fragment_cache.bump('tests')
     flash('Тест успешно удален!', 'success')
     return redirect(url_for('admin_panel'))
 
-@app.route('/admin/toggle_admin/<int:user_id>', methods=['POST'])
+@route('/admin/toggle_admin/<int:user_id>', methods=['POST'])
 @admin_required
 def toggle_admin(user_id):
     user = User.query.get_or_404(user_id)
@@ -2760,16 +5043,25 @@ def toggle_admin(user_id):
     flash(f'Права администратора для {user.username} {"выданы" if user.is_admin else "отозваны"}', 'success')
     return redirect(url_for('admin_panel'))
 
-@app.route('/admin/delete_user/<int:user_id>', methods=['POST'])
+@route('/admin/delete_user/<int:user_id>', methods=['POST'])
 @admin_required
 def delete_user(user_id):
     user = User.query.get_or_404(user_id)
+    Friendship.query.filter(db.or_(Friendship.user_id == user.id, Friendship.friend_id == user.id)).delete(synchronize_session=False)
+    UserTitle.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    UserItem.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    XpEvent.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    XpDaily.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    UserCounter.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    UserStreak.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    UserAchievement.query.filter_by(user_id=user.id).delete(synchronize_session=False)
     db.session.delete(user)
     db.session.commit()
+    leaderboards.remove_user(user_id)
     flash(f'Пользователь {user.username} удален', 'success')
     return redirect(url_for('admin_panel'))
 
-@app.route('/admin/reset_password/<int:user_id>', methods=['POST'])
+@route('/admin/reset_password/<int:user_id>', methods=['POST'])
 @admin_required
 def reset_password(user_id):
     user = User.query.get_or_404(user_id)
@@ -2779,7 +5071,7 @@ def reset_password(user_id):
     flash(f'Пароль для {user.username} сброшен на "123456"', 'success')
     return redirect(url_for('admin_panel'))
 
-@app.route('/admin/create_shop_item', methods=['GET', 'POST'])
+@route('/admin/create_shop_item', methods=['GET', 'POST'])
 @admin_required
 def create_shop_item():
     if request.method == 'POST':
@@ -2810,6 +5102,7 @@ def create_shop_item():
             
             db.session.add(item)
             db.session.commit()
+            fragment_cache.bump('shop')
             flash('Товар успешно добавлен в магазин!', 'success')
             return redirect(url_for('admin_panel'))
             
@@ -2820,19 +5113,135 @@ def create_shop_item():
     
     return render_template('create_shop_item.html')
 
-@app.route('/admin/delete_shop_item/<int:item_id>', methods=['POST'])
+@route('/admin/delete_shop_item/<int:item_id>', methods=['POST'])
 @admin_required
 def delete_shop_item(item_id):
     item = ShopItem.query.get_or_404(item_id)
+    UserItem.query.filter_by(item_id=item.id).delete(synchronize_session=False)
     db.session.delete(item)
     db.session.commit()
+    fragment_cache.bump('shop')
     flash('Товар успешно удален из магазина!', 'success')
     return redirect(url_for('admin_panel'))
 
 # Инициализация базы данных
-def init_db():
-    with app.app_context():
+def migrate_friendships():
+    # Переносим JSON-списки друзей и запросов в таблицу friendship.
+    # Повторный запуск безопасен: INSERT OR IGNORE и очистка перенесенных колонок
+    users = User.query.filter(db.or_(
+        db.and_(User.friends.isnot(None), User.friends != '[]'),
+        db.and_(User.friend_requests.isnot(None), User.friend_requests != '[]')
+    )).all()
+    edges = []
+    for user in users:
+        try:
+            friend_ids = json.loads(user.friends or '[]')
+        except json.JSONDecodeError:
+            friend_ids = []
+        try:
+            request_ids = json.loads(user.friend_requests or '[]')
+        except json.JSONDecodeError:
+            request_ids = []
+        now = datetime.utcnow()
+        edges.extend({'user_id': user.id, 'friend_id': fid, 'status': FRIENDSHIP_ACCEPTED, 'created_at': now}
+                     for fid in friend_ids if fid != user.id)
+        edges.extend({'user_id': rid, 'friend_id': user.id, 'status': FRIENDSHIP_PENDING, 'created_at': now}
+                     for rid in request_ids if rid != user.id)
+        user.friends = '[]'
+        user.friend_requests = '[]'
+    if edges:
+        db.session.execute(db.insert(Friendship.__table__).prefix_with('OR IGNORE'), edges)
+    db.session.commit()
+    return len(edges)
+
+def migrate_titles_and_inventory():
+    # Переносим JSON-списки титулов и предметов в таблицы user_title и user_item
+    users = User.query.filter(db.or_(
+        db.and_(User.titles.isnot(None), User.titles != '[]'),
+        db.and_(User.inventory.isnot(None), User.inventory != '[]')
+    )).all()
+    existing_items = {item_id for (item_id,) in db.session.query(ShopItem.id)}
+    titles, items = [], []
+    for user in users:
+        try:
+            title_ids = json.loads(user.titles or '[]')
+        except json.JSONDecodeError:
+            title_ids = []
+        try:
+            item_ids = json.loads(user.inventory or '[]')
+        except json.JSONDecodeError:
+            item_ids = []
+        now = datetime.utcnow()
+        titles.extend({'user_id': user.id, 'title_id': tid, 'acquired_at': now} for tid in title_ids)
+        items.extend({'user_id': user.id, 'item_id': iid, 'acquired_at': now} for iid in item_ids if iid in existing_items)
+        user.titles = '[]'
+        user.inventory = '[]'
+    if titles:
+        db.session.execute(db.insert(UserTitle.__table__).prefix_with('OR IGNORE'), titles)
+    if items:
+        db.session.execute(db.insert(UserItem.__table__).prefix_with('OR IGNORE'), items)
+    db.session.commit()
+    return len(titles) + len(items)
+
+def ensure_columns():
+    # create_all не добавляет и новые столбцы; недостающие добавляются как NULL-столбцы
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+
+def ensure_indexes():
+    # create_all не добавляет индексы в уже существующие таблицы
+    dedupe_rows('user_achievement', 'user_id', 'achievement_id')
+    dedupe_rows('user_daily_task', 'user_id', 'task_id')
+    dedupe_rows('user_streak', 'user_id')
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def dedupe_rows(table, *columns):
+    # Старые базы могли накопить повторяющиеся строки, которые мешают уникальному индексу
+    group_by = ', '.join(columns)
+    db.session.execute(db.text(
+        f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {group_by})"))
+    db.session.commit()
+
+def backfill_achievement_counters():
+    # Счетчики для уже существующей истории и выдача пройденных порогов — множественными запросами
+    db.session.execute(db.text(
+        "UPDATE user_progress SET perfect = 1 WHERE perfect IS NULL AND score >= 100"))
+    db.session.execute(db.text(
+        "INSERT OR IGNORE INTO user_counter (user_id, name, value) "
+        "SELECT user_id, 'test_completed', COUNT(DISTINCT test_id) FROM user_progress "
+        "WHERE user_id IS NOT NULL GROUP BY user_id"))
+    db.session.execute(db.text(
+        "INSERT OR IGNORE INTO user_counter (user_id, name, value) "
+        "SELECT user_id, 'perfect_score', COUNT(DISTINCT test_id) FROM user_progress "
+        "WHERE user_id IS NOT NULL AND score >= 100 GROUP BY user_id"))
+    db.session.execute(db.text(
+        "INSERT OR IGNORE INTO user_counter (user_id, name, value) "
+        "SELECT user_id, 'purchase', COUNT(*) FROM user_item GROUP BY user_id"))
+    db.session.execute(db.text(
+        "INSERT OR IGNORE INTO user_achievement (user_id, achievement_id, earned_at, progress) "
+        "SELECT c.user_id, a.id, :now, a.condition_value FROM achievement a "
+        "JOIN user_counter c ON c.name = a.condition_type AND c.value >= a.condition_value"),
+        {'now': datetime.utcnow()})
+    db.session.commit()
+
+def init_db(app=None):
+    with (app or get_app()).app_context():
         db.create_all()
+        ensure_columns()
+        ensure_indexes()
+        migrate_friendships()
+        migrate_titles_and_inventory()
+        streak_engine.rebuild()
 
         if not User.query.first():
             # Создаем администратора
@@ -2842,9 +5251,8 @@ def init_db():
             is_admin=True,
             xp=1000,
             level=10,
-            coins=500,
-            titles=json.dumps(list(range(1, 11)))  # Первые 10 титулов
-)# Первые 10 титулов
+            coins=500
+            )
             admin.set_password('admin123')
             db.session.add(admin)
 
@@ -2854,10 +5262,14 @@ def init_db():
                 email='user@math.ru',
                 xp=250,
                 level=3,
-                coins=100,
-                titles=json.dumps([1, 2, 4]))  # Новичок, Математик, Геометр
+                coins=100)
             user.set_password('user123')
             db.session.add(user)
+            db.session.flush()
+
+            # Первые 10 титулов администратору; Новичок, Математик, Геометр — пользователю
+            db.session.add_all([UserTitle(user_id=admin.id, title_id=tid) for tid in range(1, 11)])
+            db.session.add_all([UserTitle(user_id=user.id, title_id=tid) for tid in (1, 2, 4)])
 
             # Пример теста по геометрии
             geometry_test_content = """
@@ -2982,8 +5394,23 @@ def init_db():
             ]
             db.session.add_all(progress)
 
+            # Достижения
+            db.session.add_all([
+                Achievement(name='Первый шаг', description='Пройдите первый тест', condition_type='test_completed', condition_value=1, xp_reward=10, coin_reward=5),
+                Achievement(name='Усердный ученик', description='Пройдите 5 тестов', condition_type='test_completed', condition_value=5, xp_reward=30, coin_reward=15),
+                Achievement(name='Знаток', description='Пройдите 10 тестов', condition_type='test_completed', condition_value=10, xp_reward=60, coin_reward=30),
+                Achievement(name='Без ошибок', description='Получите 100% в тесте', condition_type='perfect_score', condition_value=1, xp_reward=20, coin_reward=10),
+                Achievement(name='Перфекционист', description='Получите 100% в 5 тестах', condition_type='perfect_score', condition_value=5, xp_reward=50, coin_reward=25),
+                Achievement(name='Три дня подряд', description='Занимайтесь 3 дня подряд', condition_type='streak', condition_value=3, xp_reward=15, coin_reward=10),
+                Achievement(name='Неделя занятий', description='Занимайтесь 7 дней подряд', condition_type='streak', condition_value=7, xp_reward=40, coin_reward=20),
+                Achievement(name='Первая покупка', description='Купите предмет в магазине', condition_type='purchase', condition_value=1, xp_reward=5, coin_reward=0),
+            ])
+
             db.session.commit()
 
+        backfill_achievement_counters()
+        achievement_engine.invalidate()
+
 class SimpleTestParser:
     def __init__(self, content):
         if not content or not isinstance(content, str):
@@ -3188,98 +5615,66 @@ class SimpleTestParser:
             print(f"Ошибка при разборе фигуры: {e}")
             return None
 
-@app.route('/achievements')
+@route('/achievements')
 @login_required
+@query_budget(5)
 def achievements():
     user = get_current_user()
-    user_achievements = UserAchievement.query.filter_by(user_id=user.id).all()
+    # Только готовые данные: выданные достижения и счетчики, которые ведет AchievementEngine
+    earned = {ua.achievement_id: ua for ua in UserAchievement.query.filter_by(user_id=user.id)}
+    counters = achievement_engine.counters(user.id)
     all_achievements = Achievement.query.all()
     
     # Группируем достижения по категориям
-    achievements_by_category = {
-        'test_completed': [],
-        'perfect_score': [],
-        'streak': [],
-        'other': []
-    }
+    achievements_by_category = {category: [] for category in ACHIEVEMENT_CATEGORIES}
     
     for achievement in all_achievements:
-        user_achievement = next((ua for ua in user_achievements if ua.achievement_id == achievement.id), None)
-        category = achievement.condition_type.split('_')[0] if achievement.condition_type else 'other'
+        category = achievement.condition_type if achievement.condition_type in achievements_by_category else 'other'
         achievements_by_category[category].append({
             'achievement': achievement,
-            'user_progress': user_achievement
+            'user_progress': earned.get(achievement.id),
+            'progress': min(counters.get(achievement.condition_type, 0), achievement.condition_value or 0)
         })
     
     return render_template('achievements.html', 
                          achievements_by_category=achievements_by_category,
+                         tests_completed=counters.get('test_completed', 0),
                          current_user=user)
 
-@app.route('/daily_tasks')
+@route('/daily_tasks')
 @login_required
+@query_budget(5)
 def daily_tasks():
     user = get_current_user()
-    today = datetime.utcnow().date()
     
-    # Получаем активные задания
-    active_tasks = DailyTask.query.filter_by(active=True).all()
-    user_tasks = UserDailyTask.query.filter_by(user_id=user.id).all()
-    
-    # Обновляем прогресс
-    for task in active_tasks:
-        user_task = next((ut for ut in user_tasks if ut.task_id == task.id), None)
-        if not user_task:
-            user_task = UserDailyTask(user_id=user.id, task_id=task.id)
-            db.session.add(user_task)
-        
-        # Проверяем прогресс
-        if task.task_type == 'complete_test':
-            progress = UserProgress.query.filter_by(user_id=user.id).count()
-        elif task.task_type == 'get_perfect_score':
-            progress = UserProgress.query.filter_by(user_id=user.id, score=100).count()
-        elif task.task_type == 'earn_xp':
-            progress = user.xp
-        else:
-            progress = 0
-        
-        user_task.progress = progress
-        if progress >= task.task_value and not user_task.completed_at:
-            user_task.completed_at = datetime.utcnow()
-            user.add_xp(task.xp_reward)
-            user.add_coins(task.coin_reward)
-            flash(f'Задание выполнено! Получено {task.xp_reward} XP и {task.coin_reward} монет.', 'success')
-    
-    db.session.commit()
-    
-    # Обновляем список заданий
-    user_tasks = UserDailyTask.query.filter_by(user_id=user.id).all()
+    # Прогресс ведут события прохождения тестов и начисления опыта — здесь только одно чтение.
+    # Строки прошлых дней, которые планировщик еще не сбросил, показываются как пустые
+    tasks = db.session.query(DailyTask, UserDailyTask).outerjoin(
+        UserDailyTask, db.and_(UserDailyTask.task_id == DailyTask.id, UserDailyTask.user_id == user.id,
+                               UserDailyTask.day == datetime.utcnow().date())
+    ).filter(DailyTask.active.is_(True)).order_by(DailyTask.id).all()
     
     return render_template('daily_tasks.html',
-                         active_tasks=active_tasks,
-                         user_tasks=user_tasks,
+                         tasks=tasks,
                          current_user=user)
 
-@app.route('/friends')
+@route('/friends')
 @login_required
+@query_budget(5)
 def friends():
     user = get_current_user()
     
-    try:
-        friend_ids = json.loads(user.friends)
-        request_ids = json.loads(user.friend_requests)
-    except json.JSONDecodeError:
-        friend_ids = []
-        request_ids = []
-    
-    friends = User.query.filter(User.id.in_(friend_ids)).all()
-    requests = User.query.filter(User.id.in_(request_ids)).all()
+    friends = user.get_friends()
+    requests = user.get_friend_requests()
+    friends_ranking = friends_leaderboards.get(user.id)
     
     return render_template('friends.html',
                          friends=friends,
                          requests=requests,
+                         friends_ranking=friends_ranking,
                          current_user=user)
 
-@app.route('/add_friend/<int:user_id>', methods=['POST'])
+@route('/add_friend/<int:user_id>', methods=['POST'])
 @login_required
 def add_friend(user_id):
     user = get_current_user()
@@ -3292,43 +5687,218 @@ def add_friend(user_id):
     
     return redirect(url_for('friends'))
 
-@app.route('/accept_friend/<int:user_id>', methods=['POST'])
+@route('/accept_friend/<int:user_id>', methods=['POST'])
 @login_required
 def accept_friend(user_id):
     user = get_current_user()
     friend = User.query.get_or_404(user_id)
     
-    try:
-        requests = json.loads(user.friend_requests)
-        if user_id in requests:
-            requests.remove(user_id)
-            user.friend_requests = json.dumps(requests)
-            user.add_friend(user_id)
-            friend.add_friend(user.id)
-            flash(f'Вы теперь друзья с {friend.username}', 'success')
-        else:
-            flash('Запрос в друзья не найден', 'warning')
-    except json.JSONDecodeError:
-        flash('Ошибка при обработке запроса', 'danger')
+    request_edge = Friendship.query.filter_by(user_id=user_id, friend_id=user.id, status=FRIENDSHIP_PENDING).first()
+    if request_edge:
+        request_edge.status = FRIENDSHIP_ACCEPTED
+        user.add_friend(user_id)
+        friends_leaderboards.invalidate(user.id)
+        friends_leaderboards.invalidate(user_id)
+        flash(f'Вы теперь друзья с {friend.username}', 'success')
+    else:
+        flash('Запрос в друзья не найден', 'warning')
     
     return redirect(url_for('friends'))
 
-@app.route('/leaderboard')
+@route('/leaderboard')
+@query_budget(3)
 def leaderboard():
-    # Получаем топ-10 пользователей по XP
-    top_users = User.query.order_by(User.xp.desc()).limit(10).all()
+    # Топ-10 берется из рейтингов в памяти, без сортировки таблицы User;
+    # списки вычисляются в шаблоне и только при промахе кэша фрагментов
+    top_users = lambda: leaderboards.top('xp')
+    top_levels = lambda: leaderboards.top('level')
+    top_coins = lambda: leaderboards.top('coins')
     
-    # Получаем топ-10 пользователей по уровню
-    top_levels = User.query.order_by(User.level.desc(), User.xp.desc()).limit(10).all()
+    # Место текущего пользователя и его соседи по каждому рейтингу
+    my_ranks = {}
+    user = get_current_user()
+    if user:
+        radius = min(max(request.args.get('radius', 2, type=int), 0), MAX_RANK_RADIUS)
+        for board in Leaderboard.BOARDS:
+            rank, neighbors = leaderboards.around(board, user.id, radius)
+            if rank:
+                my_ranks[board] = {'rank': rank, 'neighbors': neighbors}
     
-    # Получаем топ-10 пользователей по монетам
-    top_coins = User.query.order_by(User.coins.desc()).limit(10).all()
+    period_day = datetime.utcnow().date().isoformat()
+    total_players = leaderboards.total('xp')
+    cached = not_modified('leaderboard', fragment_cache.version('leaderboard'),
+                          fragment_cache.version('leaderboard_period'), period_day, total_players,
+                          repr(my_ranks), user_state(user))
+    if cached:
+        return cached
     
     return render_template('leaderboard.html',
                          top_users=top_users,
                          top_levels=top_levels,
-                         top_coins=top_coins)
+                         top_coins=top_coins,
+                         my_ranks=my_ranks,
+                         total_players=total_players,
+                         period_day=period_day,
+                         top_day=lambda: windowed_leaderboards.top('day'),
+                         top_week=lambda: windowed_leaderboards.top('week'),
+                         top_month=lambda: windowed_leaderboards.top('month'))
+
+@route('/leaderboard/stream')
+@query_budget(0)
+def leaderboard_stream():
+    # Server-Sent Events: изменения топов и место текущего пользователя. На 204 браузер не
+    # переподключается, и страница остается статичной
+    stream = live_rankings.stream(session.get('user_id'), request.headers.get('Last-Event-ID'),
+                                  limit=current_app.config['LIVE_SYNC_STREAMS'])
+    if stream is None:
+        return '', 204
+    try:
+        live_rankings.start()
+    except Exception:
+        stream.close()
+        raise
+
+    def generate():
+        # Выполняется после выхода из контекста запроса: читает только рейтинги в памяти
+        try:
+            while True:
+                chunk = stream.next_chunk()
+                if chunk:
+                    yield chunk
+                stream.hub.wait(stream.version, LiveRankings.ME_INTERVAL)
+        finally:
+            stream.close()
+
+    return current_app.response_class(generate(), mimetype='text/event-stream', headers=LiveRankings.HEADERS)
+
+@route('/api/rank/<board>/<int:user_id>')
+def api_rank(board, user_id):
+    if board not in Leaderboard.BOARDS:
+        return jsonify({'error': f'Unknown board: {board}'}), 404
+    radius = min(max(request.args.get('radius', 2, type=int), 0), MAX_RANK_RADIUS)
+    rank, neighbors = leaderboards.around(board, user_id, radius)
+    if rank is None:
+        return jsonify({'error': 'User not found'}), 404
+    return jsonify({
+        'board': board,
+        'user_id': user_id,
+        'rank': rank,
+        'total': leaderboards.total(board),
+        'neighbors': [{'rank': r, **u} for r, u in neighbors]
+    })
+
+# Фабрика приложения
+class AppState:
+    # Подсистемы одного приложения, app.extensions['math_site']. Второе приложение в том же
+    # процессе (тесты, несколько баз) получает свои рейтинги, кэши и потоки
+    def __init__(self, config):
+        self.metrics = Metrics()
+        self.profiler = RequestProfiler(config['PROFILER_DIR'])
+        self.compressed_bodies = CompressedBodyCache(config['COMPRESS_CACHE_BYTES'])
+        self.fragment_cache = FragmentCache(make_cache_backend(config['FRAGMENT_CACHE_URL']))
+        self.leaderboards = Leaderboard(config['RANKINGS_MAX_AGE'])
+        self.windowed_leaderboards = WindowedLeaderboard(config['RANKINGS_MAX_AGE'])
+        self.friends_leaderboards = FriendsLeaderboardCache()
+        self.live_rankings = LiveRankings(self.leaderboards, self.windowed_leaderboards)
+        self.achievement_engine = AchievementEngine()
+        self.scheduler = Scheduler(SCHEDULED_JOBS)
+        self.outbox = Outbox(OUTBOX_HANDLERS)
+
+    def stop(self):
+        # Останавливает потоки приложения; начатая работа дописывается, новая не берется
+        self.scheduler.stop()
+        self.outbox.stop()
+        self.live_rankings.stop()
+
+def app_state(app):
+    return app.extensions['math_site']
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+    if app.config['TEMPLATE_CACHE_DIR'] is None:
+        app.config['TEMPLATE_CACHE_DIR'] = os.path.join(app.instance_path, 'template_cache')
+    if app.config['PROFILER_DIR'] is None:
+        app.config['PROFILER_DIR'] = os.path.join(app.instance_path, 'profiler')
+
+    db.init_app(app)
+    if app.config['MIGRATE_ENABLED']:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    state = app.extensions['math_site'] = AppState(app.config)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Шаблоны компилируются лениво при первом рендеринге или заранее в warm_up
+    app.jinja_loader = DictLoader(TEMPLATES)
+    if app.config['TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+    app.jinja_env.globals.update(json=json, math=math, cache_fragment=state.fragment_cache.render, asset_url=asset_url)
+    app.extensions['asset_manifest'] = load_asset_manifest(app)
+    app.extensions['build_id'] = build_id(app.extensions['asset_manifest'])
+
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.context_processor(inject_user)
+    state.metrics.add_routes(app.view_functions)
+    app.before_request(start_request_timer)
+    app.before_request(state.profiler.begin)
+    before_render_template.connect(start_template_timer, app)
+    template_rendered.connect(stop_template_timer, app)
+    app.teardown_request(state.profiler.end)
+    app.teardown_request(record_request)
+    # after_request выполняются в обратном порядке: валидаторы, сжатие, бюджет запросов и статус для метрик
+    app.after_request(remember_status)
+    app.after_request(check_query_budget)
+    app.after_request(compress_response)
+    app.after_request(add_validators)
+    app.cli.add_command(worker_command)
+    app.cli.add_command(compile_templates_command)
+    return app
+
+@on_warm_up
+def warm_rankings():
+    leaderboards.ensure_loaded()
+    windowed_leaderboards.ensure_loaded()
+    achievement_engine.load()
+
+def warm_up(app):
+    # Вызывается до приема запросов (и до fork в серверах с preload): заполняет кэши,
+    # которые иначе заполнил бы первый запрос. Возвращает время каждого шага в мс
+    timings = {}
+    with app.app_context():
+        for hook in WARMUP_HOOKS:
+            started = time.perf_counter()
+            hook()
+            timings[hook.__name__] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+def get_app():
+    # Приложение с настройками по умолчанию создается при первом обращении к app1.app
+    global _default_app
+    if _default_app is None:
+        with _default_app_lock:
+            if _default_app is None:
+                _default_app = create_app()
+    return _default_app
+
+def __getattr__(name):
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-    init_db()
+    app = create_app()
+    init_db(app)
+    # Перезагрузчик отладки запускает код дважды: родитель только следит за файлами, поэтому
+    # прогрев и планировщик нужны лишь в рабочем процессе
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up(app)
+        if app.config['SCHEDULER_ENABLED']:
+            app_state(app).scheduler.start(app)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
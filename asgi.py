@@ -0,0 +1,278 @@
+# Асинхронный запуск (ASGI) для маршрутов, которые в основном ждут: калькулятор, рейтинг и
+# отправка теста. Остальные маршруты обслуживает то же Flask-приложение в пуле потоков.
+#
+#   python asgi.py --bind 127.0.0.1:8000
+#   uvicorn asgi:app --port 8000
+#
+# Нужны starlette, uvicorn, aiosqlite и a2wsgi: pip install starlette uvicorn aiosqlite a2wsgi
+#
+# Модели и база те же: асинхронный движок SQLAlchemy строится из URL синхронного с драйвером
+# aiosqlite (asyncpg для PostgreSQL). Асинхронный обработчик выполняется в контексте запроса
+# Flask, собранном из ASGI-запроса, поэтому шаблоны, сессия, flash, ETag и сжатие работают
+# как в app1; база в этом контексте доступна только через асинхронную сессию.
+# /leaderboard и /api/calculate берут данные из памяти, и их синхронные view вызываются прямо
+# в цикле событий, когда пользователь уже загружен асинхронно. Поток занимают только чтение
+# рейтингов из базы (раз в RANKINGS_MAX_AGE) и маршруты Flask.
+#
+# bench_async.py, 1 ядро, 8 потоков в обоих серверах, PSS одного процесса 90-125 МБ:
+#   клиентов   serve.py                 asgi.py
+#   16         283 rps, p95 107 мс      254 rps, p95 195 мс
+#   64         271 rps, p95 294 мс      242 rps, p95 773 мс
+#   256         86 rps, p95 4.1 c       302 rps, p95 4.1 c
+# При 256 клиентах калькулятор отвечает за 33 мс против 4.5 c: ему не нужен свободный поток.
+# Отправка теста упирается в блокировку записи SQLite, которую делят потоки очереди событий,
+# и асинхронность тут не помогает (p95 0.9 c против 0.3 c при 16 клиентах).
+#
+# Живой рейтинг (/leaderboard/stream): 500 подписчиков во время прохождения тестов (4 клиента,
+# 128 rps) получают по 2 обновления в секунду, а пропускная способность та же, что без них
+# (126 rps); RSS растет на 14 МБ. Топы считаются один раз на публикацию, а не на подписчика.
+import argparse
+import asyncio
+import sys
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+try:
+    from a2wsgi import WSGIMiddleware
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    from starlette.applications import Starlette
+    from starlette.responses import Response, StreamingResponse
+    from starlette.routing import Mount, Route
+except ImportError as e:
+    raise SystemExit(f'Для asgi.py нужны starlette, uvicorn, aiosqlite и a2wsgi ({e}): '
+                     'pip install starlette uvicorn aiosqlite a2wsgi')
+from flask import abort, flash, g, redirect, render_template, request as flask_request, session, url_for
+from sqlalchemy import exists, select, text
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+import app1
+from app1 import (LiveRankings, Question, Test, User, UserProgress, UserTitle, TITLES, calculate_score,
+                  collect_answers, live_rankings, outbox, submission_key)
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+DEFAULT_BIND = '127.0.0.1:8000'
+DEFAULT_WSGI_THREADS = 8
+DEFAULT_GRACEFUL_TIMEOUT = 30
+
+
+def async_url(flask_app):
+    # URL синхронного движка: относительный путь SQLite Flask-SQLAlchemy уже разрешил в instance
+    with flask_app.app_context():
+        url = app1.db.engine.url
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise ValueError(f'No async driver for {url.get_backend_name()}')
+    return url.set(drivername=driver)
+
+
+def flask_environ(request, body):
+    headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in request.headers.raw]
+    overrides = {'REMOTE_ADDR': request.client.host} if request.client else {}
+    return EnvironBuilder(path=request.url.path, base_url=f'{request.url.scheme}://{request.url.netloc}',
+                          query_string=request.url.query, method=request.method, headers=headers,
+                          data=body, environ_overrides=overrides).get_environ()
+
+
+def to_asgi(response):
+    # Заголовки переносятся списком: Set-Cookie может повторяться
+    result = Response(response.get_data(), status_code=response.status_code)
+    result.raw_headers = [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                          for key, value in response.headers.items()]
+    return result
+
+
+def flask_view(handler):
+    # Ответ обработчика проходит через before_request (таймер метрик), after_request приложения
+    # (ETag, сжатие) и сохранение сессии
+    async def endpoint(request):
+        flask_app = request.app.state.flask_app
+        body = await request.body()
+        with flask_app.request_context(flask_environ(request, body)):
+            try:
+                response = flask_app.make_response(flask_app.preprocess_request() or await handler(request))
+            except HTTPException as e:
+                response = e.get_response()
+            response = flask_app.process_response(response)
+        return to_asgi(response)
+    return endpoint
+
+
+async def load_user(db_session):
+    # То же, что get_current_user, но без синхронного запроса: view и шаблоны возьмут пользователя из g
+    if 'user_id' not in session:
+        return None
+    g.current_user = await db_session.get(User, session['user_id'])
+    return g.current_user
+
+
+def reload_rankings(flask_app):
+    with flask_app.app_context():
+        app1.leaderboards.ensure_loaded()
+        app1.windowed_leaderboards.ensure_loaded()
+
+
+def notify_outbox(flask_app):
+    with flask_app.app_context():
+        outbox.notify()
+
+
+@flask_view
+async def api_calculate(request):
+    return app1.api_calculate()
+
+
+@flask_view
+async def leaderboard(request):
+    async with request.app.state.sessions() as db_session:
+        await load_user(db_session)
+    if app1.leaderboards.is_stale() or app1.windowed_leaderboards.is_stale():
+        await asyncio.to_thread(reload_rankings, request.app.state.flask_app)
+    return app1.leaderboard()
+
+
+@flask_view
+async def submit_test(request):
+    # POST /test/<id> из app1.test: проверка ответов, попытка и событие очереди в одной транзакции
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    async with request.app.state.sessions() as db_session:
+        user = await load_user(db_session)
+        if user is None:
+            return redirect(url_for('login'))
+        test = await db_session.get(Test, request.path_params['test_id'])
+        if test is None:
+            abort(404)
+        questions = (await db_session.scalars(
+            select(Question).where(Question.test_id == test.id).order_by(Question.id))).all()
+        score, results = calculate_score(collect_answers(flask_request.form.lists()), questions)
+
+        existing_progress = await db_session.scalar(
+            select(UserProgress).filter_by(user_id=user.id, test_id=test.id).limit(1))
+        previous_score = existing_progress.score if existing_progress else None
+        # Все чтения до первой записи: между await транзакция держит блокировку записи SQLite
+        title_reward = None
+        if not existing_progress and test.title_reward and not await db_session.scalar(select(exists().where(
+                UserTitle.user_id == user.id, UserTitle.title_id == test.title_reward))):
+            title_reward = test.title_reward
+
+        result = await db_session.execute(outbox.insert_statement(), outbox.event_row('test_graded', {
+            'user_id': user.id, 'test_id': test.id, 'score': score,
+            'first_attempt': existing_progress is None, 'previous_score': previous_score,
+        }, submission_key(user.id, test.id, flask_request.form.get('submission_id'))))
+        if result.rowcount != 1:
+            title_reward = None
+            flash('Эти ответы уже были приняты.', 'info')
+        elif not existing_progress:
+            db_session.add(UserProgress(user_id=user.id, test_id=test.id, score=score,
+                                        completed_at=datetime.utcnow()))
+            if title_reward:
+                flash(f"Вы получили новый титул: {TITLES.get(title_reward, {}).get('name', '')}!", "success")
+        else:
+            existing_progress.score = score
+            existing_progress.completed_at = datetime.utcnow()
+        await db_session.commit()
+    await asyncio.to_thread(notify_outbox, request.app.state.flask_app)
+
+    return render_template('test_result.html',
+                           test=test,
+                           score=score,
+                           results=results,
+                           xp_reward=0 if existing_progress else test.xp_reward,
+                           coin_reward=0 if existing_progress else test.coin_reward,
+                           title_reward=title_reward)
+
+
+async def leaderboard_stream(request):
+    # /leaderboard/stream из app1 без ограничения числа подключений: ожидающий подписчик —
+    # это корутина, а не поток. Публикация будит все подписки цикла одним вызовом
+    with request.app.state.flask_app.request_context(flask_environ(request, b'')):
+        live_rankings.start()
+        stream = live_rankings.stream(session.get('user_id'), request.headers.get('last-event-id'))
+
+    async def chunks():
+        # Медленный клиент ждет в send: пока он ждет, версии уходят вперед, и он получит снимок
+        try:
+            while True:
+                chunk = stream.next_chunk()
+                if chunk:
+                    yield chunk
+                await stream.hub.wait_async(stream.version, LiveRankings.ME_INTERVAL)
+        finally:
+            stream.close()
+
+    return StreamingResponse(chunks(), media_type='text/event-stream', headers=LiveRankings.HEADERS)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    flask_app = app.state.flask_app
+    if app.state.engine.dialect.name == 'sqlite':
+        # Читатели в WAL не ждут писателя; режим сохраняется в файле базы
+        async with app.state.engine.connect() as conn:
+            await conn.execute(text('PRAGMA journal_mode=WAL'))
+    app1.warm_up(flask_app)
+    if flask_app.config['SCHEDULER_ENABLED']:
+        app1.app_state(flask_app).scheduler.start(flask_app)
+    yield
+    app1.app_state(flask_app).stop()
+    await app.state.engine.dispose()
+
+
+def create_asgi_app(config=None, wsgi_threads=DEFAULT_WSGI_THREADS):
+    flask_app = app1.create_app(config)
+    engine = create_async_engine(async_url(flask_app))
+    # GET /test/<id> не совпадает с асинхронным маршрутом по методу и уходит во Flask
+    app = Starlette(routes=[
+        Route('/api/calculate', api_calculate, methods=['POST']),
+        Route('/leaderboard', leaderboard, methods=['GET']),
+        Route('/leaderboard/stream', leaderboard_stream, methods=['GET']),
+        Route('/test/{test_id:int}', submit_test, methods=['POST']),
+        Mount('', app=WSGIMiddleware(flask_app, workers=wsgi_threads)),
+    ], lifespan=lifespan)
+    app.state.flask_app = flask_app
+    app.state.engine = engine
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    return app
+
+
+_default_app = None
+
+
+def __getattr__(name):
+    # uvicorn asgi:app — приложение с настройками по умолчанию создается при первом обращении
+    global _default_app
+    if name == 'app':
+        if _default_app is None:
+            _default_app = create_asgi_app()
+        return _default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Асинхронный запуск Math_site (ASGI)')
+    parser.add_argument('--bind', default=DEFAULT_BIND, help=f'адрес (по умолчанию {DEFAULT_BIND})')
+    parser.add_argument('--wsgi-threads', type=int, default=DEFAULT_WSGI_THREADS,
+                        help='потоков для маршрутов Flask')
+    parser.add_argument('--graceful-timeout', type=int, default=DEFAULT_GRACEFUL_TIMEOUT,
+                        help='сколько ждать текущие запросы при остановке; подключения живого рейтинга не завершаются сами')
+    parser.add_argument('--log-level', default='warning')
+    parser.add_argument('--access-log', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('Для asgi.py нужен uvicorn: pip install uvicorn')
+    host, _, port = args.bind.rpartition(':')
+    uvicorn.run(create_asgi_app(wsgi_threads=args.wsgi_threads), host=host or '127.0.0.1', port=int(port),
+                log_level=args.log_level, access_log=args.access_log,
+                timeout_graceful_shutdown=args.graceful_timeout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# Бенчмарк асинхронного запуска (asgi.py) против синхронного (serve.py) в одном процессе.
+#
+#   python bench_async.py --database sqlite:///bench.db --concurrency 16 64 256 --duration 20
+#
+# Оба сервера запускаются одним процессом, так что память примерно одинаковая: serve.py с
+# одним рабочим процессом и --threads потоков, asgi.py с циклом событий и тем же числом
+# потоков для маршрутов Flask. На каждом уровне одновременности loadtest.py гоняет
+# калькулятор, рейтинг и прохождение тестов (GET страницы идет во Flask, POST — в
+# асинхронный обработчик); после прогона снимается RSS и PSS сервера. Первые --warmup
+# секунд не учитываются: каждый виртуальный пользователь сначала входит, а проверка пароля
+# дорогая, и без прогрева высокие уровни меряли бы в основном вход.
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_serving import ROOT, children, free_port, memory_kb, wait_ready
+
+DEFAULT_MIX = 'calculate=30,leaderboard=40,take_test=30'
+SERVERS = ('sync', 'async')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк asgi.py против serve.py')
+    parser.add_argument('--database', help='URI базы (по умолчанию DATABASE_URL или sqlite:///site.db)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--threads', type=int, default=8, help='потоков синхронного сервера и пула Flask в asgi.py')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--warmup', type=float, default=20.0,
+                        help='секунды без учета: вход всех виртуальных пользователей (хэш пароля) занимает процессор')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--users', default='1-1000')
+    parser.add_argument('--test-ids', default='1-200')
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=list(SERVERS))
+    parser.add_argument('--output', help='файл для JSON-отчета (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+def server_command(kind, port, threads):
+    if kind == 'sync':
+        return [sys.executable, os.path.join(ROOT, 'serve.py'), '--bind', f'127.0.0.1:{port}',
+                '--workers', '1', '--threads', str(threads), '--max-requests', '0']
+    return [sys.executable, os.path.join(ROOT, 'asgi.py'), '--bind', f'127.0.0.1:{port}',
+            '--wsgi-threads', str(threads)]
+
+
+def process_memory(pid):
+    samples = [m for m in (memory_kb(p) for p in [pid] + children(pid)) if m]
+    return {
+        'rss_mb': round(sum(m['Rss'] for m in samples) / 1024, 1),
+        'pss_mb': round(sum(m['Pss'] for m in samples) / 1024, 1),
+    }
+
+
+def run_level(args, url, concurrency, env):
+    with tempfile.NamedTemporaryFile(suffix='.json') as report_file:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'loadtest.py'), '--mode', 'http', '--url', url,
+                        '--concurrency', str(concurrency), '--duration', str(args.duration),
+                        '--warmup', str(args.warmup), '--mix', args.mix,
+                        '--users', args.users, '--test-ids', args.test_ids, '--output', report_file.name],
+                       cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        with open(report_file.name, encoding='utf-8') as f:
+            report = json.load(f)
+    return report['total'], {route: stats['p95_ms'] for route, stats in report['routes'].items()}
+
+
+def run_server(args, kind, env):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen(server_command(kind, port, args.threads), cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_ready(url + '/', server)
+        idle = process_memory(server.pid)
+        for concurrency in args.concurrency:
+            total, routes_p95 = run_level(args, url, concurrency, env)
+            result = {
+                'concurrency': concurrency,
+                'rps': total['rps'],
+                'p50_ms': total['p50_ms'],
+                'p95_ms': total['p95_ms'],
+                'p99_ms': total['p99_ms'],
+                'error_rate': total['error_rate'],
+                'routes_p95_ms': routes_p95,
+                'memory': process_memory(server.pid),
+            }
+            print(f"{kind} x{concurrency}: {result['rps']} rps, p95 {result['p95_ms']} мс, "
+                  f"ошибки {result['error_rate']:.2%}, PSS {result['memory']['pss_mb']} МБ", file=sys.stderr)
+            results.append(result)
+            time.sleep(1)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+    return {'idle_memory': idle, 'levels': results}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    env = dict(os.environ)
+    if args.database:
+        env['DATABASE_URL'] = args.database
+    env['SCHEDULER_ENABLED'] = '0'
+    result = {'threads': args.threads, 'duration_s': args.duration, 'warmup_s': args.warmup, 'mix': args.mix}
+    for kind in args.servers:
+        result[kind] = run_server(args, kind, env)
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# Бенчмарк настроек serve.py: процессы, потоки и предзагрузка.
+#
+#   python bench_serving.py --database sqlite:///bench.db --duration 30 --concurrency 32
+#   python bench_serving.py --configs 1x4 2x2 4x1 --no-preload-too
+#
+# Для каждой конфигурации (процессы x потоки) запускается serve.py, прогоняется
+# loadtest.py в режиме http и снимается память мастера и рабочих процессов из
+# /proc/<pid>/smaps_rollup: PSS (доля с учетом общих страниц) и частные страницы, которые
+# процесс скопировал себе после fork. По умолчанию сравниваются ядра x 8 (рекомендация
+# serve.py), ядра x 4, ядра x 1, 2 x ядра + 1 процессов x 1 и ядра x 16. Несколько процессов
+# serve.py запускает только с общим кэшем фрагментов, поэтому такие конфигурации замеряются
+# с --fragment-cache-url redis://... (или FRAGMENT_CACHE_URL), а без него пропускаются.
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from app1 import is_shared_cache_url
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_config(value):
+    workers, _, threads = value.partition('x')
+    return int(workers), int(threads or 1)
+
+
+def default_configs():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    configs = [(cpus, 8), (cpus, 4), (cpus, 1), (2 * cpus + 1, 1), (cpus, 16)]
+    return list(dict.fromkeys(configs))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк настроек serve.py')
+    parser.add_argument('--database', help='URI базы (по умолчанию DATABASE_URL или sqlite:///site.db)')
+    parser.add_argument('--configs', nargs='+', type=parse_config, help='конфигурации вида 2x4 (процессы x потоки)')
+    parser.add_argument('--no-preload-too', action='store_true', help='повторить первую конфигурацию без предзагрузки')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mix', help='веса действий loadtest.py')
+    parser.add_argument('--fragment-cache-url', default=os.environ.get('FRAGMENT_CACHE_URL'),
+                        help='общий кэш фрагментов (redis://...) для конфигураций с несколькими процессами')
+    parser.add_argument('--users', default='1-1000')
+    parser.add_argument('--test-ids', default='1-200')
+    parser.add_argument('--output', help='файл для JSON-отчета (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'serve.py завершился с кодом {process.returncode}')
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.05)
+    raise SystemExit(f'{url} не ответил за {timeout} c')
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_kb(pid):
+    # Pss делит общие страницы между процессами; Private_* — страницы только этого процесса
+    values = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    values[key] = int(rest.split()[0])
+    except OSError:
+        return None
+    return values
+
+
+def memory_report(master_pid):
+    workers = [memory_kb(pid) for pid in children(master_pid)]
+    workers = [w for w in workers if w]
+    master = memory_kb(master_pid)
+    if not workers or not master:
+        return None
+    private = [w['Private_Clean'] + w['Private_Dirty'] for w in workers]
+    return {
+        'total_pss_mb': round((master['Pss'] + sum(w['Pss'] for w in workers)) / 1024, 1),
+        'worker_rss_mb': round(sum(w['Rss'] for w in workers) / len(workers) / 1024, 1),
+        'worker_private_mb': round(sum(private) / len(private) / 1024, 1),
+    }
+
+
+def run_config(args, workers, threads, preload, env):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    command = [sys.executable, os.path.join(ROOT, 'serve.py'), '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--threads', str(threads), '--max-requests', '0']
+    if args.fragment_cache_url:
+        command += ['--fragment-cache-url', args.fragment_cache_url]
+    if not preload:
+        command.append('--no-preload')
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(url + '/', server)
+        boot_s = time.perf_counter() - started
+        with tempfile.NamedTemporaryFile(suffix='.json') as report_file:
+            loadtest = [sys.executable, os.path.join(ROOT, 'loadtest.py'), '--mode', 'http', '--url', url,
+                        '--concurrency', str(args.concurrency), '--duration', str(args.duration),
+                        '--users', args.users, '--test-ids', args.test_ids, '--output', report_file.name]
+            if args.mix:
+                loadtest += ['--mix', args.mix]
+            subprocess.run(loadtest, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+            with open(report_file.name, encoding='utf-8') as f:
+                total = json.load(f)['total']
+        memory = memory_report(server.pid)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+    return {
+        'workers': workers,
+        'threads': threads,
+        'preload': preload,
+        'boot_s': round(boot_s, 2),
+        'rps': total['rps'],
+        'p50_ms': total['p50_ms'],
+        'p95_ms': total['p95_ms'],
+        'p99_ms': total['p99_ms'],
+        'error_rate': total['error_rate'],
+        'memory': memory,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    env = dict(os.environ)
+    if args.database:
+        env['DATABASE_URL'] = args.database
+    # Планировщик в замер не входит
+    env['SCHEDULER_ENABLED'] = '0'
+    configs = args.configs or default_configs()
+    if not is_shared_cache_url(args.fragment_cache_url):
+        skipped = [f'{workers}x{threads}' for workers, threads in configs if workers > 1]
+        if skipped:
+            print(f"Без --fragment-cache-url redis://... пропущены: {' '.join(skipped)}", file=sys.stderr)
+        configs = [(workers, threads) for workers, threads in configs if workers == 1]
+        if not configs:
+            raise SystemExit('Нет конфигураций для замера: для нескольких процессов нужен --fragment-cache-url')
+    runs = [(workers, threads, True) for workers, threads in configs]
+    if args.no_preload_too:
+        runs.append((configs[0][0], configs[0][1], False))
+    results = []
+    for workers, threads, preload in runs:
+        result = run_config(args, workers, threads, preload, env)
+        print(f"{workers}x{threads}{'' if preload else ' без предзагрузки'}: {result['rps']} rps, "
+              f"p95 {result['p95_ms']} мс", file=sys.stderr)
+        results.append(result)
+    output = json.dumps({'cpus': default_configs()[0][0], 'duration_s': args.duration,
+                         'concurrency': args.concurrency, 'results': results}, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+# Бенчмарк запуска: время импорта app1, create_app, прогрева и первых запросов.
+#
+#   python bench_startup.py --database sqlite:///bench.db --runs 5
+#
+# Каждый замер делается в новом интерпретаторе, чтобы импорт был холодным. Режим cold —
+# первые запросы идут сразу после create_app, режим warm — после warm_up(app), как
+# в сервере с preload. Отчет печатается в JSON (медиана и максимум по прогонам).
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATHS = ['/', '/tests', '/leaderboard']
+
+PROBE = r'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app1
+imported = time.perf_counter()
+app = app1.create_app({{'MIGRATE_ENABLED': False, 'SCHEDULER_ENABLED': False}})
+created = time.perf_counter()
+warm_up = app1.warm_up(app) if {warm!r} else {{}}
+warmed = time.perf_counter()
+client = app.test_client()
+first = {{}}
+for path in {paths!r}:
+    t = time.perf_counter()
+    status = client.get(path).status_code
+    first[path] = (time.perf_counter() - t) * 1000
+    if status >= 400:
+        raise SystemExit(f'{{path}} returned {{status}}')
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'warm_up_ms': (warmed - created) * 1000,
+    'warm_up_steps': warm_up,
+    'first_request_ms': first,
+    'time_to_first_response_ms': (warmed - started) * 1000 + first[{paths!r}[0]],
+}}))
+'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк запуска Math_site')
+    parser.add_argument('--database', help='URI базы (по умолчанию DATABASE_URL или sqlite:///site.db)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--output', help='файл для JSON-отчета (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+def probe(args, warm, env):
+    code = PROBE.format(root=ROOT, warm=warm, paths=args.paths)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, cwd=ROOT)
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {'median': round(statistics.median(samples), 1), 'max': round(max(samples), 1)}
+
+
+def report(runs):
+    summary = {key: summarize([run[key] for run in runs])
+               for key in ('import_ms', 'create_app_ms', 'warm_up_ms', 'time_to_first_response_ms')}
+    summary['first_request_ms'] = {path: summarize([run['first_request_ms'][path] for run in runs])
+                                   for path in runs[0]['first_request_ms']}
+    steps = runs[0]['warm_up_steps']
+    if steps:
+        summary['warm_up_steps'] = {step: summarize([run['warm_up_steps'][step] for run in runs]) for step in steps}
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    env = dict(os.environ)
+    if args.database:
+        env['DATABASE_URL'] = args.database
+    subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {ROOT!r}); import app1; app1.init_db()'],
+                   check=True, env=env, cwd=ROOT)
+    result = {'runs': args.runs, 'paths': args.paths}
+    for mode, warm in (('cold', False), ('warm', True)):
+        result[mode] = report([probe(args, warm, env) for _ in range(args.runs)])
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
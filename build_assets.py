@@ -0,0 +1,211 @@
+# Сборка статических ресурсов: вендоринг библиотек, отпечатки имен и предварительное сжатие.
+#
+# Один раз (нужен интернет) — скачать библиотеки в static/vendor и закоммитить их:
+#   python build_assets.py --fetch
+# При каждом деплое — собрать static/dist:
+#   python build_assets.py
+# Сборка завершается ошибкой, если каких-то библиотек из VENDOR_ASSETS нет в static/vendor:
+# иначе собранные страницы молча продолжали бы грузить их с CDN.
+#
+# Каждый файл из static/src и static/vendor копируется в static/dist под именем с хэшем
+# содержимого (base.css -> base.3f9a1c2e4b5d.css), ссылки url(...) в CSS переписываются
+# на такие же имена, рядом кладутся .gz и .br (если установлен пакет brotli).
+# static/dist/manifest.json сопоставляет исходное имя собранному; приложение раздает
+# эти файлы по /assets/ с Cache-Control: immutable.
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+import time
+import urllib.request
+from urllib.parse import urljoin, urlsplit
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC = os.path.join(ROOT, 'static')
+SOURCES = ['src', 'vendor']
+DIST = 'dist'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.ttf', '.eot'}
+MIN_COMPRESS_SIZE = 512
+HASH_LENGTH = 12
+# Google Fonts отдает woff2 только браузерам
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Сборка статических ресурсов Math_site')
+    parser.add_argument('--fetch', action='store_true', help='скачать сторонние библиотеки в static/vendor')
+    parser.add_argument('--no-build', action='store_true', help='не собирать static/dist')
+    return parser.parse_args(argv)
+
+
+def download(url):
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return response.read()
+
+
+def is_local_reference(ref):
+    return not ref.startswith(('data:', '#')) and not urlsplit(ref).scheme and not ref.startswith('//')
+
+
+def write_file(name, data):
+    path = os.path.join(STATIC, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def fetch(vendor_assets):
+    # Файлы, на которые ссылается CSS (шрифты), скачиваются рядом. Относительные ссылки
+    # сохраняют структуру каталогов; абсолютные кладутся в fonts/ возле CSS
+    for name, url in vendor_assets.items():
+        data = download(url)
+        if name.endswith('.css'):
+            css = data.decode('utf-8')
+            base_dir = posixpath.dirname(name)
+
+            def localize(match):
+                ref = match.group(2)
+                if ref.startswith('data:'):
+                    return match.group(0)
+                target = urljoin(url, ref)
+                clean = urlsplit(target)._replace(query='', fragment='').geturl()
+                if is_local_reference(ref):
+                    local = posixpath.normpath(posixpath.join(base_dir, urlsplit(ref).path))
+                    rewritten = ref
+                else:
+                    local = posixpath.join(base_dir, 'fonts', posixpath.basename(urlsplit(clean).path))
+                    rewritten = posixpath.relpath(local, base_dir)
+                if not os.path.exists(os.path.join(STATIC, *local.split('/'))):
+                    write_file(local, download(clean))
+                    print(f'  {local}')
+                return f'url({rewritten})'
+
+            data = CSS_URL.sub(localize, css).encode('utf-8')
+        write_file(name, data)
+        print(f'{name} <- {url}')
+
+
+def missing_vendor_assets(vendor_assets):
+    return [name for name in vendor_assets if not os.path.isfile(os.path.join(STATIC, *name.split('/')))]
+
+
+def fingerprint(name, data):
+    root, ext = posixpath.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return f'{root}.{digest}{ext}'
+
+
+def collect():
+    files = []
+    for source in SOURCES:
+        top = os.path.join(STATIC, source)
+        for dirpath, _, filenames in os.walk(top):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                files.append(os.path.relpath(path, STATIC).replace(os.sep, '/'))
+    return sorted(files)
+
+
+def rewrite_css(name, css, manifest):
+    # Ссылки на другие ресурсы заменяются собранными именами относительно нового CSS
+    base_dir = posixpath.dirname(name)
+    target_dir = posixpath.dirname(manifest.get(name, name))
+
+    def replace(match):
+        ref = match.group(2)
+        if not is_local_reference(ref):
+            return match.group(0)
+        parts = urlsplit(ref)
+        local = posixpath.normpath(posixpath.join(base_dir, parts.path))
+        if local not in manifest:
+            return match.group(0)
+        rewritten = posixpath.relpath(manifest[local], target_dir)
+        if parts.query:
+            rewritten += '?' + parts.query
+        if parts.fragment:
+            rewritten += '#' + parts.fragment
+        return f'url({rewritten})'
+
+    return CSS_URL.sub(replace, css)
+
+
+def compress(path, data, brotli):
+    # mtime=0 — одинаковый результат при одинаковом содержимом
+    written = []
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gz)
+        written.append(len(gz))
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            with open(path + '.br', 'wb') as f:
+                f.write(br)
+            written.append(len(br))
+    return written
+
+
+def build():
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print('brotli не установлен, собираются только .gz (pip install brotli)')
+
+    dist = os.path.join(STATIC, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    files = collect()
+    # CSS собирается последним, чтобы в манифесте уже были шрифты и картинки
+    files.sort(key=lambda name: name.endswith('.css'))
+    total_raw = total_compressed = 0
+    for name in files:
+        with open(os.path.join(STATIC, *name.split('/')), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            data = rewrite_css(name, data.decode('utf-8'), manifest).encode('utf-8')
+        hashed = fingerprint(name, data)
+        manifest[name] = hashed
+        path = os.path.join(dist, *hashed.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if posixpath.splitext(name)[1] in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+            sizes = compress(path, data, brotli)
+            if sizes:
+                total_raw += len(data)
+                total_compressed += min(sizes)
+        print(f'{name} -> {hashed}')
+
+    with open(os.path.join(dist, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f'Собрано файлов: {len(manifest)}; сжимаемые: {total_raw} -> {total_compressed} байт')
+    return manifest
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.perf_counter()
+    from app1 import VENDOR_ASSETS
+    if args.fetch:
+        fetch(VENDOR_ASSETS)
+    if not args.no_build:
+        missing = missing_vendor_assets(VENDOR_ASSETS)
+        if missing:
+            raise SystemExit('Нет вендорных библиотек: ' + ', '.join(missing) +
+                             '. Скачайте их (python build_assets.py --fetch) и закоммитьте static/vendor')
+        build()
+    print(f'Готово за {time.perf_counter() - started:.1f} c')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
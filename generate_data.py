@@ -0,0 +1,326 @@
+# Генератор синтетических данных для нагрузочного тестирования.
+#
+# Пример:
+#   python generate_data.py --database sqlite:///bench.db --users 1000000 \
+#       --attempts 20000000 --friendships 5000000 --tests 50000 --seed 42
+#
+# Все таблицы заполняются пакетными INSERT через SQLAlchemy Core, каждая таблица —
+# в одной транзакции. Один и тот же --seed дает одну и ту же базу.
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+BASE_TIME = datetime(2024, 9, 1)
+SUBJECTS = ['algebra', 'geometry']
+DEFAULT_PASSWORD = 'password'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Генерация синтетических данных Math_site')
+    parser.add_argument('--database', help='URI базы данных (по умолчанию DATABASE_URL или sqlite:///site.db)')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--tests', type=int, default=500)
+    parser.add_argument('--attempts', type=int, default=100000)
+    parser.add_argument('--friendships', type=int, default=50000, help='количество ребер графа дружбы')
+    parser.add_argument('--titles-per-user', type=int, default=2)
+    parser.add_argument('--shop-items', type=int, default=20, help='товаров в магазине (для сценария покупки)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--password', default=DEFAULT_PASSWORD, help='общий пароль всех сгенерированных пользователей')
+    parser.add_argument('--reset', action='store_true', help='удалить и пересоздать все таблицы')
+    return parser.parse_args(argv)
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def next_id(conn, table):
+    from sqlalchemy import func, select
+    return (conn.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+
+def bulk_insert(engine, table, rows, batch_size, or_ignore=False):
+    from sqlalchemy import insert
+    statement = insert(table)
+    if or_ignore:
+        statement = statement.prefix_with('OR IGNORE')
+    started = time.perf_counter()
+    count = attempted = 0
+    with engine.begin() as conn:
+        for batch in batched(rows, batch_size):
+            result = conn.execute(statement, batch)
+            # С OR IGNORE вставлено может быть меньше строк, чем передано
+            count += result.rowcount if result.rowcount >= 0 else len(batch)
+            attempted += len(batch)
+    elapsed = time.perf_counter() - started
+    skipped = f', пропущено дубликатов: {attempted - count}' if attempted != count else ''
+    print(f'{table.name}: {count} строк за {elapsed:.1f} c ({count / elapsed if elapsed else 0:.0f} строк/с){skipped}')
+    return count
+
+
+def user_rows(rng, first_id, count, password_hash):
+    for i in range(count):
+        uid = first_id + i
+        level = min(int(rng.expovariate(0.35)) + 1, 60)
+        yield {
+            'id': uid,
+            'username': f'user{uid}',
+            'email': f'user{uid}@example.com',
+            'password': password_hash,
+            'is_admin': False,
+            'created_at': BASE_TIME + timedelta(seconds=rng.randrange(365 * 86400)),
+            'xp': rng.randrange(100 * level ** 2),
+            'level': level,
+            'coins': int(rng.expovariate(1 / 150)),
+            'titles': '[]',
+            'inventory': '[]',
+            'friends': '[]',
+            'friend_requests': '[]',
+            'settings': '{}',
+        }
+
+
+def make_question(rng, subject):
+    # Возвращает (строки DSL, вопрос для таблицы question)
+    if subject == 'geometry':
+        figure = rng.choice(['circle', 'triangle', 'square', 'rectangle'])
+        if figure == 'circle':
+            r = rng.randint(1, 20)
+            return (['## Площадь круга: S = π × r²', f'<figure type="circle" radius="{r}" />',
+                     f'== Чему равна площадь круга с радиусом {r}? ==',
+                     f'[answer type="number" correct="{math.pi * r * r}"]'],
+                    (f'Чему равна площадь круга с радиусом {r}?', 'number', None, repr(math.pi * r * r)))
+        if figure == 'triangle':
+            k = rng.randint(1, 10)
+            a, b, c = 3 * k, 4 * k, 5 * k
+            return (['## Периметр треугольника: P = a + b + c', f'<figure type="triangle" sides="{a},{b},{c}" />',
+                     f'== Чему равен периметр треугольника со сторонами {a}, {b}, {c}? ==',
+                     f'[answer type="number" correct="{a + b + c}"]'],
+                    (f'Чему равен периметр треугольника со сторонами {a}, {b}, {c}?', 'number', None, str(a + b + c)))
+        if figure == 'square':
+            a = rng.randint(1, 30)
+            return (['## Площадь квадрата: S = a²', f'<figure type="square" side="{a}" />',
+                     f'== Чему равна площадь квадрата со стороной {a}? ==',
+                     f'[answer type="number" correct="{a * a}"]'],
+                    (f'Чему равна площадь квадрата со стороной {a}?', 'number', None, str(a * a)))
+        a, b = rng.randint(1, 30), rng.randint(1, 30)
+        return (['## Периметр прямоугольника: P = 2(a + b)', f'<figure type="rectangle" length="{a}" width="{b}" />',
+                 f'== Чему равен периметр прямоугольника {a} × {b}? ==',
+                 f'[answer type="number" correct="{2 * (a + b)}"]'],
+                (f'Чему равен периметр прямоугольника {a} × {b}?', 'number', None, str(2 * (a + b))))
+    if rng.random() < 0.7:
+        a = rng.choice([n for n in range(-9, 10) if n])
+        x = rng.randint(-20, 20)
+        b = -a * x
+        return ([f'== Решите уравнение: {a}x + {b} = 0 ==', f'[answer type="number" correct="{x}"]'],
+                (f'Решите уравнение: {a}x + {b} = 0', 'number', None, str(x)))
+    r = rng.randint(1, 12)
+    options = [str(r), str(-r), f'{r} и {-r}', 'Нет решений']
+    return ([f'== Решите уравнение: x² - {r * r} = 0 ==',
+             f'[answer type="multiple_choice" options="{"|".join(options)}" correct="{options[2]}"]'],
+            (f'Решите уравнение: x² - {r * r} = 0', 'multiple_choice', options, [options[2]]))
+
+
+def test_and_question_rows(rng, first_test_id, first_question_id, count, title_ids):
+    import json
+    tests, questions = [], []
+    question_id = first_question_id
+    for i in range(count):
+        tid = first_test_id + i
+        subject = rng.choice(SUBJECTS)
+        xp_reward = rng.randint(5, 30)
+        coin_reward = rng.randint(1, 20)
+        title_reward = rng.choice(title_ids) if rng.random() < 0.2 else None
+        title = f'{"Геометрия" if subject == "geometry" else "Алгебра"} №{tid}'
+        lines = [f'@test: {title}', f'@subject: {subject}', '@description: Сгенерированный тест',
+                 f'@xp_reward: {xp_reward}', f'@coin_reward: {coin_reward}',
+                 f'@title_reward: {title_reward or ""}', '']
+        for _ in range(rng.randint(2, 6)):
+            dsl, (text, answer_type, options, correct) = make_question(rng, subject)
+            lines.extend(dsl)
+            lines.append('')
+            questions.append({
+                'id': question_id,
+                'test_id': tid,
+                'text': text,
+                'answer_type': answer_type,
+                'options': json.dumps(options) if options else None,
+                'correct_answer': json.dumps(correct),
+                'figure_data': None,
+            })
+            question_id += 1
+        tests.append({
+            'id': tid,
+            'title': title,
+            'subject': subject,
+            'description': 'Сгенерированный тест',
+            'content': '\n'.join(lines),
+            'xp_reward': xp_reward,
+            'coin_reward': coin_reward,
+            'title_reward': title_reward,
+        })
+    return tests, questions
+
+
+def attempt_rows(rng, user_ids, test_ids, count):
+    # Как и в приложении, у пары (пользователь, тест) одна строка user_progress: каждый
+    # пользователь получает выборку тестов без повторов, в среднем count / users. Нижняя
+    # граница выборки гарантирует, что оставшимся пользователям хватит тестов до count
+    scores = [0.0, 20.0, 25.0, 33.33, 40.0, 50.0, 60.0, 66.67, 75.0, 80.0, 100.0]
+    users = user_ids[1] - user_ids[0]
+    tests = test_ids[1] - test_ids[0]
+    remaining = min(count, users * tests)
+    for i, uid in enumerate(range(*user_ids)):
+        left = users - i
+        low = max(0, remaining - (left - 1) * tests)
+        high = min(tests, remaining)
+        k = min(max(round(rng.uniform(0, 2 * remaining / left)), low), high)
+        remaining -= k
+        for test_id in rng.sample(range(*test_ids), k):
+            yield {
+                'user_id': uid,
+                'test_id': test_id,
+                'score': rng.choice(scores),
+                'completed_at': BASE_TIME + timedelta(seconds=rng.randrange(365 * 86400)),
+            }
+
+
+def friendship_rows(rng, user_ids, count, accepted, pending):
+    # Принятая дружба — два ребра, запрос — одно. Каждая неупорядоченная пара используется один
+    # раз: иначе следующая пара могла бы совпасть с половиной принятой дружбы, и INSERT OR IGNORE
+    # оставил бы ее односторонней. Пара (a, b) кодируется одним числом, чтобы множество занимало
+    # меньше памяти
+    users = user_ids[1] - user_ids[0]
+    pairs = users * (users - 1) // 2
+    seen = set()
+    produced = 0
+    while produced < count and len(seen) < pairs:
+        a = rng.randrange(*user_ids)
+        b = rng.randrange(*user_ids)
+        if a == b:
+            continue
+        pair = min(a, b) * users + max(a, b)
+        if pair in seen:
+            continue
+        seen.add(pair)
+        created_at = BASE_TIME + timedelta(seconds=rng.randrange(365 * 86400))
+        if rng.random() < 0.9 and produced + 2 <= count:
+            yield {'user_id': a, 'friend_id': b, 'status': accepted, 'created_at': created_at}
+            yield {'user_id': b, 'friend_id': a, 'status': accepted, 'created_at': created_at}
+            produced += 2
+        else:
+            yield {'user_id': a, 'friend_id': b, 'status': pending, 'created_at': created_at}
+            produced += 1
+
+
+def one_way_friendships(engine, table, user_ids, accepted):
+    # Принятые ребра без обратного принятого ребра среди сгенерированных пользователей
+    from sqlalchemy import and_, exists, func, select
+    reverse = table.alias('reverse')
+    query = select(func.count()).select_from(table).where(
+        table.c.status == accepted,
+        table.c.user_id >= user_ids[0], table.c.user_id < user_ids[1],
+        ~exists().where(and_(reverse.c.user_id == table.c.friend_id, reverse.c.friend_id == table.c.user_id,
+                             reverse.c.status == accepted)))
+    with engine.connect() as conn:
+        return conn.scalar(query)
+
+
+def shop_item_rows(rng, first_id, count):
+    # Купленный титул получает id товара как id титула, поэтому генерируются только предметы оформления
+    for i in range(count):
+        item_id = first_id + i
+        item_type = rng.choice(['badge', 'background'])
+        yield {
+            'id': item_id,
+            'name': f'{"Значок" if item_type == "badge" else "Фон"} №{item_id}',
+            'description': 'Сгенерированный товар',
+            'price': rng.randint(10, 300),
+            'item_type': item_type,
+            'image_url': None,
+        }
+
+
+def title_rows(rng, user_ids, per_user, title_ids):
+    for uid in range(*user_ids):
+        for tid in rng.sample(title_ids, min(per_user, len(title_ids))):
+            yield {'user_id': uid, 'title_id': tid, 'acquired_at': BASE_TIME}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+
+    from werkzeug.security import generate_password_hash
+    from app1 import (app, db, ensure_indexes, User, Test, Question, UserProgress, Friendship,
+                      UserTitle, ShopItem, TITLES, FRIENDSHIP_ACCEPTED, FRIENDSHIP_PENDING)
+
+    started = time.perf_counter()
+    with app.app_context():
+        engine = db.engine
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        ensure_indexes()
+        if engine.dialect.name == 'sqlite':
+            with engine.connect() as conn:
+                conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+
+        with engine.connect() as conn:
+            first_user = next_id(conn, User.__table__)
+            first_test = next_id(conn, Test.__table__)
+            first_question = next_id(conn, Question.__table__)
+            first_item = next_id(conn, ShopItem.__table__)
+
+        # Хэш пароля дорогой, поэтому он считается один раз для всех пользователей
+        password_hash = generate_password_hash(args.password)
+        title_ids = sorted(TITLES)
+        user_ids = (first_user, first_user + args.users)
+        test_ids = (first_test, first_test + args.tests)
+
+        bulk_insert(engine, User.__table__,
+                    user_rows(random.Random(f'{args.seed}:users'), first_user, args.users, password_hash),
+                    args.batch_size)
+        tests, questions = test_and_question_rows(random.Random(f'{args.seed}:tests'), first_test,
+                                                  first_question, args.tests, title_ids)
+        bulk_insert(engine, Test.__table__, tests, args.batch_size)
+        bulk_insert(engine, Question.__table__, questions, args.batch_size)
+        if args.users and args.tests:
+            bulk_insert(engine, UserProgress.__table__,
+                        attempt_rows(random.Random(f'{args.seed}:attempts'), user_ids, test_ids, args.attempts),
+                        args.batch_size)
+        if args.users > 1:
+            bulk_insert(engine, Friendship.__table__,
+                        friendship_rows(random.Random(f'{args.seed}:friendships'), user_ids, args.friendships,
+                                        FRIENDSHIP_ACCEPTED, FRIENDSHIP_PENDING),
+                        args.batch_size, or_ignore=True)
+            one_way = one_way_friendships(engine, Friendship.__table__, user_ids, FRIENDSHIP_ACCEPTED)
+            if one_way:
+                raise SystemExit(f'Несимметричных принятых дружб: {one_way}')
+        bulk_insert(engine, ShopItem.__table__,
+                    shop_item_rows(random.Random(f'{args.seed}:shop'), first_item, args.shop_items),
+                    args.batch_size)
+        bulk_insert(engine, UserTitle.__table__,
+                    title_rows(random.Random(f'{args.seed}:titles'), user_ids, args.titles_per_user, title_ids),
+                    args.batch_size, or_ignore=True)
+
+    print(f'Готово за {time.perf_counter() - started:.1f} c. '
+          f'Пользователи user{first_user}..user{first_user + args.users - 1}, пароль: {args.password}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+# Нагрузочный тест: воспроизводит типичный трафик учеников и печатает отчет в JSON.
+#
+# Против запущенного сервера (асинхронный HTTP-клиент, нужен aiohttp):
+#   python loadtest.py --mode http --url http://127.0.0.1:5000 --concurrency 50 --duration 60
+# Внутри процесса через WSGI (сервер не нужен):
+#   python loadtest.py --mode wsgi --database sqlite:///bench.db --concurrency 8 --requests 5000
+#
+# Пользователи берутся из generate_data.py: user<N> с общим паролем. Поля ответов берутся
+# со страницы теста, товары — со страницы магазина, поэтому сценарии не зависят от id в базе.
+# Ошибкой считаются ответы 4xx/5xx и редирект на /login (неудачный вход или потерянная сессия).
+# Отчет содержит пропускную способность, перцентили задержки и долю ошибок по маршрутам,
+# так что прогоны на разных коммитах можно сравнивать.
+import argparse
+import asyncio
+import html
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+DEFAULT_MIX = 'take_test=35,calculate=20,leaderboard=20,browse=15,buy=10'
+EXPRESSIONS = ['2 + 2 * 3', 'sqrt(144) + pi', 'sin(pi / 6) * 10', 'log(100) / log(10)', 'exp(1) ** 2', '(3 - 7) * 11 / 4']
+BROWSE_PATHS = [('GET /tests', '/tests'), ('GET /profile', '/profile'), ('GET /shop', '/shop'),
+                ('GET /friends', '/friends'), ('GET /', '/')]
+INPUT_RE = re.compile(r'<input\b[^>]*>')
+ATTR_RE = re.compile(r'([\w-]+)="([^"]*)"')
+BUY_RE = re.compile(r'action="/buy/(\d+)"')
+
+
+def parse_range(value):
+    start, _, end = value.partition('-')
+    return int(start), int(end or start)
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(ACTIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown actions in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочное тестирование Math_site')
+    parser.add_argument('--mode', choices=['http', 'wsgi'], default='wsgi')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='адрес сервера для режима http')
+    parser.add_argument('--database', help='URI базы для режима wsgi (по умолчанию DATABASE_URL)')
+    parser.add_argument('--concurrency', type=int, default=10, help='число одновременных виртуальных пользователей')
+    parser.add_argument('--duration', type=float, default=30.0, help='длительность прогона в секундах')
+    parser.add_argument('--requests', type=int, help='остановиться после этого числа запросов')
+    parser.add_argument('--warmup', type=float, default=0.0,
+                        help='не учитывать запросы первых N секунд (вход пользователей, прогрев); добавляется к --duration')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help=f'веса действий (по умолчанию {DEFAULT_MIX})')
+    parser.add_argument('--users', type=parse_range, default='1-1000', help='диапазон id пользователей, например 1-100000')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--test-ids', type=parse_range, default='1-200')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='файл для JSON-отчета (по умолчанию stdout)')
+    return parser.parse_args(argv)
+
+
+class Stats:
+    def __init__(self, warmup=0.0):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.total = 0
+        self.measure_from = time.perf_counter() + warmup
+
+    def record(self, route, elapsed, ok):
+        # Запросы, начатые во время прогрева, в отчет не попадают
+        if time.perf_counter() - elapsed < self.measure_from:
+            return
+        with self.lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            self.total += 1
+
+    def report(self, wall_time, args):
+        routes = {}
+        all_latencies = []
+        for route, samples in sorted(self.latencies.items()):
+            samples.sort()
+            all_latencies.extend(samples)
+            routes[route] = summarize(samples, self.errors.get(route, 0), wall_time)
+        all_latencies.sort()
+        return {
+            'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'mode': args.mode,
+            'concurrency': args.concurrency,
+            'mix': args.mix,
+            'seed': args.seed,
+            'wall_time_s': round(wall_time, 3),
+            'total': summarize(all_latencies, sum(self.errors.values()), wall_time),
+            'routes': routes,
+        }
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, max(0, int(round(q * (len(samples) - 1)))))
+    return round(samples[index] * 1000, 3)
+
+
+def summarize(samples, errors, wall_time):
+    count = len(samples)
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': round(errors / count, 4) if count else 0.0,
+        'rps': round(count / wall_time, 2) if wall_time else 0.0,
+        'mean_ms': round(sum(samples) / count * 1000, 3) if count else None,
+        'p50_ms': percentile(samples, 0.50),
+        'p90_ms': percentile(samples, 0.90),
+        'p95_ms': percentile(samples, 0.95),
+        'p99_ms': percentile(samples, 0.99),
+        'max_ms': round(samples[-1] * 1000, 3) if count else None,
+    }
+
+
+# Сценарии: каждое действие — генератор запросов (метка маршрута, метод, путь, данные формы, json).
+# Генератор получает обратно (статус, текст ответа), чтобы взять данные для следующего запроса
+# со страницы; state — память виртуального пользователя между действиями
+def answer_fields(page):
+    # Поля ответов формы теста: имя -> (тип, значения вариантов)
+    fields = {}
+    for tag in INPUT_RE.findall(page):
+        attrs = dict(ATTR_RE.findall(tag))
+        name = attrs.get('name', '')
+        if name.startswith('q'):
+            kind, options = fields.setdefault(name, (attrs.get('type', 'text'), []))
+            if 'value' in attrs:
+                options.append(html.unescape(attrs['value']))
+    return fields
+
+
+def take_test(rng, args, state):
+    test_id = rng.randint(*args.test_ids)
+    status, page = yield ('GET /test/<id>', 'GET', f'/test/{test_id}', None, None)
+    if status != 200:
+        return
+    # Идентификатор отправки браузер создает сам; повтор формы с ним не засчитывается дважды
+    form = [('submission_id', f'{rng.getrandbits(64):016x}')]
+    for name, (kind, options) in answer_fields(page).items():
+        if kind == 'checkbox' and options:
+            form += [(name, option) for option in rng.sample(options, rng.randint(1, len(options)))]
+        else:
+            form.append((name, str(rng.randint(-20, 100))))
+    yield ('POST /test/<id>', 'POST', f'/test/{test_id}', form, None)
+
+
+def calculate(rng, args, state):
+    yield ('POST /api/calculate', 'POST', '/api/calculate', None, {'expression': rng.choice(EXPRESSIONS)})
+
+
+def leaderboard(rng, args, state):
+    yield ('GET /leaderboard', 'GET', '/leaderboard', None, None)
+
+
+def browse(rng, args, state):
+    label, path = rng.choice(BROWSE_PATHS)
+    yield (label, 'GET', path, None, None)
+
+
+def buy(rng, args, state):
+    # Товары один раз на виртуального пользователя читаются со страницы магазина
+    if 'item_ids' not in state:
+        status, page = yield ('GET /shop', 'GET', '/shop', None, None)
+        state['item_ids'] = sorted({int(item_id) for item_id in BUY_RE.findall(page)}) if status == 200 else []
+    if state['item_ids']:
+        yield ('POST /buy/<id>', 'POST', f'/buy/{rng.choice(state["item_ids"])}', None, None)
+
+
+ACTIONS = {
+    'take_test': take_test,
+    'calculate': calculate,
+    'leaderboard': leaderboard,
+    'browse': browse,
+    'buy': buy,
+}
+
+
+def is_ok(status, location=None):
+    # Редиректы (покупка) — нормальный ответ; редирект на /login значит, что сессии нет
+    if location and urlsplit(location).path == '/login':
+        return False
+    return status < 400
+
+
+def login_ok(status, location=None):
+    # При неверном пароле страница входа возвращается с кодом 200
+    return 300 <= status < 400 and is_ok(status, location)
+
+
+class Budget:
+    def __init__(self, args):
+        self.deadline = time.perf_counter() + args.warmup + args.duration
+        self.remaining = args.requests
+        self.lock = threading.Lock()
+
+    def take(self):
+        if time.perf_counter() >= self.deadline:
+            return False
+        if self.remaining is None:
+            return True
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def pick_action(rng, mix):
+    names = list(mix)
+    return ACTIONS[rng.choices(names, weights=[mix[n] for n in names])[0]]
+
+
+def login_form(rng, args):
+    return {'username': f'user{rng.randint(*args.users)}', 'password': args.password}
+
+
+# Режим wsgi: каждый виртуальный пользователь — поток со своим test_client
+def run_wsgi(args, stats, budget):
+    if args.database:
+        os.environ['DATABASE_URL'] = args.database
+    from werkzeug.datastructures import MultiDict
+    from app1 import app
+
+    def worker(index):
+        rng = random.Random(f'{args.seed}:{index}')
+        client = app.test_client()
+        state = {}
+        if not budget.take():
+            return
+        started = time.perf_counter()
+        response = client.post('/login', data=login_form(rng, args))
+        stats.record('POST /login', time.perf_counter() - started,
+                     login_ok(response.status_code, response.headers.get('Location')))
+        while True:
+            action = pick_action(rng, args.mix)(rng, args, state)
+            result = None
+            while True:
+                try:
+                    label, method, path, form, payload = action.send(result)
+                except StopIteration:
+                    break
+                if not budget.take():
+                    return
+                started = time.perf_counter()
+                try:
+                    response = client.open(path, method=method, data=MultiDict(form) if form else None, json=payload)
+                    ok = is_ok(response.status_code, response.headers.get('Location'))
+                    result = (response.status_code, response.get_data(as_text=True))
+                    response.close()
+                except Exception:
+                    ok = False
+                    result = (0, '')
+                stats.record(label, time.perf_counter() - started, ok)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Режим http: асинхронные виртуальные пользователи против запущенного сервера
+async def run_http(args, stats, budget):
+    try:
+        import aiohttp
+    except ImportError:
+        raise SystemExit('Для режима http нужен aiohttp: pip install aiohttp')
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    async def request(session, label, method, path, form=None, payload=None, check=is_ok):
+        started = time.perf_counter()
+        try:
+            async with session.request(method, args.url + path, data=form, json=payload,
+                                       allow_redirects=False) as response:
+                result = (response.status, await response.text())
+                ok = check(response.status, response.headers.get('Location'))
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            result = (0, '')
+            ok = False
+        stats.record(label, time.perf_counter() - started, ok)
+        return result
+
+    async def virtual_user(index):
+        rng = random.Random(f'{args.seed}:{index}')
+        jar = aiohttp.CookieJar(unsafe=True)
+        async with aiohttp.ClientSession(connector=connector, connector_owner=False,
+                                         cookie_jar=jar, timeout=timeout) as session:
+            state = {}
+            if not budget.take():
+                return
+            await request(session, 'POST /login', 'POST', '/login', form=login_form(rng, args), check=login_ok)
+            while True:
+                action = pick_action(rng, args.mix)(rng, args, state)
+                result = None
+                while True:
+                    try:
+                        label, method, path, form, payload = action.send(result)
+                    except StopIteration:
+                        break
+                    if not budget.take():
+                        return
+                    result = await request(session, label, method, path, form, payload)
+
+    try:
+        await asyncio.gather(*(virtual_user(i) for i in range(args.concurrency)))
+    finally:
+        await connector.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stats = Stats(args.warmup)
+    budget = Budget(args)
+    if args.mode == 'http':
+        asyncio.run(run_http(args, stats, budget))
+    else:
+        run_wsgi(args, stats, budget)
+    report = stats.report(time.perf_counter() - stats.measure_from, args)
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# Боевой запуск под gunicorn: приложение создается и прогревается до fork, число процессов
+# и потоков выбирается по числу ядер, код обновляется без потери запросов.
+#
+#   python serve.py --bind 0.0.0.0:8000 --pidfile /run/math_site.pid
+#   python serve.py --reload --pidfile /run/math_site.pid      # выкатить новый код
+#
+# Мастер-процесс создает приложение и вызывает warm_up: шаблоны, разобранные тесты,
+# рейтинги и индекс достижений оказываются в памяти до fork, и рабочие процессы делят эти
+# страницы copy-on-write. После прогрева объекты замораживаются (gc.freeze), чтобы сборщик
+# мусора в рабочих процессах не трогал их и не копировал страницы, а пул соединений
+# закрывается: соединение SQLite нельзя использовать из двух процессов.
+#
+# По умолчанию процессов столько же, сколько ядер (при общем кэше фрагментов, иначе один),
+# и по 8 потоков в каждом. Запросы в основном нагружают процессор (шаблоны, разбор тестов),
+# а SQLite все равно пишет по одному, так что лишние процессы только ждут блокировку базы
+# и занимают память; потоки закрывают ожидание диска при записи. Замер bench_serving.py
+# на 1 ядре, 16 клиентов, 20 c, два прогона:
+#   1 x 8 — 247 rps, p95 108 мс;  1 x 4 — 216-254 rps, p95 83-106 мс;
+#   1 x 1 — 236-241 rps, p95 77-96 мс;  1 x 16 — 213-228 rps, p95 123-129 мс.
+# Конфигурации с несколькими процессами требуют Redis и в этот замер не вошли.
+# Предзагрузка уменьшает частную память рабочего процесса с 77 до 53 МБ (1 x 8).
+#
+# Каждый процесс держит свои рейтинги в памяти, поэтому при нескольких процессах они
+# перечитываются из базы раз в --rankings-max-age секунд. Кэш фрагментов и версии, из которых
+# строятся ETag, должны быть общими: с кэшем в памяти процесса изменение в одном процессе не
+# видно остальным, и они отдают устаревшие /tests и /shop. Поэтому при --workers > 1 нужен
+# --fragment-cache-url (или FRAGMENT_CACHE_URL) с сервером Redis.
+#
+# Перезагрузка:
+#   kill -HUP <мастер>    — новые рабочие процессы с тем же кодом (например, после смены
+#                           окружения); старые дообслуживают начатые запросы
+#   serve.py --reload     — новый код: USR2 запускает новый мастер на тех же сокетах, и когда
+#                           он готов, старый получает TERM и завершается, дождавшись текущих
+#                           запросов (не дольше --graceful-timeout)
+# Завершающийся процесс закрывает keep-alive соединения: запрос, отправленный в такое
+# соединение в момент закрытия, получит разрыв. Прокси перед сервером повторяет такие
+# запросы (nginx: proxy_next_upstream); без прокси можно отключить keep-alive (--keepalive 0).
+import argparse
+import gc
+import os
+import signal
+import sys
+import time
+
+DEFAULT_BIND = '127.0.0.1:8000'
+DEFAULT_THREADS = 8
+DEFAULT_RANKINGS_MAX_AGE = 30.0
+
+
+def default_workers(fragment_cache_url):
+    # Без общего кэша фрагментов процессы не видят изменений друг друга, поэтому один процесс
+    from app1 import is_shared_cache_url
+    if not is_shared_cache_url(fragment_cache_url):
+        return 1
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Запуск Math_site под gunicorn')
+    parser.add_argument('--bind', action='append', help=f'адрес, можно несколько (по умолчанию {DEFAULT_BIND})')
+    parser.add_argument('--workers', type=int,
+                        help='число процессов (по умолчанию — ядра при --fragment-cache-url redis://..., иначе 1)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, help='потоков в процессе')
+    parser.add_argument('--timeout', type=int, default=30, help='зависший процесс перезапускается через столько секунд')
+    parser.add_argument('--graceful-timeout', type=int, default=30, help='сколько ждать текущие запросы при остановке')
+    parser.add_argument('--keepalive', type=int, default=5)
+    parser.add_argument('--max-requests', type=int, default=10000,
+                        help='перезапуск процесса после стольких запросов (fork из прогретого мастера дешевый)')
+    parser.add_argument('--rankings-max-age', type=float,
+                        help=f'частота перечитывания рейтингов при нескольких процессах (по умолчанию {DEFAULT_RANKINGS_MAX_AGE:g} c)')
+    parser.add_argument('--fragment-cache-url', default=os.environ.get('FRAGMENT_CACHE_URL'),
+                        help='общий кэш фрагментов (redis://...), обязателен при --workers > 1')
+    parser.add_argument('--no-preload', action='store_true', help='создавать приложение в каждом процессе (для сравнения)')
+    parser.add_argument('--init-db', action='store_true', help='создать таблицы и начальные данные перед запуском')
+    parser.add_argument('--pidfile')
+    parser.add_argument('--access-log', help="файл журнала запросов, '-' — stdout")
+    parser.add_argument('--reload', action='store_true', help='перезапустить работающий сервер из --pidfile с новым кодом')
+    parser.add_argument('--ready-timeout', type=float, default=60.0, help='сколько ждать готовности нового мастера при --reload')
+    return parser.parse_args(argv)
+
+
+def app_config(args):
+    config = {}
+    if args.fragment_cache_url:
+        config['FRAGMENT_CACHE_URL'] = args.fragment_cache_url
+    if args.workers > 1 and not os.environ.get('RANKINGS_MAX_AGE'):
+        config['RANKINGS_MAX_AGE'] = args.rankings_max_age or DEFAULT_RANKINGS_MAX_AGE
+    elif args.rankings_max_age:
+        config['RANKINGS_MAX_AGE'] = args.rankings_max_age
+    return config
+
+
+def load_app(args, preload):
+    import app1
+    from sqlalchemy import text
+
+    app = app1.create_app(app_config(args))
+    if args.init_db:
+        app1.init_db(app)
+    with app.app_context():
+        engine = app1.db.engine
+        if engine.dialect.name == 'sqlite':
+            # Читатели в WAL не ждут писателя из другого процесса; режим сохраняется в файле базы
+            with engine.connect() as conn:
+                conn.execute(text('PRAGMA journal_mode=WAL'))
+    timings = app1.warm_up(app)
+    print('Прогрев: ' + ', '.join(f'{name} {ms} мс' for name, ms in timings.items()), file=sys.stderr)
+    with app.app_context():
+        app1.db.engine.dispose()
+    if preload:
+        gc.collect()
+        gc.freeze()
+    return app
+
+
+def post_fork(server, worker):
+    # Потоки не переживают fork, поэтому планировщик запускается в каждом рабочем процессе:
+    # общие задачи захватывает один из них через job_run, локальные выполняет каждый
+    import app1
+    app = worker.app.wsgi()
+    if app.config['SCHEDULER_ENABLED']:
+        app1.app_state(app).scheduler.start(app, app.config['SCHEDULER_INTERVAL'])
+
+
+def make_server(args):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit('Для serve.py нужен gunicorn: pip install gunicorn')
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': args.bind or [DEFAULT_BIND],
+                'workers': args.workers,
+                'threads': args.threads,
+                'worker_class': 'gthread',
+                'preload_app': not args.no_preload,
+                'timeout': args.timeout,
+                'graceful_timeout': args.graceful_timeout,
+                'keepalive': args.keepalive,
+                'max_requests': args.max_requests,
+                'max_requests_jitter': args.max_requests // 10,
+                'pidfile': args.pidfile,
+                'accesslog': args.access_log,
+                'proc_name': 'math_site',
+                'post_fork': post_fork,
+            }
+            for key, value in options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return load_app(args, preload=not args.no_preload)
+
+    return Server()
+
+
+def read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0) or None
+    except (OSError, ValueError):
+        return None
+
+
+def worker_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return None
+
+
+def reload(args):
+    # USR2: мастер запускает новый мастер с тем же кодом запуска и теми же сокетами. Новый пишет
+    # pid в <pidfile>.2 уже после предзагрузки и переименовывает его, когда старый завершится
+    if not args.pidfile:
+        raise SystemExit('--reload требует --pidfile')
+    old_pid = read_pid(args.pidfile)
+    if old_pid is None:
+        raise SystemExit(f'Сервер не запущен: нет {args.pidfile}')
+    expected = len(worker_pids(old_pid) or []) or args.workers
+    os.kill(old_pid, signal.SIGUSR2)
+    deadline = time.monotonic() + args.ready_timeout
+    while True:
+        new_pid = read_pid(args.pidfile + '.2')
+        children = worker_pids(new_pid) if new_pid else []
+        if new_pid and (children is None or len(children) >= expected):
+            break
+        if time.monotonic() >= deadline:
+            # Если новый мастер не поднялся, старый продолжает обслуживать запросы
+            raise SystemExit(f'Новый мастер не готов за {args.ready_timeout:g} c, старый ({old_pid}) продолжает работу')
+        time.sleep(0.1)
+    if children is None:
+        # Без /proc число рабочих процессов не узнать — даем им время запуститься
+        time.sleep(1)
+    os.kill(old_pid, signal.SIGTERM)
+    print(f'Мастер {old_pid} -> {new_pid}; старый завершается после текущих запросов')
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.workers is None:
+        args.workers = default_workers(args.fragment_cache_url)
+    if args.reload:
+        return reload(args)
+    from app1 import is_shared_cache_url
+    if args.workers > 1 and not is_shared_cache_url(args.fragment_cache_url):
+        raise SystemExit(f'При --workers {args.workers} нужен общий кэш фрагментов: задайте '
+                         '--fragment-cache-url redis://... (или FRAGMENT_CACHE_URL) либо --workers 1')
+    make_server(args).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,29 @@
+// Переключение бокового меню на мобильных устройствах
+function toggleSidebar() {
+    document.querySelector('.sidebar').classList.toggle('active');
+}
+
+// Автоматическое скрытие flash-сообщений
+document.addEventListener('DOMContentLoaded', function() {
+    const alerts = document.querySelectorAll('.alert');
+    alerts.forEach(function(alert) {
+        setTimeout(function() {
+            alert.classList.remove('show');
+            setTimeout(function() {
+                alert.remove();
+            }, 300);
+        }, 5000);
+    });
+});
+
+// Закрытие бокового меню при клике вне его на мобильных устройствах
+document.addEventListener('click', function(event) {
+    const sidebar = document.querySelector('.sidebar');
+    const mobileMenuBtn = document.querySelector('.mobile-menu-btn');
+
+    if (window.innerWidth <= 768 && 
+        !sidebar.contains(event.target) && 
+        !mobileMenuBtn.contains(event.target)) {
+        sidebar.classList.remove('active');
+    }
+});